@@ -0,0 +1,103 @@
+import argparse
+import logging
+import os
+import time
+
+import numpy as np
+import torch
+from torch.utils.data import SequentialSampler
+
+import utils
+from modeling.inference import VectorNetInference, pack_inputs, export_onnx, export_torchscript
+from modeling.vectornet import VectorNet
+
+logging.basicConfig(format='%(asctime)s - %(levelname)s - %(name)s -   %(message)s',
+                    datefmt='%m/%d/%Y %H:%M:%S',
+                    level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Batches run before timing, for the allocator and the TorchScript profiling executor.
+WARMUP_BATCH_NUM = 3
+
+
+def get_latency_string(name, latencies, batch_sizes):
+    """
+    Percentiles are of the batch latencies. The latency per scenario divides every batch by its own size,
+    since the last batch of the eval dataset can be smaller.
+    """
+    latencies = np.array(latencies) * 1000.0
+    return '{}: {:.2f} ms per batch of {:.1f}, {:.2f} ms per scenario, p50 {:.2f} ms, p90 {:.2f} ms, p99 {:.2f} ms'.format(
+        name, np.mean(latencies), np.mean(batch_sizes), np.mean(latencies / np.array(batch_sizes)),
+        *np.percentile(latencies, [50, 90, 99]))
+
+
+def benchmark(args):
+    """
+    Latency of VectorNetInference on the CPU, eager and exported, on the batches of the eval dataset.
+    """
+    torch.set_num_threads(args.core_num)
+    from dataset_argoverse import Dataset
+    eval_dataset = Dataset(args, args.eval_batch_size)
+    eval_dataloader = torch.utils.data.DataLoader(eval_dataset, batch_size=args.eval_batch_size,
+                                                  sampler=SequentialSampler(eval_dataset),
+                                                  collate_fn=utils.batch_list_to_batch_tensors)
+    model = VectorNet(args)
+    logger.info("***** Recover model: %s *****", args.model_recover_path)
+    model.load_state_dict(torch.load(args.model_recover_path, map_location='cpu'))
+    engine = VectorNetInference(model, args).eval()
+
+    batches = []
+    for batch in eval_dataloader:
+        batches.append(pack_inputs(batch))
+        if len(batches) == WARMUP_BATCH_NUM + args.benchmark_batch_num:
+            break
+    assert len(batches) > WARMUP_BATCH_NUM, 'not enough batches in the eval dataset'
+
+    engines = [('eager', engine)]
+    os.makedirs(args.export_dir, exist_ok=True)
+    path = os.path.join(args.export_dir, 'vectornet.pt')
+    # The last batch is checked too, its polyline and goal numbers are different.
+    export_torchscript(engine, batches[0], path, check_inputs=batches[-1:])
+    engines.append(('torchscript', torch.jit.load(path)))
+    logger.info('TorchScript model saved to %s', path)
+    if args.onnx:
+        path = os.path.join(args.export_dir, 'vectornet.onnx')
+        export_onnx(engine, batches[0], path)
+        logger.info('ONNX model saved to %s', path)
+
+    with torch.no_grad():
+        for name, function in engines:
+            latencies = []
+            batch_sizes = []
+            for i, inputs in enumerate(batches):
+                start_time = time.perf_counter()
+                function(*inputs)
+                if i >= WARMUP_BATCH_NUM:
+                    latencies.append(time.perf_counter() - start_time)
+                    batch_sizes.append(inputs[2].shape[0])
+            utils.logging(get_latency_string(name, latencies, batch_sizes), to_screen=True)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    utils.add_argument(parser)
+    parser.add_argument("--benchmark_batch_num",
+                        default=50,
+                        type=int)
+    parser.add_argument("--export_dir",
+                        default=None,
+                        type=str,
+                        help="where the exported models are saved, output_dir/inference if None")
+    parser.add_argument("--onnx",
+                        action='store_true',
+                        help="also export the model to ONNX, which needs the onnx package")
+    args: utils.Args = parser.parse_args()
+    utils.init(args, logger)
+    if args.export_dir is None:
+        args.export_dir = os.path.join(args.output_dir, 'inference')
+
+    benchmark(args)
+
+
+if __name__ == "__main__":
+    main()
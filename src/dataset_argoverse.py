@@ -1,14 +1,17 @@
 import copy
+import hashlib
+import json
 import math
 import multiprocessing
 import os
 import pickle
 import random
+import shutil
 from statistics import mean
-import zlib
 from collections import defaultdict
 from typing import Dict, List, Optional
 from multiprocessing import Process
+from queue import Empty
 from random import choice
 
 import numpy as np
@@ -16,9 +19,14 @@ import torch
 from argoverse.map_representation.map_api import ArgoverseMap
 from tqdm import tqdm
 
+import eval_metrics
 import utils_cython
+from drivable_area import create_drivable_area, get_drivable_area_compliance
+from frame_transform import Frame
 import utils
-from utils import get_name, get_file_name_int, get_angle, logging, rotate, round_value, get_pad_vector, get_dis, get_subdivide_polygons
+from lane_index import LaneIndex
+from scenario_cache import CACHE_VERSION, SHARD_FILES, DiskLRU, ScenarioCacheWriter, ShardedScenarioCache, get_shard_dir, load_manifest
+from utils import get_name, get_file_name_int, get_angle, logging, round_value, get_pad_vector, get_dis, get_subdivide_polygons
 from utils import get_points_remove_repeated, get_one_subdivide_polygon, get_dis_point_2_polygons, larger, equal, assert_
 from utils import get_neighbour_points, get_subdivide_points, get_unit_vector, get_dis_point_2_points
 
@@ -36,12 +44,116 @@ type2index["AV"] = 2
 
 max_vector_num = 0
 
+# Loaded by load_map.
+am = None
+lane_index = None
+
+# Scenarios whose metrics are computed at once by get_displacement_errors_and_miss_rate.
+METRICS_CHUNK_SIZE = 4096
+
 VECTOR_PRE_X = 0
 VECTOR_PRE_Y = 1
 VECTOR_X = 2
 VECTOR_Y = 3 
 
 
+def get_history_num(timestamps: np.ndarray, two_seconds):
+    """
+    Number of leading frames of a track which are not later than two_seconds.
+    """
+    is_future = larger(timestamps, two_seconds)
+    return int(np.argmax(is_future)) if np.any(is_future) else len(timestamps)
+
+
+def get_agent_vectors(points: np.ndarray, timestamps: np.ndarray, object_type: int, polyline_idx, hidden_size):
+    """
+    Build the vectors of an agent trajectory, one vector per pair of consecutive points.
+
+    Layout: [pre_x, pre_y, x, y, timestamp, is_AV, is_AGENT, is_OTHERS, polyline index, point index, 0...].
+    """
+    vector_num = max(len(points) - 1, 0)
+    vectors = np.zeros([vector_num, hidden_size], dtype=np.float32)
+    if vector_num > 0:
+        vectors[:, 0:2] = points[:-1]
+        vectors[:, 2:4] = points[1:]
+        vectors[:, 4] = timestamps[1:]
+        vectors[:, 5] = object_type == type2index['AV']
+        vectors[:, 6] = object_type == type2index['AGENT']
+        vectors[:, 7] = object_type == type2index['OTHERS']
+        vectors[:, 8] = polyline_idx
+        vectors[:, 9] = np.arange(1, vector_num + 1)
+    return vectors
+
+
+def get_lane_vectors(polygon: np.ndarray, polyline_idx, hidden_size, lane_segment=None):
+    """
+    Build the vectors of a lane centerline, one vector per pair of consecutive points.
+
+    Lane features are stored at the end of each vector, see VECTOR_PRE_X etc.
+    """
+    vector_num = len(polygon) - 1
+    vectors = np.zeros([vector_num, hidden_size], dtype=np.float32)
+    point_pre, point = polygon[:-1], polygon[1:]
+    vectors[:, -1 - VECTOR_PRE_X] = point_pre[:, 0]
+    vectors[:, -1 - VECTOR_PRE_Y] = point_pre[:, 1]
+    vectors[:, -1 - VECTOR_X] = point[:, 0]
+    vectors[:, -1 - VECTOR_Y] = point[:, 1]
+    vectors[:, -5] = 1
+    vectors[:, -6] = np.arange(1, vector_num + 1)  # position in the polyline
+    vectors[:, -7] = polyline_idx
+
+    if lane_segment is not None:
+        vectors[:, -8] = 1 if lane_segment.has_traffic_control else -1
+        vectors[:, -9] = 1 if lane_segment.turn_direction == 'RIGHT' else \
+            -1 if lane_segment.turn_direction == 'LEFT' else 0
+        vectors[:, -10] = 1 if lane_segment.is_intersection else -1
+
+    # The point before point_pre. It is extrapolated for the first vector.
+    vectors[0, -17] = 2 * point_pre[0, 0] - point[0, 0]
+    vectors[0, -18] = 2 * point_pre[0, 1] - point[0, 1]
+    vectors[1:, -17] = polygon[:-2, 0]
+    vectors[1:, -18] = polygon[:-2, 1]
+    return vectors
+
+
+def get_point_hash(point):
+    return round((point[0] + 500) * 100) * 1000000 + round((point[1] + 500) * 100)
+
+
+def get_goals_2D(args: utils.Args, polygons):
+    """
+    Sparse goal candidates: the distinct points of all lanes, and the points subdivided from them.
+    """
+    points = []
+    visit = {}
+    # Retrieve all points in the polygones (lanes on a radius of 50m) - goals_2D
+    for polygon in polygons:
+        for point in polygon:
+            hash = get_point_hash(point)  # create hash table for points
+            if hash not in visit:
+                visit[hash] = True
+                points.append(point)
+
+        # Subdivide lanes to get more fine-grained 2D goals.
+        if 'subdivide' in args.other_params:
+            points.extend(get_subdivide_points(polygon))
+    return np.array(points)
+
+
+def get_stage_one_label(polygons, point_label):
+    """
+    Index of the polygon with the point closest to point_label.
+    """
+    stage_one_label = 0
+    min_dis = 10000.0
+    for i, polygon in enumerate(polygons):
+        temp = np.min(get_dis(polygon, point_label))
+        if temp < min_dis:
+            min_dis = temp
+            stage_one_label = i
+    return stage_one_label
+
+
 def get_sub_map(args: utils.Args, x, y, city_name, vectors=[], polyline_spans=[], mapping=None):
     """
     Calculate lanes which are close to (x, y) on map.
@@ -56,20 +168,15 @@ def get_sub_map(args: utils.Args, x, y, city_name, vectors=[], polyline_spans=[]
         assert isinstance(am, ArgoverseMap)
         # Add more lane attributes, such as 'has_traffic_control', 'is_intersection' etc.
         if 'semantic_lane' in args.other_params:
-            lane_ids = am.get_lane_ids_in_xy_bbox(x, y, city_name, query_search_range_manhattan=args.max_distance)
-            # Mask out lanes (polygons) with a p% probability
-            if 'mask_lanes' in args.other_params:
-                lane_ids = [lane for lane in lane_ids if random.random() > float(args.other_params['p'])]
-            local_lane_centerlines = [am.get_lane_segment_centerline(lane_id, city_name) for lane_id in lane_ids]
-            polygons = local_lane_centerlines
+            lane_idxs = lane_index.get_lane_idxs_in_xy_bbox(x, y, city_name, query_search_range_manhattan=args.max_distance)
+            lane_ids = lane_index.get_lane_ids(city_name, lane_idxs)
+            polygons = lane_index.get_centerlines(city_name, lane_idxs, x, y, mapping['angle'])
 
             if args.visualize:
-                angle = mapping['angle']
-                vis_lanes = [am.get_lane_segment_polygon(lane_id, city_name)[:, :2] for lane_id in lane_ids]
+                frame = Frame(x, y, mapping['angle'])
+                vis_lanes = [frame.to_frame(am.get_lane_segment_polygon(lane_id, city_name)[:, :2]) for lane_id in lane_ids]
                 t = []
                 for each in vis_lanes:
-                    for point in each:
-                        point[0], point[1] = rotate(point[0] - x, point[1] - y, angle)
                     num = len(each) // 2
                     t.append(each[:num].copy())
                     t.append(each[num:num * 2].copy())
@@ -78,17 +185,11 @@ def get_sub_map(args: utils.Args, x, y, city_name, vectors=[], polyline_spans=[]
         else:
             polygons = am.find_local_lane_centerlines(x, y, city_name,
                                                       query_search_range_manhattan=args.max_distance)
-        polygons = [polygon[:, :2].copy() for polygon in polygons]
-        angle = mapping['angle']
-        for index_polygon, polygon in enumerate(polygons):
-            for i, point in enumerate(polygon):
-                point[0], point[1] = rotate(point[0] - x, point[1] - y, angle)
-                if 'scale' in mapping:
-                    assert 'enhance_rep_4' in args.other_params
-                    scale = mapping['scale']
-                    point[0] *= scale
-                    point[1] *= scale
-
+            frame = Frame(x, y, mapping['angle'])
+            polygons = [frame.to_frame(polygon[:, :2]) for polygon in polygons]
+        if 'scale' in mapping:
+            assert 'enhance_rep_4' in args.other_params
+            polygons = [polygon * mapping['scale'] for polygon in polygons]
 
         def dis_2(point):
             return point[0] * point[0] + point[1] * point[1]
@@ -108,9 +209,6 @@ def get_sub_map(args: utils.Args, x, y, city_name, vectors=[], polyline_spans=[]
                     return True
             return False
 
-        def get_hash(point):
-            return round((point[0] + 500) * 100) * 1000000 + round((point[1] + 500) * 100)
-
         lane_idx_2_polygon_idx = {}
         for polygon_idx, lane_idx in enumerate(lane_ids):
             lane_idx_2_polygon_idx[lane_idx] = polygon_idx
@@ -119,69 +217,24 @@ def get_sub_map(args: utils.Args, x, y, city_name, vectors=[], polyline_spans=[]
         # In this implementation, we use goal scoring instead of lane scoring, because we observed that it performs slightly better than lane scoring.
         # Here we only sample sparse goals, and dense goal sampling is performed after goal scoring (see decoder).
         if 'goals_2D' in args.other_params:
-            points = []
-            visit = {}
-            point_idx_2_unit_vector = []
-
             mapping['polygons'] = polygons
-
-            # Retrieve all points in the polygones (lanes on a radius of 50m) - goals_2D
-            for index_polygon, polygon in enumerate(polygons): 
-                for i, point in enumerate(polygon):
-                    hash = get_hash(point)  # create hash table for points 
-                    if hash not in visit:
-                        visit[hash] = True
-                        points.append(point)
-
-                # Subdivide lanes to get more fine-grained 2D goals.
-                if 'subdivide' in args.other_params: 
-                    subdivide_points = get_subdivide_points(polygon)  
-                    points.extend(subdivide_points)
-                    subdivide_points = get_subdivide_points(polygon, include_self=True)  
-
-            mapping['goals_2D'] = np.array(points) 
+            mapping['goals_2D'] = get_goals_2D(args, polygons)
 
         # Create vectors for polygones/lanes
         for index_polygon, polygon in enumerate(polygons): 
             assert_(2 <= len(polygon) <= 10, info=len(polygon))  #most of the lengths are 10 points
             # assert len(polygon) % 2 == 1
-            # if args.visualize:
-            #     traj = np.zeros((len(polygon), 2))
-            #     for i, point in enumerate(polygon):
-            #         traj[i, 0], traj[i, 1] = point[0], point[1]
-            #     mapping['trajs'].append(traj)
 
-            start = len(vectors)
+            lane_segment = None
             if 'semantic_lane' in args.other_params:
                 assert len(lane_ids) == len(polygons)
                 lane_id = lane_ids[index_polygon]
                 lane_segment = am.city_lane_centerlines_dict[city_name][lane_id]
             assert_(len(polygon) >= 2)
-            for i, point in enumerate(polygon):
-                if i > 0:
-                    vector = [0] * args.hidden_size
-                    vector[-1 - VECTOR_PRE_X], vector[-1 - VECTOR_PRE_Y] = point_pre[0], point_pre[1]
-                    vector[-1 - VECTOR_X], vector[-1 - VECTOR_Y] = point[0], point[1]
-                    vector[-5] = 1
-                    vector[-6] = i #position in the polyline
-
-                    vector[-7] = len(polyline_spans)
-
-                    if 'semantic_lane' in args.other_params:
-                        vector[-8] = 1 if lane_segment.has_traffic_control else -1
-                        vector[-9] = 1 if lane_segment.turn_direction == 'RIGHT' else \
-                            -1 if lane_segment.turn_direction == 'LEFT' else 0
-                        vector[-10] = 1 if lane_segment.is_intersection else -1
-                    point_pre_pre = (2 * point_pre[0] - point[0], 2 * point_pre[1] - point[1]) 
-                    if i >= 2:
-                        point_pre_pre = polygon[i - 2]
-                    vector[-17] = point_pre_pre[0]
-                    vector[-18] = point_pre_pre[1]
-
-                    vectors.append(vector)
-                point_pre = point
-
-            end = len(vectors)
+            start = polyline_spans[-1][1] if len(polyline_spans) > 0 else 0
+            lane_vectors = get_lane_vectors(polygon, len(polyline_spans), args.hidden_size, lane_segment)
+            vectors.append(lane_vectors)
+            end = start + len(lane_vectors)
             if start < end:
                 polyline_spans.append([start, end])
 
@@ -236,86 +289,53 @@ def preprocess(args, id2info, mapping):
     keys.remove('AGENT')
     keys = ['AGENT', 'AV'] + keys # Agent, AV, others IDs
     vectors = []
+    vector_num = 0
     two_seconds = mapping['two_seconds']
     mapping['trajs'] = []
     mapping['agents'] = []
     for id in keys:
-        # Mask per agent with 50% probability if id != 'AV' and id != 'AGENT' 
-        if 'mask_agents' in args.other_params and id != 'AV' and id != 'AGENT' and random.random() < float(args.other_params['p']):
-            continue 
-
         info = id2info[id]
-        if 'mask_agents_frames' in args.other_params and id != 'AV' and id != 'AGENT':
-            info = [ i for i in info if random.random() > float(args.other_params['p']) ]
-
-        start = len(vectors)
+        start = vector_num
         if args.no_agents:
             if id != 'AV' and id != 'AGENT':
                 break
 
-        agent = [] # x, y 
-        for i, line in enumerate(info):
-            if larger(line[TIMESTAMP], two_seconds):   
-                break # outside of history, either future anns, or other agents don't appear in the history.
-            agent.append((line[X], line[Y]))
+        # Frames outside of history are either future anns, or other agents don't appear in the history.
+        history_num = get_history_num(info[:, TIMESTAMP], two_seconds)
+        agent = info[:history_num, [X, Y]]  # x, y
 
         if args.visualize:
-            traj = np.zeros([args.hidden_size])
-            for i, line in enumerate(info):
-                if larger(line[TIMESTAMP], two_seconds):
-                    traj = traj[:i * 2].copy()
-                    break
-                traj[i * 2], traj[i * 2 + 1] = line[X], line[Y]
-                if i == len(info) - 1:
-                    traj = traj[:(i + 1) * 2].copy()
-            traj = traj.reshape((-1, 2))
-            mapping['trajs'].append(traj)
-
-        for i, line in enumerate(info):
-            if larger(line[TIMESTAMP], two_seconds):
-                break # outside of history
-            x, y = line[X], line[Y]
-            if i > 0:
-                # print(x-line_pre[X], y-line_pre[Y])
-                vector = [line_pre[X], line_pre[Y], x, y, line[TIMESTAMP], line[OBJECT_TYPE] == 'AV',
-                          line[OBJECT_TYPE] == 'AGENT', line[OBJECT_TYPE] == 'OTHERS', len(polyline_spans), i]
-                vectors.append(get_pad_vector(vector))
-            line_pre = line
-
-        end = len(vectors)
+            mapping['trajs'].append(agent.copy())
+
+        if len(agent) > 0:
+            agent_vectors = get_agent_vectors(agent, info[:history_num, TIMESTAMP], info[0, OBJECT_TYPE], len(polyline_spans),
+                                              args.hidden_size)
+            vectors.append(agent_vectors)
+            vector_num += len(agent_vectors)
+
+        end = vector_num
         if end - start == 0:
             assert id != 'AV' and id != 'AGENT'
         else:
-            mapping['agents'].append(np.array(agent))
+            mapping['agents'].append(agent)
 
             polyline_spans.append([start, end])
 
     assert_(len(mapping['agents']) == len(polyline_spans))
 
-    assert len(vectors) <= max_vector_num
+    assert vector_num <= max_vector_num
 
-    t = len(vectors)
     mapping['map_start_polyline_idx'] = len(polyline_spans)
     if args.use_map:
         vectors, polyline_spans = get_sub_map(args, mapping['cent_x'], mapping['cent_y'], mapping['city_name'],
                                               vectors=vectors,
                                               polyline_spans=polyline_spans, mapping=mapping)
 
-    # logging('len(vectors)', t, len(vectors), prob=0.01)
-
-    matrix = np.array(vectors)
-    # matrix = np.array(vectors, dtype=float)
-    # del vectors
-
-    # matrix = torch.zeros([len(vectors), args.hidden_size])
-    # for i, vector in enumerate(vectors):
-    #     for j, each in enumerate(vector):
-    #         matrix[i][j].fill_(each)
+    matrix = np.concatenate(vectors) if len(vectors) > 0 else np.zeros([0, args.hidden_size], dtype=np.float32)
 
 
     ### Get Labels ###
 
-    labels = []
     info = id2info['AGENT']
     info = info[mapping['agent_pred_index']:]
     if not args.do_test:
@@ -323,9 +343,7 @@ def preprocess(args, id2info, mapping):
             pass
         else:
             assert len(info) == 30
-    for line in info:
-        labels.append(line[X])
-        labels.append(line[Y])
+    labels = info[:, [X, Y]].reshape([-1])
 
     if 'set_predict' in args.other_params:
         if 'test' in args.data_dir[0]:
@@ -336,16 +354,7 @@ def preprocess(args, id2info, mapping):
         mapping['goals_2D_labels'] = np.argmin(get_dis(mapping['goals_2D'], point_label)) # select the closest goal
         
         if 'lane_scoring' in args.other_params:
-            stage_one_label = 0
-            polygons = mapping['polygons']
-            min_dis = 10000.0
-            for i, polygon in enumerate(polygons):
-                temp = np.min(get_dis(polygon, point_label))
-                if temp < min_dis:
-                    min_dis = temp
-                    stage_one_label = i
-
-            mapping['stage_one_label'] = stage_one_label # select the polygon with the closest point
+            mapping['stage_one_label'] = get_stage_one_label(mapping['polygons'], point_label)
 
     mapping.update(dict(
         matrix=matrix,
@@ -358,181 +367,381 @@ def preprocess(args, id2info, mapping):
     return mapping
 
 
+# Robustness analysis: mask lanes, agents or frames of agents with probability other_params['p'], see get_masked_mapping.
+MASK_PARAMS = ['mask_lanes', 'mask_agents', 'mask_agents_frames']
+
+
+def get_masked_mapping(args: utils.Args, mapping, rng: np.random.Generator):
+    """
+    Apply MASK_PARAMS to an unmasked preprocessed scenario.
+
+    matrix, polyline_spans and the lane based goals are rebuilt from the kept polylines,
+    so a single preprocessing run serves every mask type and every p. AGENT and AV are never masked.
+    """
+    p = float(args.other_params['p'])
+    matrix = mapping['matrix']
+    polyline_spans = mapping['polyline_spans']
+    map_start_polyline_idx = mapping['map_start_polyline_idx']
+    mapping = mapping.copy()
+
+    agent_keep = np.ones(map_start_polyline_idx, dtype=bool)
+    if 'mask_agents' in args.other_params:
+        agent_keep[2:] = rng.random(map_start_polyline_idx - 2) >= p
+    if 'trajs' in mapping:
+        # Histories too short for a vector have no agent polyline, so they are never masked.
+        trajs = list(mapping['trajs'])
+        traj_idxs = np.flatnonzero([len(traj) > 1 for traj in trajs])
+        assert len(traj_idxs) == map_start_polyline_idx
+    vectors = []
+    agents = []
+    for i in np.flatnonzero(agent_keep):
+        agent = mapping['agents'][i]
+        agent_vectors = matrix[polyline_spans[i]]
+        if 'mask_agents_frames' in args.other_params and i >= 2:
+            frame_keep = rng.random(len(agent)) > p
+            # The timestamp of the first point is not part of the vectors, and it is not needed either.
+            timestamps = np.concatenate([[0], agent_vectors[:, 4]])
+            agent = agent[frame_keep]
+            if 'trajs' in mapping:
+                trajs[traj_idxs[i]] = agent
+            agent_vectors = get_agent_vectors(agent, timestamps[frame_keep], type2index['OTHERS'], len(agents),
+                                              args.hidden_size)
+        else:
+            agent_vectors = agent_vectors.copy()
+            agent_vectors[:, 8] = len(agents)
+        if len(agent_vectors) > 0:
+            vectors.append(agent_vectors)
+            agents.append(agent)
+
+    # Lanes follow the agents up to the end of matrix, one polyline per polygon.
+    lane_spans = polyline_spans[map_start_polyline_idx:]
+    lane_keep = np.ones(len(lane_spans), dtype=bool)
+    if 'mask_lanes' in args.other_params:
+        lane_keep = rng.random(len(lane_spans)) > p
+    lane_lengths = np.array([each.stop - each.start for each in lane_spans], dtype=np.int64)
+    if len(lane_spans) > 0:
+        lane_vectors = matrix[lane_spans[0].start:][np.repeat(lane_keep, lane_lengths)]
+        lane_vectors[:, -7] = np.repeat(len(agents) + np.arange(np.sum(lane_keep)), lane_lengths[lane_keep])
+        vectors.append(lane_vectors)
+
+    ends = np.cumsum([len(each) for each in vectors[:len(agents)]] + lane_lengths[lane_keep].tolist(), dtype=np.int64)
+    mapping.update(dict(
+        matrix=np.concatenate(vectors) if len(vectors) > 0 else np.zeros([0, args.hidden_size], dtype=np.float32),
+        polyline_spans=[slice(int(end - length), int(end)) for end, length in zip(ends, np.diff(ends, prepend=0))],
+        map_start_polyline_idx=len(agents),
+        agents=agents,
+    ))
+    if 'trajs' in mapping:
+        traj_keep = np.ones(len(trajs), dtype=bool)
+        traj_keep[traj_idxs[~agent_keep]] = False
+        mapping['trajs'] = [traj for traj, keep in zip(trajs, traj_keep) if keep]
+    if 'mask_lanes' in args.other_params:
+        if 'vis_lanes' in mapping:
+            # Two borders per lane.
+            mapping['vis_lanes'] = [each for each, keep in zip(mapping['vis_lanes'], np.repeat(lane_keep, 2)) if keep]
+        if 'goals_2D' in args.other_params:
+            polygons = [polygon for polygon, keep in zip(mapping['polygons'], lane_keep) if keep]
+            mapping['polygons'] = polygons
+            mapping['goals_2D'] = get_goals_2D(args, polygons)
+            point_label = np.array(mapping['labels'][-1])
+            mapping['goals_2D_labels'] = np.argmin(get_dis(mapping['goals_2D'], point_label))
+            if 'lane_scoring' in args.other_params:
+                mapping['stage_one_label'] = get_stage_one_label(polygons, point_label)
+    return mapping
+
+
+def get_columns(lines):
+    """
+    Split the lines of a csv file into a 2D array of strings in one pass.
+    """
+    fields = ','.join(lines).replace('\r', '').replace('\n', '').split(',')
+    return np.array(fields).reshape([len(lines), -1])
+
+
 def argoverse_get_instance(lines, file_name, args):
     """
     Extract polylines from one example file content.
+
+    Each value of id2info is a float array with one row per frame of the track,
+    and TIMESTAMP, TRACK_ID, OBJECT_TYPE (see type2index), X, Y as columns.
     """
 
     global max_vector_num
-    vector_num = 0
-    id2info = {}
     mapping = {}
     mapping['file_name'] = file_name
 
-    for i, line in enumerate(lines):
+    table = get_columns(lines)
+    mapping['start_time'] = float(table[0, TIMESTAMP])
+    mapping['city_name'] = table[0, CITY_NAME]
 
-        line = line.strip().split(',')
-        if i == 0:
-            mapping['start_time'] = float(line[TIMESTAMP])
-            mapping['city_name'] = line[CITY_NAME]
+    object_types = table[:, OBJECT_TYPE]
+    track_ids = np.where((object_types == 'AV') | (object_types == 'AGENT'), object_types, table[:, TRACK_ID])
+    ids, first_index, track_index = np.unique(track_ids, return_index=True, return_inverse=True)
+    track_index = track_index.reshape([-1])
 
-        line[TIMESTAMP] = float(line[TIMESTAMP]) - mapping['start_time']
-        line[X] = float(line[X])
-        line[Y] = float(line[Y])
-        id = line[TRACK_ID]
+    columns = np.zeros([len(table), 5])
+    columns[:, TIMESTAMP] = table[:, TIMESTAMP].astype(float) - mapping['start_time']
+    columns[:, TRACK_ID] = track_index
+    columns[:, OBJECT_TYPE] = np.select([object_types == each for each in type2index], list(type2index.values()), -1)
+    columns[:, X] = table[:, X].astype(float)
+    columns[:, Y] = table[:, Y].astype(float)
 
-        if line[OBJECT_TYPE] == 'AV' or line[OBJECT_TYPE] == 'AGENT':
-            line[TRACK_ID] = line[OBJECT_TYPE]
+    # Rows of each track in file order, tracks in order of first appearance.
+    rows = np.split(np.argsort(track_index, kind='stable'), np.cumsum(np.bincount(track_index))[:-1])
+    id2rows = {str(ids[k]): rows[k] for k in np.argsort(first_index)}
 
-        if line[TRACK_ID] in id2info:
-            id2info[line[TRACK_ID]].append(line)
-            vector_num += 1
-        else:
-            id2info[line[TRACK_ID]] = [line]
-
-        if line[OBJECT_TYPE] == 'AGENT' and len(id2info['AGENT']) == 20:
-            assert 'AV' in id2info
-            assert 'cent_x' not in mapping
-            agent_lines = id2info['AGENT']
-            mapping['cent_x'] = agent_lines[-1][X]
-            mapping['cent_y'] = agent_lines[-1][Y]
-            mapping['agent_pred_index'] = len(agent_lines) # what for? it'll always be 20 (if len(agent_lines) == 20)
-            mapping['two_seconds'] = line[TIMESTAMP]
-
-            # Smooth the direction of agent. Only taking the direction of the last frame is not accurate due to label error.
-            if 'direction' in args.other_params:
-                span = agent_lines[-args.mode_num:]
-                intervals = [2]
-                angles = []
-                for interval in intervals:
-                    for j in range(len(span)):
-                        if j + interval < len(span):
-                            der_x, der_y = span[j + interval][X] - span[j][X], span[j + interval][Y] - span[j][Y]
-                            angles.append([der_x, der_y])
-
-            der_x, der_y = agent_lines[-1][X] - agent_lines[-2][X], agent_lines[-1][Y] - agent_lines[-2][Y]
+    vector_num = len(table) - len(ids)  # vector_num is the number of vectors in the sequence 
     if not args.do_test:
         if 'set_predict' in args.other_params:
             pass
         else:
-            assert len(id2info['AGENT']) == 50
+            assert len(id2rows['AGENT']) == 50
 
     if vector_num > max_vector_num:
-        max_vector_num = vector_num  # vector_num is the number of vectors in the sequence 
-        
-    if 'cent_x' not in mapping: # if there is no cent_x, then ¿it's a test file? or we don't have good annotations 
+        max_vector_num = vector_num
+
+    if len(id2rows.get('AGENT', [])) < 20: # if there is no history of 2 seconds, then ¿it's a test file? or we don't have good annotations 
         return None
 
+    assert 'AV' in id2rows
+    agent_lines = columns[id2rows['AGENT'][:20]]
+    mapping['cent_x'] = agent_lines[-1, X]
+    mapping['cent_y'] = agent_lines[-1, Y]
+    mapping['agent_pred_index'] = len(agent_lines) # what for? it'll always be 20 (if len(agent_lines) == 20)
+    mapping['two_seconds'] = agent_lines[-1, TIMESTAMP]
+
     if args.do_eval:
         origin_labels = np.zeros([30, 2])
-        for i, line in enumerate(id2info['AGENT'][20:]):
-            origin_labels[i][0], origin_labels[i][1] = line[X], line[Y]
+        future = columns[id2rows['AGENT'][20:]]
+        origin_labels[:len(future)] = future[:, [X, Y]]
         mapping['origin_labels'] = origin_labels
 
+    der_x, der_y = agent_lines[-1, X] - agent_lines[-2, X], agent_lines[-1, Y] - agent_lines[-2, Y]
     angle = -get_angle(der_x, der_y) + math.radians(90)
 
     # Smooth the direction of agent. Only taking the direction of the last frame is not accurate due to label error.
     if 'direction' in args.other_params:
-        angles = np.array(angles)
+        span = agent_lines[-args.mode_num:]
+        interval = 2
+        angles = span[interval:][:, [X, Y]] - span[:-interval][:, [X, Y]]
         der_x, der_y = np.mean(angles, axis=0)
         angle = -get_angle(der_x, der_y) + math.radians(90)
 
     mapping['angle'] = angle
-    for id in id2info:
-        info = id2info[id]
-        for line in info:
-            line[X], line[Y] = rotate(line[X] - mapping['cent_x'], line[Y] - mapping['cent_y'], angle)
-        if 'scale' in mapping:
-            scale = mapping['scale']
-            line[X] *= scale
-            line[Y] *= scale
+    columns[:, [X, Y]] = Frame.from_mapping(mapping).to_frame(columns[:, [X, Y]])
+    id2info = {id: columns[rows] for id, rows in id2rows.items()}
     return preprocess(args, id2info, mapping)
 
 
+# Arguments and other_params which change the output of argoverse_get_instance, see get_preprocess_key.
+# mode_num is the span of the 'direction' smoothing, set_predict changes the labels. The data_dir that set_predict
+# also reads is part of the file names of the cache manifest. mask_* params are applied on load, see get_masked_mapping.
+PREPROCESS_ARGS = ['hidden_size', 'max_distance', 'future_frame_num', 'do_eval', 'do_test', 'visualize',
+                   'not_use_api', 'use_map', 'no_agents', 'mode_num']
+PREPROCESS_PARAMS = ['semantic_lane', 'direction', 'goals_2D', 'subdivide', 'lane_scoring', 'enhance_rep_4',
+                     'set_predict']
+
+
+def get_preprocess_key(args: utils.Args):
+    """
+    Short hash of the preprocessing config, so that caches built with different features do not mix.
+    """
+    config = {name: getattr(args, name) for name in PREPROCESS_ARGS}
+    config['cache_version'] = CACHE_VERSION
+    config.update({name: args.other_params[name] for name in PREPROCESS_PARAMS if name in args.other_params})
+    return hashlib.sha1(json.dumps(config, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def get_file_hash(file):
+    with open(file, 'rb') as fin:
+        return hashlib.sha1(fin.read()).hexdigest()
+
+
+def get_data_files(data_dir):
+    files = []
+    for each_dir in data_dir:
+        root, dirs, cur_files = os.walk(each_dir).__next__()
+        files.extend([os.path.join(each_dir, file) for file in cur_files if
+                      file.endswith("csv") and not file.startswith('.')])
+    # Sorted, so that the order of scenarios does not depend on the file system or on scheduling.
+    return sorted(files)
+
+
+def load_map():
+    global am, lane_index
+    if am is None:
+        am = ArgoverseMap()
+        lane_index = LaneIndex(am)
+
+
+class LazyScenarioList:
+    """
+    Preprocess scenarios on demand with argoverse_get_instance, e.g. inside DataLoader workers.
+
+    Results are kept in lru (a DiskLRU) if given. Files without a valid scenario give None,
+    which utils.batch_list_to_batch_tensors drops from the batch.
+    """
+
+    def __init__(self, args, files, lru=None):
+        self.args = args
+        self.files = files
+        self.lru = lru
+
+    def __len__(self):
+        return len(self.files)
+
+    def __getitem__(self, idx):
+        file = self.files[idx]
+        if self.lru is not None:
+            stat = os.stat(file)
+            key = '{}:{}:{}'.format(file, stat.st_size, stat.st_mtime_ns)
+            found, instance = self.lru.get(key)
+            if found:
+                return instance
+        load_map()
+        with open(file, "r", encoding='utf-8') as fin:
+            lines = fin.readlines()[1:]
+        instance = argoverse_get_instance(lines, file, self.args)
+        if self.lru is not None:
+            self.lru.put(key, instance)
+        return instance
+
+
 class Dataset(torch.utils.data.Dataset):
     def __init__(self, args, batch_size, to_screen=True):
         data_dir = args.data_dir
-        self.ex_list = []
         self.args = args
-
-        if args.reuse_temp_file:
-            pickle_file = open(os.path.join(args.temp_file_dir, get_name('ex_list')), 'rb')
-            self.ex_list = pickle.load(pickle_file)
-            # self.ex_list = self.ex_list[len(self.ex_list) // 2:]
-            pickle_file.close()
+        cache_dir = os.path.join(args.temp_file_dir, get_name('scenario_cache') + '.' + get_preprocess_key(args))
+
+        files = get_data_files(data_dir)
+        if args.debug:
+            files = files[:200]
+
+        if 'lazy_preprocess' in args.other_params:
+            # Scenarios are preprocessed on demand, see LazyScenarioList.
+            load_map()
+        elif args.reuse_temp_file:
+            manifest = load_manifest(cache_dir)
+            files = [file for file in files if file in manifest]
         else:
-            global am
-            am = ArgoverseMap()
+            load_map()
             if args.core_num >= 1:
-                # TODO
-                files = []
-                for each_dir in data_dir:
-                    root, dirs, cur_files = os.walk(each_dir).__next__()
-                    files.extend([os.path.join(each_dir, file) for file in cur_files if
-                                  file.endswith("csv") and not file.startswith('.')]) 
-                if args.debug:
-                    files = files[:200]
-
-                pbar = tqdm(total=len(files))
-
-                queue = multiprocessing.Queue(args.core_num)
-                queue_res = multiprocessing.Queue()
+                os.makedirs(cache_dir, exist_ok=True)
+                # Shards of an interrupted run which never finished.
+                for name in os.listdir(cache_dir):
+                    if name.endswith('.tmp'):
+                        shutil.rmtree(os.path.join(cache_dir, name))
+
+                # Only new files and files whose content changed are preprocessed again.
+                manifest = load_manifest(cache_dir)
+                todo = []
+                # Files which were touched or copied, but whose content did not change.
+                refreshed = {}
+                for file in files:
+                    stat = os.stat(file)
+                    entry = manifest.get(file)
+                    if entry is not None and entry[2:4] == [stat.st_size, stat.st_mtime_ns]:
+                        continue
+                    file_hash = get_file_hash(file)
+                    if entry is not None and entry[1] == file_hash:
+                        refreshed[file] = [file_hash, stat.st_size, stat.st_mtime_ns, entry[4], entry[0]]
+                        continue
+                    todo.append([file, file_hash, stat.st_size, stat.st_mtime_ns])
+
+                shard_size = int(args.other_params.get('shard_size', 200))
+                shards = [todo[i:i + shard_size] for i in range(0, len(todo), shard_size)]
+                first_shard_idx = max([int(name[len('shard_'):]) + 1 for name in os.listdir(cache_dir)
+                                       if name.startswith('shard_')], default=0)
+                if len(refreshed) > 0:
+                    # A shard with the new sizes and mtimes only, so that these files are not hashed in every run.
+                    shard_dir = get_shard_dir(cache_dir, first_shard_idx)
+                    os.makedirs(shard_dir + '.tmp')
+                    with open(os.path.join(shard_dir + '.tmp', SHARD_FILES), 'w') as fout:
+                        json.dump(refreshed, fout)
+                    os.rename(shard_dir + '.tmp', shard_dir)
+                    first_shard_idx += 1
+                if to_screen:
+                    print('preprocess', len(todo), 'of', len(files), 'files')
+
+                # Both queues are bounded and all waits block; workers only send back small progress messages.
+                queue = multiprocessing.Queue(args.core_num * 2)
+                queue_res = multiprocessing.Queue(args.core_num * 4)
 
                 def calc_ex_list(queue, queue_res, args):
-                    res = []
-                    dis_list = []
                     while True:
-                        file = queue.get()
-                        if file is None:
+                        shard_idx = queue.get()
+                        if shard_idx is None:
                             break
-                        if file.endswith("csv"):
+                        shard_dir = get_shard_dir(cache_dir, first_shard_idx + shard_idx)
+                        writer = ScenarioCacheWriter(shard_dir + '.tmp')
+                        shard_files = {}
+                        for file, file_hash, size, mtime_ns in shards[shard_idx]:
                             with open(file, "r", encoding='utf-8') as fin:
                                 lines = fin.readlines()[1:]
                             instance = argoverse_get_instance(lines, file, args)
+                            row = -1
                             if instance is not None:
-                                data_compress = zlib.compress(pickle.dumps(instance))
-                                res.append(data_compress)
-                                queue_res.put(data_compress)
-                            else:
-                                queue_res.put(None)
+                                row = writer.size
+                                writer.append(instance)
+                            shard_files[file] = [file_hash, size, mtime_ns, row]
+                            queue_res.put((shard_idx, False))
+                        writer.close()
+                        with open(os.path.join(shard_dir + '.tmp', SHARD_FILES), 'w') as fout:
+                            json.dump(shard_files, fout)
+                        # A shard only becomes visible to load_manifest once it is complete.
+                        os.rename(shard_dir + '.tmp', shard_dir)
+                        queue_res.put((shard_idx, True))
 
                 processes = [Process(target=calc_ex_list, args=(queue, queue_res, args,)) for _ in range(args.core_num)]
                 for each in processes:
                     each.start()
-                # res = pool.map_async(calc_ex_list, [queue for i in range(args.core_num)])
-                for file in files:
-                    assert file is not None
-                    queue.put(file)
-                    pbar.update(1)
-
-                # necessary because queue is out-of-order
-                while not queue.empty():
-                    pass
 
+                pbar = tqdm(total=len(todo))
+                # One shard is handed out per finished shard, so putting never blocks while workers wait on queue_res.
+                next_shard = min(args.core_num * 2, len(shards))
+                for shard_idx in range(next_shard):
+                    queue.put(shard_idx)
+                finished = 0
+                while finished < len(shards):
+                    try:
+                        shard_idx, done = queue_res.get(timeout=10)
+                    except Empty:
+                        # Fail instead of waiting forever if a worker died; its finished shards are kept for a rerun.
+                        assert all(each.is_alive() for each in processes)
+                        continue
+                    if done:
+                        finished += 1
+                        if next_shard < len(shards):
+                            queue.put(next_shard)
+                            next_shard += 1
+                    else:
+                        pbar.update(1)
                 pbar.close()
 
-                self.ex_list = []
-
-                pbar = tqdm(total=len(files))
-                for i in range(len(files)):
-                    t = queue_res.get()
-                    if t is not None:
-                        self.ex_list.append(t)
-                    pbar.update(1)
-                pbar.close()
-                pass
-
                 for i in range(args.core_num):
                     queue.put(None)
                 for each in processes:
                     each.join()
 
+                manifest = load_manifest(cache_dir)
+                # Shards whose files were all preprocessed again later.
+                used_shards = set(entry[0] for entry in manifest.values()) | set(entry[5] for entry in manifest.values())
+                for name in os.listdir(cache_dir):
+                    if name.startswith('shard_') and name not in used_shards:
+                        shutil.rmtree(os.path.join(cache_dir, name))
+
             else:
                 assert False
 
-            pickle_file = open(os.path.join(args.temp_file_dir, get_name('ex_list')), 'wb')
-            pickle.dump(self.ex_list, pickle_file)
-            pickle_file.close()
+        if 'lazy_preprocess' in args.other_params:
+            lru = None
+            if 'lazy_cache' in args.other_params:
+                lru = DiskLRU(os.path.join(args.temp_file_dir, get_name('lazy_cache') + '.' + get_preprocess_key(args)),
+                              int(args.other_params['lazy_cache']))
+            self.ex_list = LazyScenarioList(args, files, lru)
+        else:
+            items = [(manifest[file][0], manifest[file][4]) for file in files if manifest[file][4] >= 0]
+            self.ex_list = ShardedScenarioCache(cache_dir, items)
         assert len(self.ex_list) > 0
         if to_screen:
             print("valid data size is", len(self.ex_list))
@@ -543,20 +752,22 @@ class Dataset(torch.utils.data.Dataset):
         return len(self.ex_list)
 
     def __getitem__(self, idx):
-        # file = self.ex_list[idx]
-        # pickle_file = open(file, 'rb')
-        # instance = pickle.load(pickle_file)
-        # pickle_file.close()
-
-        data_compress = self.ex_list[idx]
-        instance = pickle.loads(zlib.decompress(data_compress))
-        return instance
+        # Arrays of the returned mapping are read-only views into the memory-mapped cache.
+        mapping = self.ex_list[idx]
+        if mapping is not None and utils.satisfy_one_of(MASK_PARAMS, self.args.other_params):
+            # Seeded by the item, so an item gets the same masks in every epoch and in every worker.
+            rng = np.random.default_rng([int(self.args.other_params.get('mask_seed', 0)), idx])
+            mapping = get_masked_mapping(self.args, mapping, rng)
+        return mapping
 
 
 def post_eval(args, file2pred, file2pred_int, file2score, file2score_int, file2labels, DEs, city_names, agent_dir_var_list, 
-                agent_dir_int_var_list, opposite_dir_batch, max_guesses=None):
-    from argoverse.evaluation.eval_forecasting import get_drivable_area_compliance
-
+                agent_dir_int_var_list, opposite_dir_batch, max_guesses=None, metrics=None, metrics_int=None):
+    """
+    :param DEs: eval_metrics.DisplacementErrors of the eval
+    :param metrics: eval_metrics.MetricsAccumulator fed during the eval, the metrics are computed from file2pred if None
+    :param metrics_int: the same for the clustered predictions
+    """
     score_file = args.model_recover_path.split('/')[-1]
     score_file_int = args.model_recover_path.split('/')[-1]+'_intention'
     for each in args.eval_params:
@@ -592,12 +803,22 @@ def post_eval(args, file2pred, file2pred_int, file2score, file2score_int, file2l
         
     utils.logging('Max guesses: {}'.format(max_guesses), type=score_file, to_screen=True, append_time=True)
     
-    metric_results = get_displacement_errors_and_miss_rate(file2pred, file2labels, max_guesses, 30, 2.0, file2score)
-    metric_results["DAC"] = get_drivable_area_compliance(file2pred, city_names, max_guesses)
+    if metrics is not None:
+        metric_results = metrics.get_results()
+    else:
+        metric_results = get_displacement_errors_and_miss_rate(file2pred, file2labels, max_guesses, 30, 2.0, file2score)
+    drivable_area = create_drivable_area(args)
+    if 'DAC' not in metric_results:
+        metric_results["DAC"] = get_drivable_area_compliance(drivable_area, file2pred, city_names, max_guesses)
     metric_results["p-rF"] = metric_results["p_avgFDE"] / metric_results["p-minFDE"]  
     if args.clustering:
-        metric_results_int = get_displacement_errors_and_miss_rate(file2pred_int, file2labels, max_guesses, 30, 2.0, file2score_int)
-        metric_results_int["DAC"] = get_drivable_area_compliance(file2pred_int, city_names, max_guesses)
+        if metrics_int is not None:
+            metric_results_int = metrics_int.get_results()
+        else:
+            metric_results_int = get_displacement_errors_and_miss_rate(file2pred_int, file2labels, max_guesses, 30, 2.0,
+                                                                       file2score_int)
+        if 'DAC' not in metric_results_int:
+            metric_results_int["DAC"] = get_drivable_area_compliance(drivable_area, file2pred_int, city_names, max_guesses)
         metric_results_int["p-rF"] = metric_results_int["p_avgFDE"] / metric_results_int["p-minFDE"]  
         metric_results_int["yaw_var"] =  sum(agent_dir_int_var_list) / len(agent_dir_int_var_list)
         metric_results["yaw_var"] = sum(agent_dir_var_list) / len(agent_dir_var_list)
@@ -607,18 +828,9 @@ def post_eval(args, file2pred, file2pred_int, file2score, file2score_int, file2l
     utils.logging('Trajectory prediction evaluation: ', type=score_file, to_screen=True, append_time=True)
     utils.logging(metric_results, type=score_file, to_screen=True, append_time=True)
 
-    DE = np.concatenate(DEs, axis=0)
-    length = DE.shape[1]
-    DE_score = [0, 0, 0, 0]
-    for i in range(DE.shape[0]):
-        DE_score[0] += DE[i].mean()
-        for j in range(1, 4):
-            index = round(float(length) * j / 3) - 1
-            assert index >= 0
-            DE_score[j] += DE[i][index]
+    DE_score = DEs.get_scores()
     for j in range(4):
-        score = DE_score[j] / DE.shape[0]
-        utils.logging('ADE' if j == 0 else 'DE@1' if j == 1 else 'DE@2' if j == 2 else 'DE@3', score,
+        utils.logging('ADE' if j == 0 else 'DE@1' if j == 1 else 'DE@2' if j == 2 else 'DE@3', DE_score[j],
                       type=score_file, to_screen=True, append_time=True)
 
     utils.logging(vars(args), is_json=True,
@@ -634,8 +846,6 @@ def get_displacement_errors_and_miss_rate(
     miss_threshold: float,
     forecasted_probabilities: Optional[Dict[int, List[float]]] = None,
 ) -> Dict[str, float]:
-    from argoverse.evaluation.eval_forecasting import get_ade, get_fde
-    LOW_PROB_THRESHOLD_FOR_METRICS = 0.05
     """Compute min fde and ade for each sample.
 
     Note: Both min_fde and min_ade values correspond to the trajectory which has minimum fde.
@@ -656,76 +866,10 @@ def get_displacement_errors_and_miss_rate(
     Returns:
         metric_results: Metric values for minADE, minFDE, MR, p-minADE, p-minFDE, p-MR, brier-minADE, brier-minFDE
     """
-    metric_results: Dict[str, float] = {}
-    min_ade, prob_min_ade, brier_min_ade = [], [], []
-    min_fde, avg_fde, p_avg_fde, prob_min_fde, brier_min_fde = [], [], [], [], []
-    n_misses, prob_n_misses = [], []
-    for k, v in gt_trajectories.items():
-        curr_min_ade = float("inf")
-        curr_min_fde = float("inf")
-        min_idx = 0
-        max_num_traj = min(max_guesses, len(forecasted_trajectories[k]))
-
-        # If probabilities available, use the most likely trajectories, else use the first few
-        if forecasted_probabilities is not None:
-            sorted_idx = np.argsort([-x for x in forecasted_probabilities[k]], kind="stable")
-            # sorted_idx = np.argsort(forecasted_probabilities[k])[::-1]
-            pruned_probabilities = [forecasted_probabilities[k][t] for t in sorted_idx[:max_num_traj]]
-            # Normalize
-            prob_sum = sum(pruned_probabilities)
-            pruned_probabilities = [p / prob_sum for p in pruned_probabilities]
-        else:
-            sorted_idx = np.arange(len(forecasted_trajectories[k]))
-        pruned_trajectories = [forecasted_trajectories[k][t] for t in sorted_idx[:max_num_traj]]
-
-        avgfde = 0
-        p_avgfde = 0
-        for j in range(len(pruned_trajectories)):
-            fde = get_fde(pruned_trajectories[j][:horizon], v[:horizon])
-            avgfde += fde 
-            p_avgfde += fde + min(
-                    -np.log(pruned_probabilities[j]),
-                    -np.log(LOW_PROB_THRESHOLD_FOR_METRICS),
-                ) 
-            if fde < curr_min_fde:
-                min_idx = j
-                curr_min_fde = fde
-        curr_min_ade = get_ade(pruned_trajectories[min_idx][:horizon], v[:horizon])
-        min_ade.append(curr_min_ade)
-        min_fde.append(curr_min_fde)
-        avg_fde.append(avgfde/len(pruned_trajectories))
-        p_avg_fde.append(p_avgfde/len(pruned_trajectories))
-        n_misses.append(curr_min_fde > miss_threshold)
-
-        if forecasted_probabilities is not None:
-            prob_n_misses.append(1.0 if curr_min_fde > miss_threshold else (1.0 - pruned_probabilities[min_idx]))
-            prob_min_ade.append(
-                min(
-                    -np.log(pruned_probabilities[min_idx]),
-                    -np.log(LOW_PROB_THRESHOLD_FOR_METRICS),
-                )
-                + curr_min_ade
-            )
-            brier_min_ade.append((1 - pruned_probabilities[min_idx]) ** 2 + curr_min_ade)
-            prob_min_fde.append(
-                min(
-                    -np.log(pruned_probabilities[min_idx]),
-                    -np.log(LOW_PROB_THRESHOLD_FOR_METRICS),
-                )
-                + curr_min_fde
-            ) 
-            brier_min_fde.append((1 - pruned_probabilities[min_idx]) ** 2 + curr_min_fde)
-            brier_min_fde.append((1 - pruned_probabilities[min_idx]) ** 2 + curr_min_fde)
-
-    metric_results["minADE"] = sum(min_ade) / len(min_ade)
-    metric_results["minFDE"] = sum(min_fde) / len(min_fde)
-    metric_results["avgFDE"] = sum(avg_fde) / len(avg_fde)
-    metric_results["p_avgFDE"] = sum(p_avg_fde) / len(p_avg_fde)
-    metric_results["MR"] = sum(n_misses) / len(n_misses)
-    if forecasted_probabilities is not None:
-        metric_results["p-minADE"] = sum(prob_min_ade) / len(prob_min_ade)
-        metric_results["p-minFDE"] = sum(prob_min_fde) / len(prob_min_fde)
-        metric_results["p-MR"] = sum(prob_n_misses) / len(prob_n_misses)
-        metric_results["brier-minADE"] = sum(brier_min_ade) / len(brier_min_ade)
-        metric_results["brier-minFDE"] = sum(brier_min_fde) / len(brier_min_fde)
-    return metric_results
+    metrics = eval_metrics.MetricsAccumulator(max_guesses, horizon, miss_threshold)
+    keys = list(gt_trajectories.keys())
+    for start in range(0, len(keys), METRICS_CHUNK_SIZE):
+        chunk = keys[start:start + METRICS_CHUNK_SIZE]
+        metrics.add([forecasted_trajectories[k] for k in chunk], [gt_trajectories[k] for k in chunk],
+                    [forecasted_probabilities[k] for k in chunk] if forecasted_probabilities is not None else None)
+    return metrics.get_results()
@@ -1,6 +1,7 @@
 import argparse
 import logging
-import os
+import queue
+import threading
 from functools import partial
 import scipy
 import numpy as np
@@ -8,7 +9,9 @@ import torch
 from torch.utils.data import RandomSampler, SequentialSampler
 from tqdm import tqdm
 import time
+import eval_metrics
 import structs
+from drivable_area import create_drivable_area
 import utils
 from utils import clustering, visualize_goals_2D
 from modeling.vectornet import VectorNet
@@ -20,13 +23,20 @@ logger = logging.getLogger(__name__)
 tqdm = partial(tqdm, dynamic_ncols=True)
 
 
-def eval_instance_argoverse(batch_size, args, pred, score, pred_int, score_int, mapping, file2pred, file2score, file2pred_int, file2score_int, city_name, file2labels, DEs, iter_bar,id_with_modes):
+def eval_instance_argoverse(batch_size, args, pred, score, pred_int, score_int, mapping, file2pred, file2score, file2pred_int, file2score_int, city_name, file2labels, DEs, iter_bar,id_with_modes,
+                            metrics=None, metrics_int=None):
+    """
+    :param DEs: eval_metrics.DisplacementErrors the predictions with labels are added to
+    :param metrics: eval_metrics.MetricsAccumulator the predictions with labels are added to
+    :param metrics_int: the same for the clustered predictions
+    """
+    file_names = [utils.get_file_name_int(mapping[i]['file_name']) for i in range(batch_size)]
     if args.clustering:
         for i,id in enumerate(id_with_modes):
             a_pred = pred[id]
             a_pred_int = pred_int[i] 
             assert a_pred.shape == (args.mode_num, args.future_frame_num, 2)
-            file_name = int(os.path.split(mapping[id]['file_name'])[1][:-4])
+            file_name = file_names[id]
             file2pred[file_name] = a_pred
             file2score[file_name] = score[id] 
             file2pred_int[file_name] = a_pred_int
@@ -38,7 +48,7 @@ def eval_instance_argoverse(batch_size, args, pred, score, pred_int, score_int,
         for i in range(batch_size):
             a_pred = pred[i]
             assert a_pred.shape == (args.mode_num, args.future_frame_num, 2)
-            file_name_int = int(os.path.split(mapping[i]['file_name'])[1][:-4])
+            file_name_int = file_names[i]
             file2pred[file_name_int] = a_pred
             file2score[file_name_int] = score[i] 
             city_name[file_name_int] = mapping[i]['city_name']
@@ -46,13 +56,19 @@ def eval_instance_argoverse(batch_size, args, pred, score, pred_int, score_int,
                 file2labels[file_name_int] = mapping[i]['origin_labels']
 
     if not args.do_test:
-        DE = np.zeros([batch_size, args.future_frame_num])
-        for i in range(batch_size):
-            origin_labels = mapping[i]['origin_labels']
-            for j in range(args.future_frame_num):
-                DE[i][j] = np.sqrt((origin_labels[j][0] - pred[i, 0, j, 0]) ** 2 + (
-                        origin_labels[j][1] - pred[i, 0, j, 1]) ** 2)
-        DEs.append(DE)
+        if args.clustering:
+            labels = [mapping[id]['origin_labels'] for id in id_with_modes]
+            city_names = [mapping[id]['city_name'] for id in id_with_modes]
+            if metrics is not None:
+                metrics.add([pred[id] for id in id_with_modes], labels, [score[id] for id in id_with_modes], city_names)
+            if metrics_int is not None:
+                metrics_int.add(pred_int, labels, score_int, city_names)
+        elif metrics is not None:
+            metrics.add(list(pred), [mapping[i]['origin_labels'] for i in range(batch_size)], score,
+                        [mapping[i]['city_name'] for i in range(batch_size)])
+
+        DEs.add(pred, np.stack([mapping[i]['origin_labels'] for i in range(batch_size)]))
+        # Miss rate of the goals found by the goal optimization.
         miss_rate = 0.0
         if 0 in utils.method2FDEs:
             FDEs = utils.method2FDEs[0]
@@ -61,6 +77,45 @@ def eval_instance_argoverse(batch_size, args, pred, score, pred_int, score_int,
         iter_bar.set_description('Iter (MR=%5.3f)' % (miss_rate))
 
 
+# Batches waiting between two pipeline stages, see PipelineStage.
+PIPELINE_QUEUE_SIZE = 2
+
+
+class PipelineStage(threading.Thread):
+    """
+    Thread running function on every item of queue_in and putting the results into queue_out, until it gets None.
+
+    If function raises, the error is kept in self.error and the rest of queue_in is drained,
+    so upstream stages never block on a full queue.
+    """
+
+    def __init__(self, function, queue_in: queue.Queue, queue_out: queue.Queue = None):
+        super().__init__(daemon=True)
+        self.function = function
+        self.queue_in = queue_in
+        self.queue_out = queue_out
+        self.error = None
+
+    def run(self):
+        try:
+            # Grad mode is per thread.
+            with torch.no_grad():
+                while True:
+                    item = self.queue_in.get()
+                    if item is None:
+                        break
+                    result = self.function(*item)
+                    if self.queue_out is not None:
+                        self.queue_out.put(result)
+        except BaseException as error:
+            self.error = error
+            while self.queue_in.get() is not None:
+                pass
+        finally:
+            if self.queue_out is not None:
+                self.queue_out.put(None)
+
+
 def do_eval(args):
     device = torch.device(
         "cuda" if torch.cuda.is_available() and not args.no_cuda else "cpu")
@@ -72,8 +127,9 @@ def do_eval(args):
     eval_sampler = SequentialSampler(eval_dataset)
     eval_dataloader = torch.utils.data.DataLoader(eval_dataset, batch_size=args.eval_batch_size,
                                                   sampler=eval_sampler,
-                                                  collate_fn=utils.batch_list_to_batch_tensors, 
-                                                  pin_memory=False)
+                                                  collate_fn=utils.batch_list_to_batch_tensors,
+                                                  num_workers=args.data_workers,
+                                                  pin_memory=device.type == 'cuda')
     model = VectorNet(args)
     print('torch.cuda.device_count', torch.cuda.device_count())
 
@@ -102,13 +158,27 @@ def do_eval(args):
     file2labels = {}
     opposite_dir_batch = 0 # [8, 16] how many modes going in opposite direction per sequence
     iter_bar = tqdm(eval_dataloader, desc='Iter (loss=X.XXX)')
-    DEs = []
+    DEs = eval_metrics.DisplacementErrors(len(eval_dataset), args.future_frame_num)
     length = len(iter_bar)
     argo_pred = structs.ArgoPred()
     max_guesses = args.mode_num
+    # Metrics of the eval are accumulated batch by batch instead of from file2pred at the end.
+    drivable_area = create_drivable_area(args)
+    metrics = eval_metrics.MetricsAccumulator(max_guesses, args.future_frame_num, 2.0, drivable_area=drivable_area)
+    metrics_int = eval_metrics.MetricsAccumulator(max_guesses, args.future_frame_num, 2.0, drivable_area=drivable_area)
 
-    for step, batch in enumerate(iter_bar): 
-        pred_trajectory, pred_score, _ = model(batch, device)  
+    def complete_batch(batch, outputs):
+        """
+        Stage 2: wait for the goal optimization of the batch and complete its trajectories.
+        """
+        pred_trajectory, pred_score, _ = outputs() if callable(outputs) else outputs
+        return batch, pred_trajectory, pred_score
+
+    def post_process_batch(batch, pred_trajectory, pred_score):
+        """
+        Stage 3: intention clustering and metric accumulation.
+        """
+        nonlocal opposite_dir_batch
         pred_intention = []
         pred_intention_score =  []
         id_with_modes = []
@@ -124,7 +194,7 @@ def do_eval(args):
                 if mapping[i]['file_name'].split('/')[-1] in ['1825.csv','20880.csv','13067.csv','7214.csv','34487.csv', '38044.csv']:
                     continue
                 pred_intention_ids, cluster_probs, agent_dir_var,agent_dir_int_var, opposite_dir, vis_clusters = clustering(mapping[i], mapping[i]['vis.goals_2D'], 
-                                mapping[i]['vis.scores'], args.future_frame_num, mapping[i]['vis.predict_trajs'], max_guesses) 
+                                mapping[i]['vis.scores'], args.future_frame_num, mapping[i]['vis.predict_trajs'], max_guesses)
 
                 if args.visualize:  
                     mapping[i]['element_in_batch'] = i
@@ -149,11 +219,35 @@ def do_eval(args):
         
         pred_score = [scipy.special.softmax(pred_score[i]) for i in range(batch_size)]
         eval_instance_argoverse(batch_size, args, pred_trajectory, pred_score, pred_intention,pred_intention_score, mapping, file2pred, file2score, file2pred_int, 
-                                            file2score_int, city_name, file2labels, DEs, iter_bar,id_with_modes)
+                                            file2score_int, city_name, file2labels, DEs, iter_bar,id_with_modes,
+                                            metrics=metrics, metrics_int=metrics_int)
+
+    # Stage 1 (this thread) encodes a batch, scores its goals and starts its goal optimization in the worker pool,
+    # while the stages below finish the previous batches.
+    queue_complete = queue.Queue(PIPELINE_QUEUE_SIZE)
+    queue_post = queue.Queue(PIPELINE_QUEUE_SIZE)
+    stages = [PipelineStage(complete_batch, queue_complete, queue_post),
+              PipelineStage(post_process_batch, queue_post)]
+    for stage in stages:
+        stage.start()
+    try:
+        with torch.no_grad():
+            for step, batch in enumerate(iter_bar):
+                if any(stage.error is not None for stage in stages):
+                    break
+                queue_complete.put((batch, model(batch, device, pipeline=True)))
+    finally:
+        queue_complete.put(None)
+        for stage in stages:
+            stage.join()
+    for stage in stages:
+        if stage.error is not None:
+            raise stage.error
 
     if args.argoverse:
         from dataset_argoverse import post_eval
-        post_eval(args, file2pred, file2pred_int,file2score, file2score_int, file2labels, DEs, city_name, agent_dir_var_list, agent_dir_int_var_list,opposite_dir_batch, max_guesses)
+        post_eval(args, file2pred, file2pred_int,file2score, file2score_int, file2labels, DEs, city_name, agent_dir_var_list, agent_dir_int_var_list,opposite_dir_batch, max_guesses,
+                  metrics=metrics if not args.do_test else None, metrics_int=metrics_int if not args.do_test else None)
 
 
 def main():
@@ -0,0 +1,97 @@
+import os
+from typing import Dict, List
+
+import numpy as np
+
+import eval_metrics
+import utils
+
+# Scenarios whose compliance is computed at once by get_drivable_area_compliance.
+CHUNK_SIZE = 4096
+
+
+class DrivableArea:
+    """
+    Drivable area rasters of the cities, for the drivable area compliance (DAC) of predictions.
+
+    The raster of a city is taken from the map once and saved under cache_dir, later it is memory-mapped from there,
+    so the processes of an eval share the page cache and the map is only needed to build the cache.
+    """
+
+    def __init__(self, cache_dir, map_api=None):
+        self.cache_dir = cache_dir
+        self.map_api = map_api
+        self.rasters = {}
+
+    def _get_raster(self, city_name):
+        if city_name not in self.rasters:
+            raster_path = os.path.join(self.cache_dir, city_name + '.npy')
+            se2_path = os.path.join(self.cache_dir, city_name + '.se2.npy')
+            if not os.path.exists(raster_path):
+                assert self.map_api is not None, 'no drivable area cache of ' + city_name
+                raster, city_to_img_se2 = self.map_api.get_rasterized_driveable_area(city_name)
+                os.makedirs(self.cache_dir, exist_ok=True)
+                for path, array in [(se2_path, city_to_img_se2), (raster_path, raster)]:
+                    temp_path = '{}.{}.tmp.npy'.format(path[:-len('.npy')], os.getpid())
+                    np.save(temp_path, np.asarray(array))
+                    os.replace(temp_path, path)
+            self.rasters[city_name] = (np.load(raster_path, mmap_mode='r'), np.load(se2_path))
+        return self.rasters[city_name]
+
+    def is_drivable(self, points: np.ndarray, city_name):
+        """
+        The same as ArgoverseMap.get_raster_layer_points_boolean(points, city_name, 'driveable_area'),
+        points outside of the raster are not drivable.
+
+        :param points: shape [..., 2], in the world coordinate system
+        :return: shape [...]
+        """
+        raster, city_to_img_se2 = self._get_raster(city_name)
+        city_coords = np.round(points.reshape([-1, 2])).astype(np.int64)
+        img_coords = np.round(city_coords @ city_to_img_se2[:2, :2].T + city_to_img_se2[:2, 2]).astype(np.int64)
+        img_h, img_w = raster.shape
+        valid = (img_coords[:, 0] >= 0) & (img_coords[:, 0] < img_w) & (img_coords[:, 1] >= 0) & (img_coords[:, 1] < img_h)
+        values = np.zeros([len(img_coords)], dtype=raster.dtype)
+        values[valid] = raster[img_coords[valid, 1], img_coords[valid, 0]]
+        return (values == 1.0).reshape(points.shape[:-1])
+
+    def get_compliance(self, trajectories: np.ndarray, city_names: List[str], max_guesses, valid: np.ndarray = None):
+        """
+        DAC of every scenario, the fraction of its first max_guesses modes with all points in the drivable area,
+        as argoverse.evaluation.eval_forecasting.get_drivable_area_compliance.
+
+        :param trajectories: shape [N, K, T, 2], in the world coordinate system
+        :param valid: shape [N, K], all modes are predictions if None
+        :return: shape [N]
+        """
+        scenario_num, mode_num = trajectories.shape[:2]
+        if valid is None:
+            valid = np.ones([scenario_num, mode_num], dtype=bool)
+        guess_nums = np.minimum(np.sum(valid, axis=1), max_guesses)
+        pruned = np.arange(mode_num)[np.newaxis, :] < guess_nums[:, np.newaxis]
+
+        compliant = np.zeros([scenario_num, mode_num], dtype=bool)
+        city_names = np.array(city_names)
+        for city_name in np.unique(city_names).tolist():
+            idxs = np.nonzero(city_names == city_name)[0]
+            compliant[idxs] = np.all(self.is_drivable(trajectories[idxs], city_name), axis=-1)
+        return np.sum(compliant & pruned, axis=1) / guess_nums
+
+
+def create_drivable_area(args) -> DrivableArea:
+    return DrivableArea(os.path.join(args.temp_file_dir, 'drivable_area'), utils.am)
+
+
+def get_drivable_area_compliance(drivable_area: DrivableArea, forecasted_trajectories: Dict[int, np.ndarray],
+                                 city_names: Dict[int, str], max_guesses):
+    """
+    Mean DAC over the scenarios of forecasted_trajectories, see DrivableArea.get_compliance.
+    """
+    keys = list(forecasted_trajectories.keys())
+    compliance = []
+    for start in range(0, len(keys), CHUNK_SIZE):
+        chunk = keys[start:start + CHUNK_SIZE]
+        trajectories, _, valid = eval_metrics.stack_trajectories([forecasted_trajectories[k] for k in chunk])
+        compliance.append(drivable_area.get_compliance(trajectories, [city_names[k] for k in chunk], max_guesses,
+                                                       valid=valid))
+    return float(np.mean(np.concatenate(compliance)))
@@ -0,0 +1,165 @@
+from typing import Dict, List, Optional
+
+import numpy as np
+
+# Probabilities are clipped to this in the probabilistic metrics, as in argoverse.evaluation.eval_forecasting.
+LOW_PROB_THRESHOLD_FOR_METRICS = 0.05
+
+
+def stack_trajectories(trajectories: List[np.ndarray], probabilities: Optional[List] = None):
+    """
+    Pad the predictions of every scenario, whose numbers of modes may differ, into one array.
+
+    :param trajectories: shape ['mode num', T, 2] for every scenario
+    :return: trajectories (shape [N, K, T, 2]), probabilities (shape [N, K], None if not given)
+             and whether every mode is a prediction (shape [N, K])
+    """
+    lengths = np.array([len(each) for each in trajectories])
+    max_length = int(lengths.max())
+    valid = np.arange(max_length)[np.newaxis, :] < lengths[:, np.newaxis]
+    stacked = np.zeros([len(trajectories), max_length] + list(np.shape(trajectories[0])[1:]))
+    stacked[valid] = np.concatenate([np.asarray(each, dtype=np.float64) for each in trajectories])
+    if probabilities is not None:
+        probabilities_stacked = np.zeros([len(trajectories), max_length])
+        probabilities_stacked[valid] = np.concatenate([np.asarray(each, dtype=np.float64).reshape(-1)
+                                                       for each in probabilities])
+        probabilities = probabilities_stacked
+    return stacked, probabilities, valid
+
+
+def get_scenario_metrics(trajectories: np.ndarray, gt_trajectories: np.ndarray, max_guesses, horizon, miss_threshold,
+                         probabilities: np.ndarray = None, valid: np.ndarray = None) -> Dict[str, np.ndarray]:
+    """
+    Metrics of every scenario, the same as dataset_argoverse.get_displacement_errors_and_miss_rate.
+
+    The max_guesses most likely modes of every scenario are kept (the first ones if probabilities is None), and
+    minADE is the ADE of the mode with minimum FDE.
+
+    :param trajectories: shape [N, K, T, 2]
+    :param gt_trajectories: shape [N, T, 2]
+    :param probabilities: shape [N, K]
+    :param valid: shape [N, K], all modes are predictions if None
+    :return: {metric name: shape [N]}
+    """
+    scenario_num, mode_num = trajectories.shape[:2]
+    if valid is None:
+        valid = np.ones([scenario_num, mode_num], dtype=bool)
+    # Modes of a scenario are sorted by probability in descending order (stable), and padding goes last.
+    if probabilities is not None:
+        order = np.lexsort((-probabilities, ~valid), axis=1)
+    else:
+        order = np.argsort(~valid, axis=1, kind='stable')
+    trajectories = np.take_along_axis(np.asarray(trajectories, dtype=np.float64)[:, :, :horizon],
+                                      order[:, :, np.newaxis, np.newaxis], axis=1)
+    guess_nums = np.minimum(np.sum(valid, axis=1), max_guesses)
+    pruned = np.arange(mode_num)[np.newaxis, :] < guess_nums[:, np.newaxis]
+
+    # shape [N, K, T]
+    displacements = np.linalg.norm(trajectories - np.asarray(gt_trajectories, dtype=np.float64)[:, np.newaxis, :horizon],
+                                   axis=-1)
+    fdes = np.where(pruned, displacements[:, :, -1], np.inf)
+    scenario_idxs = np.arange(scenario_num)
+    min_idxs = np.argmin(fdes, axis=1)
+    min_fde = fdes[scenario_idxs, min_idxs]
+    min_ade = np.mean(displacements[scenario_idxs, min_idxs], axis=-1)
+    fdes = np.where(pruned, fdes, 0.0)
+
+    metrics = dict(
+        minADE=min_ade,
+        minFDE=min_fde,
+        avgFDE=np.sum(fdes, axis=1) / guess_nums,
+    )
+    misses = (min_fde > miss_threshold).astype(np.float64)
+    if probabilities is not None:
+        probabilities = np.where(pruned, np.take_along_axis(probabilities, order, axis=1), 0.0)
+        probabilities = probabilities / np.sum(probabilities, axis=1, keepdims=True)
+        with np.errstate(divide='ignore'):
+            prob_costs = np.minimum(-np.log(probabilities), -np.log(LOW_PROB_THRESHOLD_FOR_METRICS))
+        metrics['p_avgFDE'] = np.sum(np.where(pruned, fdes + prob_costs, 0.0), axis=1) / guess_nums
+    metrics['MR'] = misses
+    if probabilities is not None:
+        min_probabilities = probabilities[scenario_idxs, min_idxs]
+        min_prob_costs = prob_costs[scenario_idxs, min_idxs]
+        metrics['p-minADE'] = min_prob_costs + min_ade
+        metrics['p-minFDE'] = min_prob_costs + min_fde
+        metrics['p-MR'] = np.where(misses > 0, 1.0, 1.0 - min_probabilities)
+        metrics['brier-minADE'] = (1 - min_probabilities) ** 2 + min_ade
+        metrics['brier-minFDE'] = (1 - min_probabilities) ** 2 + min_fde
+    return metrics
+
+
+class MetricsAccumulator:
+    """
+    Streaming get_scenario_metrics: the predictions of every batch are added as they come,
+    and only the sums of the metrics are kept.
+
+    With drivable_area (a drivable_area.DrivableArea), the 'DAC' of the predictions is accumulated as well.
+    """
+
+    def __init__(self, max_guesses, horizon, miss_threshold, drivable_area=None):
+        self.max_guesses = max_guesses
+        self.horizon = horizon
+        self.miss_threshold = miss_threshold
+        self.drivable_area = drivable_area
+        self.sums: Dict[str, float] = {}
+        self.count = 0
+
+    def add(self, trajectories: List[np.ndarray], gt_trajectories: List[np.ndarray], probabilities: Optional[List] = None,
+            city_names: Optional[List[str]] = None):
+        """
+        :param trajectories: shape ['mode num', T, 2] for every scenario
+        :param gt_trajectories: shape [T, 2] for every scenario
+        :param probabilities: shape ['mode num'] for every scenario
+        :param city_names: city of every scenario, needed with drivable_area
+        """
+        if len(trajectories) == 0:
+            return
+        trajectories, probabilities, valid = stack_trajectories(trajectories, probabilities)
+        metrics = get_scenario_metrics(trajectories, np.stack(gt_trajectories), self.max_guesses, self.horizon,
+                                       self.miss_threshold, probabilities=probabilities, valid=valid)
+        if self.drivable_area is not None:
+            metrics['DAC'] = self.drivable_area.get_compliance(trajectories, city_names, self.max_guesses, valid=valid)
+        for key, values in metrics.items():
+            self.sums[key] = self.sums.get(key, 0.0) + float(np.sum(values))
+        self.count += len(trajectories)
+
+    def get_results(self) -> Dict[str, float]:
+        return {key: value / self.count for key, value in self.sums.items()}
+
+
+class DisplacementErrors:
+    """
+    Displacement errors of the first mode of every scenario, in an array preallocated for the whole eval and indexed
+    by the order in which the scenarios are added.
+    """
+
+    def __init__(self, scenario_num, future_frame_num):
+        self.DE = np.zeros([scenario_num, future_frame_num])
+        self.size = 0
+
+    def add(self, trajectories: np.ndarray, labels: np.ndarray):
+        """
+        :param trajectories: shape [N, K, T, 2]
+        :param labels: shape [N, T, 2]
+        """
+        end = self.size + len(trajectories)
+        if end > len(self.DE):
+            DE = np.zeros([max(end, 2 * len(self.DE)), self.DE.shape[1]])
+            DE[:self.size] = self.DE[:self.size]
+            self.DE = DE
+        self.DE[self.size:end] = np.linalg.norm(np.asarray(trajectories, dtype=np.float64)[:, 0] -
+                                                np.asarray(labels, dtype=np.float64), axis=-1)
+        self.size = end
+
+    def get_scores(self) -> List[float]:
+        """
+        :return: ADE, and DE@1, DE@2, DE@3, the displacement errors at the ends of the thirds of the horizon
+        """
+        DE = self.DE[:self.size]
+        length = DE.shape[1]
+        scores = [np.sum(np.mean(DE, axis=1)) / self.size]
+        for j in range(1, 4):
+            index = round(float(length) * j / 3) - 1
+            assert index >= 0
+            scores.append(np.sum(DE[:, index]) / self.size)
+        return scores
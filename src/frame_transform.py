@@ -0,0 +1,84 @@
+import math
+from typing import Dict, List
+
+import numpy as np
+import torch
+
+
+class Frame:
+    """
+    Agent-centred coordinate frame of an example, or of all examples of a batch.
+
+    World points are translated by (-x, -y) and rotated by angle into the frame, as mapping['cent_x'],
+    mapping['cent_y'] and mapping['angle'] are used in preprocessing. Points are NumPy arrays or Torch tensors
+    of shape [..., 2]. For a batch, x, y and angle have shape [batch_size] and the leading axis of the points
+    is the batch.
+
+    Transforms return new points and do the same arithmetic as utils.rotate, so results are the same as
+    rotating point by point.
+    """
+
+    def __init__(self, x, y, angle):
+        self.batched = np.ndim(angle) > 0
+        if self.batched:
+            self.x = np.asarray(x, dtype=np.float64)
+            self.y = np.asarray(y, dtype=np.float64)
+            self.angle = np.asarray(angle, dtype=np.float64)
+            self.cos = np.array([math.cos(each) for each in self.angle.tolist()])
+            self.sin = np.array([math.sin(each) for each in self.angle.tolist()])
+            self.cos_back = np.array([math.cos(-each) for each in self.angle.tolist()])
+            self.sin_back = np.array([math.sin(-each) for each in self.angle.tolist()])
+        else:
+            # Python floats keep the dtype of float32 points in NumPy arithmetic.
+            self.x, self.y, self.angle = float(x), float(y), float(angle)
+            self.cos, self.sin = math.cos(self.angle), math.sin(self.angle)
+            self.cos_back, self.sin_back = math.cos(-self.angle), math.sin(-self.angle)
+        # The world origin in the frame.
+        self.origin_x = -self.x * self.cos - (-self.y) * self.sin
+        self.origin_y = -self.x * self.sin + (-self.y) * self.cos
+
+    @classmethod
+    def from_mapping(cls, mapping: Dict) -> 'Frame':
+        return cls(mapping['cent_x'], mapping['cent_y'], mapping['angle'])
+
+    @classmethod
+    def from_mappings(cls, mapping: List[Dict]) -> 'Frame':
+        """
+        Frame of all examples of a batch.
+        """
+        return cls([each['cent_x'] for each in mapping], [each['cent_y'] for each in mapping],
+                   [each['angle'] for each in mapping])
+
+    def __getitem__(self, idx) -> 'Frame':
+        """
+        Frame of the idx-th example of a batch.
+        """
+        assert self.batched
+        return Frame(self.x[idx], self.y[idx], self.angle[idx])
+
+    def _transform(self, points, x, y, cos, sin):
+        if self.batched:
+            shape = [len(self.angle)] + [1] * (len(points.shape) - 2)
+            x, y, cos, sin = [each.reshape(shape) for each in (x, y, cos, sin)]
+        if isinstance(points, torch.Tensor):
+            if self.batched:
+                x, y, cos, sin = [torch.as_tensor(each, dtype=points.dtype, device=points.device) for each in (x, y, cos, sin)]
+            dx = points[..., 0] - x
+            dy = points[..., 1] - y
+            return torch.stack([dx * cos - dy * sin, dx * sin + dy * cos], dim=-1)
+        points = np.asarray(points)
+        dx = points[..., 0] - x
+        dy = points[..., 1] - y
+        return np.stack([dx * cos - dy * sin, dx * sin + dy * cos], axis=-1)
+
+    def to_frame(self, points):
+        """
+        World coordinates to the frame.
+        """
+        return self._transform(points, self.x, self.y, self.cos, self.sin)
+
+    def to_world(self, points):
+        """
+        Frame coordinates back to the world.
+        """
+        return self._transform(points, self.origin_x, self.origin_y, self.cos_back, self.sin_back)
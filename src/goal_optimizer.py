@@ -0,0 +1,200 @@
+import math
+import time
+
+import numpy as np
+
+# A sample point is missed if no selected goal is within MISS_THRESHOLD, which costs MISS_ERROR (see utils_cython.get_value).
+MISS_THRESHOLD = 2.0
+MISS_ERROR = 10.0
+
+
+def get_sample_points(goals_2D: np.ndarray, scores: np.ndarray, cnt_len):
+    """
+    Sub-sample the 1m x 1m cell around every goal on a cnt x cnt lattice, where cnt is cnt_len, cnt_len * 2
+    or cnt_len * 3 depending on the score of the goal, the same lattice as utils_cython.get_value.
+
+    :return: sample points (shape ['sample num', 2]) and their weights, the score of the goal divided by cnt * cnt
+    """
+    t_int = (scores * np.float32(1000)).astype(np.int64)
+    cnts = np.where(t_int > 10, cnt_len * 3, np.where(t_int > 5, cnt_len * 2, cnt_len))
+    points = []
+    weights = []
+    for cnt in np.unique(cnts).tolist():
+        idxs = np.nonzero(cnts == cnt)[0]
+        offsets = (np.arange(cnt) + 0.5) / cnt - 0.5
+        offsets = np.stack(np.meshgrid(offsets, offsets, indexing='ij'), axis=-1).reshape(-1, 2)
+        points.append((goals_2D[idxs, np.newaxis, :] + offsets[np.newaxis, :, :]).reshape(-1, 2))
+        weights.append(np.repeat(scores[idxs] / (cnt * cnt), cnt * cnt))
+    return np.concatenate(points).astype(np.float32), np.concatenate(weights).astype(np.float32)
+
+
+def get_costs(min_sqr_dis: np.ndarray, MRratio):
+    """
+    Cost of every sample point given the squared distance to its nearest selected goal,
+    MRratio * miss (scaled by MISS_ERROR) + (1 - MRratio) * minFDE.
+    """
+    costs = (min_sqr_dis > MISS_THRESHOLD ** 2).astype(np.float32) * np.float32(MISS_ERROR * MRratio)
+    if MRratio < 1.0:
+        costs += np.sqrt(min_sqr_dis) * np.float32(1.0 - MRratio)
+    return costs
+
+
+def get_sample_matrix(sample_points: np.ndarray):
+    """
+    Sample points as the [3, 'sample num'] matrix used by get_sqr_dis.
+    """
+    return np.concatenate([-2.0 * sample_points, np.sum(np.square(sample_points), axis=-1, keepdims=True)],
+                          axis=-1).T.astype(np.float32)
+
+
+def get_sqr_dis(sample_matrix: np.ndarray, points: np.ndarray):
+    """
+    Squared distances from points to all sample points, as one matrix product |p|^2 - 2 p.s + |s|^2.
+
+    :param points: shape [..., 2]
+    :return: shape [..., 'sample num']
+    """
+    points = points.astype(np.float32)
+    sqr_dis = np.concatenate([points, np.ones(points.shape[:-1] + (1,), dtype=np.float32)], axis=-1) @ sample_matrix
+    sqr_dis += np.sum(np.square(points), axis=-1, keepdims=True)
+    return np.maximum(sqr_dis, 0.0, out=sqr_dis)
+
+
+def get_values(sample_matrix: np.ndarray, weights: np.ndarray, candidates: np.ndarray, MRratio):
+    """
+    Expected cost of every candidate goal set.
+
+    :param candidates: candidate goal sets (shape ['candidate num', mode_num, 2])
+    :return: shape ['candidate num']
+    """
+    return get_costs(np.min(get_sqr_dis(sample_matrix, candidates), axis=1), MRratio) @ weights
+
+
+def get_nearest_two(sqr_dis: np.ndarray):
+    """
+    :param sqr_dis: squared distances from every goal of goal sets to the sample points (shape ['set num', mode_num, 'sample num'])
+    :return: index of and squared distance to the nearest goal, and squared distance to the second nearest goal
+             (each of shape ['set num', 'sample num'])
+    """
+    nearest = np.argmin(sqr_dis, axis=1)[:, np.newaxis, :]
+    first = np.take_along_axis(sqr_dis, nearest, axis=1)[:, 0]
+    sqr_dis = sqr_dis.copy()
+    np.put_along_axis(sqr_dis, nearest, np.inf, axis=1)
+    return nearest[:, 0], first, np.min(sqr_dis, axis=1)
+
+
+def get_greedy_targets(sample_matrix: np.ndarray, weights: np.ndarray, goals_2D: np.ndarray, scores: np.ndarray,
+                       mode_num, MRratio, candidate_num=256):
+    """
+    Select mode_num goals one by one, each time the goal that lowers the expected cost the most.
+    Only the candidate_num goals with the highest scores are considered.
+    """
+    candidates = goals_2D[np.argsort(-scores)[:candidate_num]]
+    sqr_dis = get_sqr_dis(sample_matrix, candidates)
+    min_sqr_dis = np.full(sample_matrix.shape[1], np.inf, dtype=np.float32)
+    selected = []
+    for _ in range(mode_num):
+        idx = int(np.argmin(get_costs(np.minimum(sqr_dis, min_sqr_dis), MRratio) @ weights))
+        selected.append(idx)
+        min_sqr_dis = np.minimum(min_sqr_dis, sqr_dis[idx])
+    return candidates[selected]
+
+
+def get_optimal_targets(goals_2D: np.ndarray, scores: np.ndarray, objective, opti_time, kwargs: dict = None):
+    """
+    Vectorized replacement of utils_cython.get_optimal_targets.
+
+    Runs num_chain annealing chains together, all starting from get_greedy_targets. At every step each chain
+    draws num_proposal moves of a single goal of its goal set. A move only changes the distances to that goal, so all
+    chains x proposals are evaluated at once from the squared distances of the sample points to their nearest and
+    second nearest goals, which are kept per chain. Each chain takes its best proposal if it improves, or a random one
+    with a small probability. Stops after num_step steps, opti_time seconds, or patience steps without improving
+    the best expectation.
+
+    :param scores: probabilities of goals
+    :return: (expectation, ans_points, pred_probs), ans_points sorted by pred_probs in descending order
+    """
+    kwargs = kwargs if kwargs is not None else {}
+    mode_num = kwargs.get('mode_num', 12)
+    num_step = kwargs.get('num_step', 1000)
+    num_chain = kwargs.get('num_chain', 2)
+    num_proposal = kwargs.get('num_proposal', 16)
+    patience = kwargs.get('patience', 100)
+    cnt_sample = kwargs.get('cnt_sample', 1)
+    cnt_len = int(round(math.sqrt(cnt_sample)))
+    assert cnt_len * cnt_len == cnt_sample, 'cnt_sample != square'
+    if objective == 'MR':
+        MRratio = 1.0
+    elif objective == 'minFDE':
+        MRratio = 0.0
+    elif objective == 'MRminFDE':
+        MRratio = kwargs.get('MRratio', 1.0)
+    else:
+        assert False, objective
+    rng = np.random.default_rng(kwargs.get('seed'))
+    start_time = time.time()
+
+    # Goals with negligible probability are dropped, as in utils_cython.
+    keep = scores >= 0.001
+    if not np.any(keep):
+        keep = scores == np.max(scores)
+    goals_2D = np.asarray(goals_2D[keep], dtype=np.float32)
+    # Centered coordinates keep the matrix product of get_sqr_dis accurate in float32.
+    center = np.mean(goals_2D, axis=0)
+    goals_2D = goals_2D - center
+    sample_points, weights = get_sample_points(goals_2D, np.asarray(scores[keep], dtype=np.float32), cnt_len)
+    sample_matrix = get_sample_matrix(sample_points)
+
+    chain_idxs = np.arange(num_chain)
+    # All chains start from the greedy selection and diverge by their random moves.
+    ans_points = np.repeat(get_greedy_targets(sample_matrix, weights, goals_2D, scores[keep], mode_num, MRratio)[np.newaxis],
+                           num_chain, axis=0)
+    sqr_dis = get_sqr_dis(sample_matrix, ans_points)
+    nearest, first, second = get_nearest_two(sqr_dis)
+    expectations = get_costs(first, MRratio) @ weights
+    best_expectation = float(np.min(expectations))
+    best_points = ans_points[np.argmin(expectations)].copy()
+
+    no_improvement = 0
+    for step in range(num_step):
+        spent_ratio = (time.time() - start_time) / opti_time
+        if spent_ratio >= 1.0 or no_improvement >= patience:
+            break
+        # The step size decays with the steps or the time spent, whichever is further.
+        lr = math.exp(-2.0 * max(step / num_step, spent_ratio))
+
+        moved_idxs = rng.integers(0, mode_num, size=[num_chain, num_proposal])
+        proposals = ans_points[chain_idxs[:, np.newaxis], moved_idxs] + \
+                    rng.uniform(-lr, lr, size=[num_chain, num_proposal, 2]).astype(np.float32)
+        # Without the moved goal, a sample point is nearest to its second nearest goal if the moved goal was the nearest.
+        sqr_dis_without_moved = np.where(nearest[:, np.newaxis, :] == moved_idxs[:, :, np.newaxis],
+                                         second[:, np.newaxis, :], first[:, np.newaxis, :])
+        values = get_costs(np.minimum(sqr_dis_without_moved, get_sqr_dis(sample_matrix, proposals)), MRratio) @ weights
+
+        proposal_idxs = np.argmin(values, axis=-1)
+        go = values[chain_idxs, proposal_idxs] < expectations
+        # Random moves let the chains escape local minima.
+        fire = ~go & (rng.random(num_chain) < 0.01)
+        proposal_idxs[fire] = rng.integers(0, num_proposal, size=int(np.sum(fire)))
+        go |= fire
+        if np.any(go):
+            chains = chain_idxs[go]
+            moved = moved_idxs[chains, proposal_idxs[go]]
+            ans_points[chains, moved] = proposals[chains, proposal_idxs[go]]
+            sqr_dis[chains, moved] = get_sqr_dis(sample_matrix, ans_points[chains, moved])
+            nearest[chains], first[chains], second[chains] = get_nearest_two(sqr_dis[chains])
+            expectations[chains] = values[chains, proposal_idxs[go]]
+
+        chain = np.argmin(expectations)
+        if expectations[chain] < best_expectation - 1e-6:
+            no_improvement = 0
+        else:
+            no_improvement += 1
+        if expectations[chain] < best_expectation:
+            best_expectation = float(expectations[chain])
+            best_points = ans_points[chain].copy()
+
+    # The probability of every selected goal is 1 - the cost if it were the only prediction.
+    pred_probs = 1.0 - get_values(sample_matrix, weights, best_points[:, np.newaxis, :], MRratio)
+    argsort = np.argsort(-pred_probs)
+    return best_expectation, best_points[argsort] + center, pred_probs[argsort].astype(np.float32)
@@ -0,0 +1,88 @@
+from typing import Dict, List
+
+import numpy as np
+from argoverse.map_representation.map_api import ArgoverseMap
+from argoverse.utils.manhattan_search import find_all_polygon_bboxes_overlapping_query_bbox
+
+from frame_transform import Frame
+
+
+class _CityLanes:
+    """
+    All lanes of one city: their bounding boxes, their centerlines packed into one [M, 2] array
+    (lane i owns rows starts[i]:ends[i]), and a uniform grid over the bounding boxes.
+    """
+
+    def __init__(self, am: ArgoverseMap, city_name, cell_size):
+        self.cell_size = cell_size
+        # Same table (and order) as used by ArgoverseMap.get_lane_ids_in_xy_bbox.
+        self.bboxes = np.asarray(am.city_halluc_bbox_table[city_name], dtype=np.float64)
+        tableidx_to_laneid = am.city_halluc_tableidx_to_laneid_map[city_name]
+        self.lane_ids = np.array([tableidx_to_laneid[str(i)] for i in range(len(self.bboxes))], dtype=np.int64)
+
+        centerlines = [am.city_lane_centerlines_dict[city_name][lane_id].centerline[:, :2]
+                       for lane_id in self.lane_ids.tolist()]
+        lengths = np.array([len(each) for each in centerlines], dtype=np.int64)
+        self.ends = np.cumsum(lengths)
+        self.starts = self.ends - lengths
+        self.points = np.concatenate(centerlines).astype(np.float64)
+
+        # Register every lane in all grid cells its bounding box overlaps.
+        cell_min = np.floor(self.bboxes[:, :2] / cell_size).astype(np.int64)
+        cell_max = np.floor(self.bboxes[:, 2:] / cell_size).astype(np.int64)
+        cells = {}
+        for idx in range(len(self.bboxes)):
+            for i in range(cell_min[idx, 0], cell_max[idx, 0] + 1):
+                for j in range(cell_min[idx, 1], cell_max[idx, 1] + 1):
+                    cells.setdefault((i, j), []).append(idx)
+        self.cells: Dict[tuple, np.ndarray] = {cell: np.array(idxs, dtype=np.int64) for cell, idxs in cells.items()}
+
+    def query(self, x, y, query_search_range_manhattan):
+        query_bbox = np.array([x - query_search_range_manhattan, y - query_search_range_manhattan,
+                               x + query_search_range_manhattan, y + query_search_range_manhattan])
+        cell_min = np.floor(query_bbox[:2] / self.cell_size).astype(np.int64)
+        cell_max = np.floor(query_bbox[2:] / self.cell_size).astype(np.int64)
+        candidates = [self.cells[(i, j)]
+                      for i in range(cell_min[0], cell_max[0] + 1)
+                      for j in range(cell_min[1], cell_max[1] + 1) if (i, j) in self.cells]
+        if len(candidates) == 0:
+            return np.zeros([0], dtype=np.int64)
+        # np.unique also sorts, which keeps the order of the map API.
+        candidates = np.unique(np.concatenate(candidates))
+        return candidates[find_all_polygon_bboxes_overlapping_query_bbox(self.bboxes[candidates], query_bbox)]
+
+
+class LaneIndex:
+    """
+    Spatial index over the lane centerlines of every city in an ArgoverseMap.
+
+    Queries return the same lanes, in the same order, as am.get_lane_ids_in_xy_bbox, and centerlines are
+    gathered from the packed per-city arrays instead of the dict based map api.
+    """
+
+    def __init__(self, am: ArgoverseMap, cell_size=100.0):
+        self.city2lanes = {city_name: _CityLanes(am, city_name, cell_size) for city_name in am.city_halluc_bbox_table}
+
+    def get_lane_idxs_in_xy_bbox(self, x, y, city_name, query_search_range_manhattan):
+        """
+        Table indices of the lanes whose bounding boxes overlap the manhattan box around (x, y).
+        """
+        return self.city2lanes[city_name].query(x, y, query_search_range_manhattan)
+
+    def get_lane_ids(self, city_name, lane_idxs) -> List[int]:
+        return self.city2lanes[city_name].lane_ids[lane_idxs].tolist()
+
+    def get_centerlines(self, city_name, lane_idxs, x, y, angle) -> List[np.ndarray]:
+        """
+        Centerlines of the given lanes, translated by (-x, -y) and rotated by angle, as [n, 2] arrays.
+        """
+        lanes = self.city2lanes[city_name]
+        lane_idxs = np.asarray(lane_idxs, dtype=np.int64)
+        if len(lane_idxs) == 0:
+            return []
+        starts = lanes.starts[lane_idxs]
+        lengths = lanes.ends[lane_idxs] - starts
+        ends = np.cumsum(lengths)
+        rows = np.arange(ends[-1]) + np.repeat(starts - (ends - lengths), lengths)
+        points = lanes.points[rows]
+        return np.split(Frame(x, y, angle).to_frame(points), ends[:-1])
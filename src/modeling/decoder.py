@@ -1,3 +1,4 @@
+from functools import partial
 from typing import Dict, List, Tuple, NamedTuple, Any
 
 import numpy as np
@@ -7,6 +8,7 @@ from torch import nn, Tensor
 
 import structs
 import utils_cython
+from frame_transform import Frame
 from modeling.lib import PointSubGraph, GlobalGraphRes, CrossAttention, GlobalGraph, MLP
 
 import utils
@@ -92,63 +94,84 @@ class Decoder(nn.Module):
             self.set_predict_decoders = nn.ModuleList(
                 [DecoderResCat(hidden_size, hidden_size * 2, out_features=13) for _ in range(args.other_params['set_predict'])])
 
-    def lane_scoring(self, i, mapping, lane_states_batch, inputs, inputs_lengths,
+    def get_stage_one_scores(self, lanes: Tensor, lanes_mask: Tensor, inputs: Tensor, inputs_mask: Tensor,
+                             hidden_states: Tensor):
+        """
+        :param lanes: hidden states of lanes (shape [batch_size, 'max lane num', hidden_size])
+        :param lanes_mask: whether every lane is a lane of the example (shape [batch_size, 'max lane num'])
+        :param inputs_mask: whether every element is an element of the example (shape [batch_size, 'max element num'])
+        :return: log scores of lanes, padded lanes get a probability of 0 (shape [batch_size, 'max lane num'])
+        """
+        stage_one_hidden_attention = self.stage_one_cross_attention(lanes, inputs, inputs_mask.unsqueeze(1))
+        stage_one_scores = self.stage_one_decoder(torch.cat([hidden_states[:, 0, :].unsqueeze(1).expand(
+            lanes.shape), lanes, stage_one_hidden_attention], dim=-1))
+        stage_one_scores = stage_one_scores.squeeze(-1)
+        return F.log_softmax(stage_one_scores.masked_fill(~lanes_mask, -np.inf), dim=-1)
+
+    def select_top_lanes(self, stage_one_scores: Tensor, lanes: Tensor, lanes_mask: Tensor):
+        """
+        Select the top K lanes of every example, where K is dynamic: the sum of the probabilities of the selected lanes
+        is larger than threshold (0.95).
+
+        :return: hidden states of lanes in descending order of score (shape [batch_size, 'max lane num', hidden_size]),
+                 whether every one of them is selected (shape [batch_size, 'max lane num'])
+                 and their indices in lanes (shape [batch_size, 'max lane num'])
+        """
+        # A lane is selected if the sum of the probabilities of the lanes before it is not larger than threshold.
+        threshold = 0.95
+        stage_one_scores, stage_one_topk_ids = torch.sort(stage_one_scores.detach(), dim=-1, descending=True)
+        probs = torch.exp(stage_one_scores)
+        topk_lanes_mask = (torch.cumsum(probs, dim=-1) - probs <= threshold) & torch.gather(lanes_mask, 1,
+                                                                                         stage_one_topk_ids)
+        topk_lanes = torch.gather(lanes, 1, stage_one_topk_ids.unsqueeze(-1).expand(lanes.shape))
+        return topk_lanes, topk_lanes_mask, stage_one_topk_ids
+
+    def lane_scoring(self, mapping, batch_size, lane_states_batch, inputs, inputs_lengths,
                      hidden_states, device, loss):
-        def get_stage_one_scores():
-            stage_one_hidden = lane_states_batch[i] # (N polylines in batch i, hidden_size)
-            stage_one_hidden_attention = self.stage_one_cross_attention(
-                stage_one_hidden.unsqueeze(0), inputs[i][:inputs_lengths[i]].unsqueeze(0)).squeeze(0)
-            stage_one_scores = self.stage_one_decoder(torch.cat([hidden_states[i, 0, :].unsqueeze(0).expand(
-                stage_one_hidden.shape), stage_one_hidden, stage_one_hidden_attention], dim=-1))
-            stage_one_scores = stage_one_scores.squeeze(-1)
-            stage_one_scores = F.log_softmax(stage_one_scores, dim=-1)
-            return stage_one_scores
-
-        stage_one_scores = get_stage_one_scores() # (N polylines in batch i, 1) scores per polyline (lane selection?)
-        assert len(stage_one_scores) == len(mapping[i]['polygons'])
-        loss[i] += F.nll_loss(stage_one_scores.unsqueeze(0),
-                              torch.tensor([mapping[i]['stage_one_label']], device=device))
-
-        # Select top K lanes, where K is dynamic. The sum of the probabilities of selected lanes is larger than threshold (0.95).
-        if True:
-            _, stage_one_topk_ids = torch.topk(stage_one_scores, k=len(stage_one_scores))
-            threshold = 0.95
-            sum = 0.0
-            for idx, each in enumerate(torch.exp(stage_one_scores[stage_one_topk_ids])):
-                sum += each
-                if sum > threshold:
-                    stage_one_topk_ids = stage_one_topk_ids[:idx + 1]
-                    break
-            utils.other_errors_put('stage_one_k', len(stage_one_topk_ids))
-        # _, stage_one_topk_ids = torch.topk(stage_one_scores, k=min(args.stage_one_K, len(stage_one_scores)))
-
-        if mapping[i]['stage_one_label'] in stage_one_topk_ids.tolist():
-            utils.other_errors_put('stage_one_recall', 1.0)
-        else:
-            utils.other_errors_put('stage_one_recall', 0.0)
+        """
+        Score the lanes of all examples together and select the top K lanes of every example, see select_top_lanes.
+
+        :return: hidden states of the selected lanes of every example, in descending order of score
+                 (shape [batch_size, 'max lane num', hidden_size]), and whether every lane is selected
+                 (shape [batch_size, 'max lane num'])
+        """
+        lanes, lanes_lengths = utils.merge_tensors(lane_states_batch, device)
+        lanes_mask = utils.get_length_mask(lanes_lengths, lanes.shape[1], device)
+        stage_one_scores = self.get_stage_one_scores(
+            lanes, lanes_mask, inputs, utils.get_length_mask(inputs_lengths, inputs.shape[1], device), hidden_states)
+        for i in range(batch_size):
+            assert lanes_lengths[i] == len(mapping[i]['polygons'])
+        stage_one_labels = torch.tensor([mapping[i]['stage_one_label'] for i in range(batch_size)], device=device)
+        loss += F.nll_loss(stage_one_scores, stage_one_labels, reduction='none')
+
+        topk_lanes, topk_lanes_mask, stage_one_topk_ids = self.select_top_lanes(stage_one_scores, lanes, lanes_mask)
 
-        topk_lanes = lane_states_batch[i][stage_one_topk_ids]
-        return topk_lanes
+        recall = torch.gather(topk_lanes_mask, 1, torch.argsort(stage_one_topk_ids, dim=-1))
+        recall = recall[torch.arange(batch_size, device=device), stage_one_labels]
+        utils.other_errors_put_tensor('stage_one_k', topk_lanes_mask.sum(-1))
+        utils.other_errors_put_tensor('stage_one_recall', recall.float())
+        return topk_lanes, topk_lanes_mask
 
-    def get_scores_of_dense_goals(self, i, goals_2D, mapping, labels, device, scores,
-                                  get_scores_inputs, gt_points=None):
+    def get_dense_goals(self, goals_2D: Tensor, scores: Tensor):
+        """
+        Sample dense goals around the top K sparse goals of an example.
+
+        :return: dense goals followed by the sparse goals (shape ['dense goal num', 2])
+        """
         if args.argoverse:
             k = 150
         else:
             k = 40
         _, topk_ids = torch.topk(scores, k=min(k, len(scores)))
-        topk_ids = topk_ids.tolist()
 
         # Sample dense goals from top K sparse goals.
-        goals_2D_dense = utils.get_neighbour_points(goals_2D[topk_ids], topk_ids=topk_ids, mapping=mapping[i])
-
-        goals_2D_dense = torch.cat([torch.tensor(goals_2D_dense, device=device, dtype=torch.float),
-                                    torch.tensor(goals_2D, device=device, dtype=torch.float)], dim=0)
+        goals_2D_dense = utils.get_neighbour_points_tensor(
+            goals_2D[topk_ids], neighbour_dis=float(args.other_params.get('dense_goals_radius', 2)),
+            density=float(args.other_params.get('dense_goals_density', 1.0)))
 
-        old_vector_num = len(goals_2D)
-
-        scores = self.get_scores(goals_2D_dense, *get_scores_inputs)
+        return torch.cat([goals_2D_dense, goals_2D], dim=0)
 
+    def get_highest_dense_goal(self, i, goals_2D_dense, mapping, labels, scores):
         index = torch.argmax(scores).item()
         point = np.array(goals_2D_dense[index].tolist())
 
@@ -157,7 +180,7 @@ class Decoder(nn.Module):
             final_idx = mapping[i].get('final_idx', -1)
             mapping[i]['goals_2D_labels'] = np.argmin(utils.get_dis(goals_2D_dense.detach().cpu().numpy(), label[final_idx]))
 
-        return scores, point, goals_2D_dense.detach().cpu().numpy()
+        return point, goals_2D_dense.detach().cpu().numpy()
 
     def goals_2D_per_example_calc_loss(self, i: int, goals_2D: np.ndarray, mapping: List[Dict], inputs: Tensor,
                                        inputs_lengths: List[int], hidden_states: Tensor, device, loss: Tensor,
@@ -186,12 +209,12 @@ class Decoder(nn.Module):
         loss[i] += F.nll_loss(scores.unsqueeze(0),
                               torch.tensor([mapping[i]['goals_2D_labels']], device=device))
 
-    def goals_2D_per_example(self, i: int, goals_2D: np.ndarray, mapping: List[Dict], lane_states_batch: List[Tensor],
-                             inputs: Tensor, inputs_lengths: List[int], hidden_states: Tensor, labels: List[np.ndarray],
-                             labels_is_valid: List[np.ndarray], device, loss: Tensor, DE: np.ndarray):
+    def goals_2D_batch(self, mapping: List[Dict], batch_size, lane_states_batch: List[Tensor], inputs: Tensor,
+                       inputs_lengths: List[int], hidden_states: Tensor, labels: List[np.ndarray],
+                       labels_is_valid: List[np.ndarray], device, loss: Tensor, DE: np.ndarray):
         """
-        :param i: example index in batch
-        :param goals_2D: candidate goals sampled from map (shape ['goal num', 2])
+        Score the goals of all examples, sparse goals first and then dense goals, one batched get_scores call each.
+
         :param lane_states_batch: each value in list is hidden states of lanes (value shape ['lane num', hidden_size])
         :param inputs: hidden states of all elements before encoding by global graph (shape [batch_size, 'element num', hidden_size])
         :param inputs_lengths: valid element number of each example
@@ -199,35 +222,47 @@ class Decoder(nn.Module):
         :param loss: (shape [batch_size])
         :param DE: displacement error (shape [batch_size, self.future_frame_num])
         """
-        if args.do_train:
-            final_idx = mapping[i].get('final_idx', -1)
-            assert labels_is_valid[i][final_idx]
-
-        gt_points = labels[i].reshape([self.future_frame_num, 2])
-
         topk_lanes = None
         # Get top K lanes with the highest probability.
         if 'lane_scoring' in args.other_params:
-            topk_lanes = self.lane_scoring(i, mapping, lane_states_batch, inputs, inputs_lengths,
+            topk_lanes = self.lane_scoring(mapping, batch_size, lane_states_batch, inputs, inputs_lengths,
                                            hidden_states, device, loss)
 
-        get_scores_inputs = (inputs, hidden_states, inputs_lengths, i, mapping, device, topk_lanes)
+        get_scores_inputs = (inputs, hidden_states, inputs_lengths, device, topk_lanes)
 
         # There is a lane scoring module (see Section 3.2) in the paper in order to reduce the number of goal candidates.
         # In this implementation, we use goal scoring instead of lane scoring, because we observed that it performs slightly better than lane scoring.
         # Here goals_2D are sparse cnadidate goals sampled from map.
+        goals_2D_batch = [torch.tensor(mapping[i]['goals_2D'], device=device, dtype=torch.float) for i in range(batch_size)]
         if 'goal_scoring' in args.other_params:
-            goals_2D_tensor = torch.tensor(goals_2D, device=device, dtype=torch.float)
-            scores = self.get_scores(goals_2D_tensor, *get_scores_inputs)
-            index = torch.argmax(scores).item()
-            highest_goal = goals_2D[index]
+            scores_batch = self.get_scores(goals_2D_batch, *get_scores_inputs)
 
         # Get dense goals and their scores.
         # With the help of the above goal scoring, we can reduce the number of dense goals.
         # After this step, goals_2D become dense goals.
-        scores, highest_goal, goals_2D = \
-            self.get_scores_of_dense_goals(i, goals_2D, mapping, labels, device, scores,
-                                           get_scores_inputs, gt_points)
+        goals_2D_dense_batch = [self.get_dense_goals(goals_2D_batch[i], scores_batch[i])
+                                for i in range(batch_size)]
+        scores_batch = self.get_scores(goals_2D_dense_batch, *get_scores_inputs)
+
+        for i in range(batch_size):
+            highest_goal, goals_2D = self.get_highest_dense_goal(i, goals_2D_dense_batch[i], mapping, labels, scores_batch[i])
+            self.goals_2D_per_example(i, goals_2D, scores_batch[i], highest_goal, mapping, inputs, inputs_lengths,
+                                      hidden_states, labels, labels_is_valid, device, loss, DE)
+
+    def goals_2D_per_example(self, i: int, goals_2D: np.ndarray, scores: Tensor, highest_goal: np.ndarray,
+                             mapping: List[Dict], inputs: Tensor, inputs_lengths: List[int], hidden_states: Tensor,
+                             labels: List[np.ndarray], labels_is_valid: List[np.ndarray], device, loss: Tensor,
+                             DE: np.ndarray):
+        """
+        :param i: example index in batch
+        :param goals_2D: dense goals (shape ['goal num', 2])
+        :param scores: log scores of the dense goals (shape ['goal num'])
+        """
+        if args.do_train:
+            final_idx = mapping[i].get('final_idx', -1)
+            assert labels_is_valid[i][final_idx]
+
+        gt_points = labels[i].reshape([self.future_frame_num, 2])
 
         if args.do_train:
             self.goals_2D_per_example_calc_loss(i, goals_2D, mapping, inputs, inputs_lengths,
@@ -255,13 +290,31 @@ class Decoder(nn.Module):
                 else:
                     assert False
 
-    def goals_2D_eval(self, batch_size, mapping, labels, hidden_states, inputs, inputs_lengths, device):
+    def complete_trajectories(self, goals: Tensor, inputs: Tensor, inputs_mask: Tensor, hidden_states: Tensor):
+        """
+        Complete the trajectories to the goals of all examples together, cross attention is masked to the elements
+        of each example.
+
+        :param goals: shape [batch_size, 'goal num', 2]
+        :param inputs_mask: whether every element is an element of the example (shape [batch_size, 'max element num'])
+        :return: shape [batch_size, 'goal num', self.future_frame_num, 2]
+        """
+        targets_feature = self.goals_2D_mlps(goals)
+        hidden_attention = self.complete_traj_cross_attention(targets_feature, inputs, inputs_mask.unsqueeze(1))
+        return self.complete_traj_decoder(
+            torch.cat([hidden_states[:, 0, :].unsqueeze(1).expand(targets_feature.shape), targets_feature,
+                       hidden_attention], dim=-1)).view([goals.shape[0], goals.shape[1], self.future_frame_num, 2])
+
+    def goals_2D_eval(self, batch_size, mapping, labels, hidden_states, inputs, inputs_lengths, device, batch_id=None):
+        """
+        :param batch_id: id from utils.submit_goals_optimization if the goal optimization of the batch was already started
+        """
         if 'set_predict' in args.other_params:
             pred_goals_batch = [mapping[i]['set_predict_ans_points'] for i in range(batch_size)]
             pred_probs_batch = np.zeros((batch_size, args.mode_num))
         elif 'optimization' in args.other_params:
             pred_goals_batch, pred_probs_batch = utils.select_goals_by_optimization(
-                np.array(labels).reshape([batch_size, self.future_frame_num, 2]), mapping)
+                np.array(labels).reshape([batch_size, self.future_frame_num, 2]), mapping, batch_id=batch_id)
         elif args.nms_threshold is not None:
             pred_goals_batch = [mapping[i]['pred_goals'] for i in range(batch_size)]
             pred_probs_batch = [mapping[i]['pred_probs'] for i in range(batch_size)]
@@ -274,24 +327,23 @@ class Decoder(nn.Module):
         assert pred_probs_batch.shape == (batch_size, self.mode_num)
 
         if 'complete_traj' in args.other_params:
-            pred_trajs_batch = []
+            predict_trajs = self.complete_trajectories(
+                torch.tensor(pred_goals_batch, dtype=torch.float, device=device), inputs,
+                utils.get_length_mask(inputs_lengths, inputs.shape[1], device), hidden_states)
+            # Double precision, as the world coordinates are large.
+            predict_trajs = predict_trajs.double()
+            final_idxs = torch.tensor([mapping[i].get('final_idx', -1) % self.future_frame_num for i in range(batch_size)],
+                                      device=device)
+            predict_trajs[torch.arange(batch_size, device=device), :, final_idxs] = torch.tensor(
+                pred_goals_batch, dtype=torch.double, device=device)
+
+            if args.argoverse:
+                predict_trajs, pred_trajs_batch = torch.stack(
+                    [predict_trajs, Frame.from_mappings(mapping).to_world(predict_trajs)]).cpu().numpy()
+            else:
+                predict_trajs = pred_trajs_batch = predict_trajs.cpu().numpy()
             for i in range(batch_size):
-                targets_feature = self.goals_2D_mlps(torch.tensor(pred_goals_batch[i], dtype=torch.float, device=device))
-                hidden_attention = self.complete_traj_cross_attention(
-                    targets_feature.unsqueeze(0), inputs[i][:inputs_lengths[i]].unsqueeze(0)).squeeze(0)
-                predict_trajs = self.complete_traj_decoder(
-                    torch.cat([hidden_states[i, 0, :].unsqueeze(0).expand(len(targets_feature), -1), targets_feature,
-                               hidden_attention], dim=-1)).view([self.mode_num, self.future_frame_num, 2])
-                predict_trajs = np.array(predict_trajs.tolist())
-                final_idx = mapping[i].get('final_idx', -1)
-                predict_trajs[:, final_idx, :] = pred_goals_batch[i]
-                mapping[i]['vis.predict_trajs'] = predict_trajs.copy()
-
-                if args.argoverse:
-                    for each in predict_trajs:
-                        utils.to_origin_coordinate(each, i)
-                pred_trajs_batch.append(predict_trajs)
-            pred_trajs_batch = np.array(pred_trajs_batch)
+                mapping[i]['vis.predict_trajs'] = predict_trajs[i].copy()
         else:
             pass 
 
@@ -329,18 +381,17 @@ class Decoder(nn.Module):
             if 'variety_loss-prob' in args.other_params:
                 loss[i] += F.nll_loss(pred_probs[i].unsqueeze(0), torch.tensor([argmin], device=device))
         if args.do_eval:
-            outputs = np.array(outputs.tolist())
+            outputs = Frame.from_mappings(mapping).to_world(outputs.detach().double()).cpu().numpy()
             pred_probs = np.array(pred_probs.tolist(), dtype=np.float32) if pred_probs is not None else pred_probs
-            for i in range(batch_size):
-                for each in outputs[i]:
-                    utils.to_origin_coordinate(each, i)
 
             return outputs, pred_probs, None
         return loss.mean(), DE, None
 
     def forward(self, mapping: List[Dict], batch_size, lane_states_batch: List[Tensor], inputs: Tensor,
-                inputs_lengths: List[int], hidden_states: Tensor, device):
+                inputs_lengths: List[int], hidden_states: Tensor, device, pipeline=False):
         """
+        :param pipeline: in eval, return a function that finishes the eval of the batch (see goals_2D_eval)
+                         after starting its goal optimization, instead of the predictions
         :param lane_states_batch: each value in list is hidden states of lanes (value shape ['lane num', hidden_size])
         :param inputs: hidden states of all elements before encoding by global graph (shape [batch_size, 'max element num', hidden_size])
         :param inputs_lengths: valid element number of each example
@@ -354,11 +405,8 @@ class Decoder(nn.Module):
         if 'variety_loss' in args.other_params:
             return self.variety_loss(mapping, hidden_states, batch_size, inputs, inputs_lengths, labels_is_valid, loss, DE, device, labels)
         elif 'goals_2D' in args.other_params:
-            for i in range(batch_size):
-                goals_2D = mapping[i]['goals_2D']  # N, 2
-
-                self.goals_2D_per_example(i, goals_2D, mapping, lane_states_batch, inputs, inputs_lengths,
-                                          hidden_states, labels, labels_is_valid, device, loss, DE)
+            self.goals_2D_batch(mapping, batch_size, lane_states_batch, inputs, inputs_lengths, hidden_states, labels,
+                                labels_is_valid, device, loss, DE)
 
             if 'set_predict' in args.other_params:
                 pass
@@ -372,6 +420,12 @@ class Decoder(nn.Module):
                 #     return pred_trajs_batch
 
             if args.do_eval:
+                if pipeline:
+                    batch_id = None
+                    if 'optimization' in args.other_params and 'set_predict' not in args.other_params:
+                        batch_id = utils.submit_goals_optimization(mapping)
+                    return partial(self.goals_2D_eval, batch_size, mapping, labels, hidden_states, inputs, inputs_lengths,
+                                   device, batch_id=batch_id)
                 return self.goals_2D_eval(batch_size, mapping, labels, hidden_states, inputs, inputs_lengths, device)
             else:
                 if args.visualize:
@@ -387,35 +441,58 @@ class Decoder(nn.Module):
         else:
             assert False
 
-    def get_scores(self, goals_2D_tensor: Tensor, inputs, hidden_states, inputs_lengths, i, mapping, device, topk_lanes):
+    def get_scores(self, goals_2D_batch: List[Tensor], inputs, hidden_states, inputs_lengths, device, topk_lanes):
+        """
+        Score the candidate goals of all examples together, padded to the largest goal set, see score_goals.
+
+        :param goals_2D_batch: candidate goals sampled from map (value shape ['goal num', 2])
+        :param topk_lanes: top K lanes and their mask from lane_scoring, None without lane scoring
+        :return: log scores of goals (value shape ['goal num'])
         """
-        :param goals_2D_tensor: candidate goals sampled from map (shape ['goal num', 2])
-        :return: log scores of goals (shape ['goal num'])
+        goals_2D_tensor, goals_2D_lengths = utils.merge_tensors(goals_2D_batch, device, hidden_size=2)
+        scores = self.score_goals(goals_2D_tensor, utils.get_length_mask(goals_2D_lengths, goals_2D_tensor.shape[1], device),
+                                  inputs, utils.get_length_mask(inputs_lengths, inputs.shape[1], device), hidden_states,
+                                  topk_lanes)
+        return [scores[i, :goals_2D_lengths[i]] for i in range(len(goals_2D_batch))]
+
+    def score_goals(self, goals_2D_tensor: Tensor, goals_2D_mask: Tensor, inputs: Tensor, inputs_mask: Tensor,
+                    hidden_states: Tensor, topk_lanes: Tuple[Tensor, Tensor] = None):
         """
+        Cross attention is masked to the elements (and top K lanes) of each example and log softmax
+        only runs over the goals of each example.
+
+        :param goals_2D_tensor: candidate goals (shape [batch_size, 'max goal num', 2])
+        :param goals_2D_mask: whether every goal is a candidate goal of the example (shape [batch_size, 'max goal num'])
+        :param inputs_mask: whether every element is an element of the example (shape [batch_size, 'max element num'])
+        :param topk_lanes: top K lanes and their mask (see select_top_lanes), None without lane scoring
+        :return: log scores of goals, padded goals get a probability of 0 (shape [batch_size, 'max goal num'])
+        """
+        agent = hidden_states[:, 0, :]
+
         # Fuse goal feature and agent feature when encoding goals.
         if 'point_sub_graph' in args.other_params:
-            goals_2D_hidden = self.goals_2D_point_sub_graph(goals_2D_tensor.unsqueeze(0), hidden_states[i, 0:1, :]).squeeze(0)
+            goals_2D_hidden = self.goals_2D_point_sub_graph(goals_2D_tensor, agent)
         else:
             goals_2D_hidden = self.goals_2D_mlps(goals_2D_tensor)
 
-        goals_2D_hidden_attention = self.goals_2D_cross_attention(
-            goals_2D_hidden.unsqueeze(0), inputs[i][:inputs_lengths[i]].unsqueeze(0)).squeeze(0)
+        # Padded keys are masked for all goals.
+        goals_2D_hidden_attention = self.goals_2D_cross_attention(goals_2D_hidden, inputs, inputs_mask.unsqueeze(1))
 
-        if 'lane_scoring' in args.other_params:
+        if topk_lanes is not None:
             # Perform cross attention from goals to top K lanes. It's a trick to improve model performance.
+            topk_lanes, topk_lanes_mask = topk_lanes
             stage_one_goals_2D_hidden_attention = self.goals_2D_cross_attention(
-                goals_2D_hidden.unsqueeze(0), topk_lanes.unsqueeze(0)).squeeze(0)
-            li = [hidden_states[i, 0, :].unsqueeze(0).expand(goals_2D_hidden.shape),
+                goals_2D_hidden, topk_lanes, topk_lanes_mask.unsqueeze(1))
+            li = [agent.unsqueeze(1).expand(goals_2D_hidden.shape),
                   goals_2D_hidden, goals_2D_hidden_attention, stage_one_goals_2D_hidden_attention]
 
             scores = self.stage_one_goals_2D_decoder(torch.cat(li, dim=-1))
         else:
-            scores = self.goals_2D_decoder(torch.cat([hidden_states[i, 0, :].unsqueeze(0).expand(
+            scores = self.goals_2D_decoder(torch.cat([agent.unsqueeze(1).expand(
                 goals_2D_hidden.shape), goals_2D_hidden, goals_2D_hidden_attention], dim=-1))
 
         scores = scores.squeeze(-1)
-        scores = F.log_softmax(scores, dim=-1)
-        return scores
+        return F.log_softmax(scores.masked_fill(~goals_2D_mask, -np.inf), dim=-1)
 
     def run_set_predict(self, goals_2D, scores, mapping, device, loss, i):
         gt_points = mapping[i]['labels'].reshape((self.future_frame_num, 2))
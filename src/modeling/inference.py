@@ -0,0 +1,139 @@
+from typing import Dict, List, Tuple
+
+import numpy as np
+import torch
+from torch import nn, Tensor
+
+import utils
+from modeling.vectornet import VectorNet
+
+# Names of the inputs and outputs of VectorNetInference, in order, for export.
+INPUT_NAMES = ['polylines', 'polyline_mask', 'element_index', 'element_mask', 'lane_mask', 'goals', 'goals_mask']
+OUTPUT_NAMES = ['scores', 'pred_goals', 'pred_trajs']
+
+
+class VectorNetInference(nn.Module):
+    r"""
+    Inference of a trained VectorNet on packed tensors (see pack_inputs), without mapping dicts.
+
+    It shares the weights of the model. The options of args.other_params are read once here, so forward is a fixed
+    graph of tensor operations, which can be exported by torch.jit.trace or torch.onnx.export.
+
+    Goals are the mode_num candidate goals with the highest scores. The goal set optimization of the eval
+    (see goal_optimizer) is not part of the graph. It can still run on the host, on the returned scores.
+    """
+
+    def __init__(self, model: VectorNet, args: utils.Args):
+        super(VectorNetInference, self).__init__()
+        assert 'goals_2D' in args.other_params and 'complete_traj' in args.other_params
+        assert 'variety_loss' not in args.other_params and 'set_predict' not in args.other_params
+        self.model = model
+        self.mode_num = args.mode_num
+        self.lane_gcn = 'laneGCN' in args.other_params
+        self.lane_scoring = 'lane_scoring' in args.other_params
+
+    def forward(self, polylines: Tensor, polyline_mask: Tensor, element_index: Tensor, element_mask: Tensor,
+                lane_mask: Tensor, goals: Tensor, goals_mask: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+        """
+        :param polylines: vectors of all polylines of the batch, padded with zeros (shape [N polylines, T, D])
+        :param polyline_mask: whether every vector is a vector of the polyline (shape [N polylines, T])
+        :param element_index: polyline of every element of every example (shape [batch_size, 'max element num'])
+        :param element_mask: whether every element is an element of the example (shape [batch_size, 'max element num'])
+        :param lane_mask: whether every element is a lane (shape [batch_size, 'max element num'])
+        :param goals: candidate goals (shape [batch_size, 'max goal num', 2])
+        :param goals_mask: whether every goal is a candidate goal of the example (shape [batch_size, 'max goal num'])
+        :return: log scores of the candidate goals (shape [batch_size, 'max goal num']),
+                 predicted goals (shape [batch_size, mode_num, 2]) and trajectories to them
+                 (shape [batch_size, mode_num, future_frame_num, 2]), in the coordinate system of the agent
+        """
+        decoder = self.model.decoder
+        polyline_states = torch.max(self.model.point_level_sub_graph.encode(polylines, polyline_mask), dim=1)[0]
+        inputs = torch.where(element_mask.unsqueeze(-1), polyline_states[element_index],
+                             torch.zeros_like(polyline_states[element_index]))
+        lanes = inputs
+
+        # Lanes attend to the lanes and the target agent, as in VectorNet.forward_encode_sub_graph.
+        if self.lane_gcn:
+            key_mask = lane_mask | (torch.arange(inputs.shape[1], device=inputs.device) == 0).unsqueeze(0)
+            inputs = torch.where(lane_mask.unsqueeze(-1),
+                                 inputs + self.model.laneGCN_A2L(inputs, inputs, key_mask.unsqueeze(1)), inputs)
+
+        hidden_states = self.model.global_graph(inputs, element_mask.unsqueeze(2))
+
+        topk_lanes = None
+        if self.lane_scoring:
+            stage_one_scores = decoder.get_stage_one_scores(lanes, lane_mask, inputs, element_mask, hidden_states)
+            topk_lanes = decoder.select_top_lanes(stage_one_scores, lanes, lane_mask)[:2]
+
+        scores = decoder.score_goals(goals, goals_mask, inputs, element_mask, hidden_states, topk_lanes)
+        _, pred_goal_ids = torch.topk(scores, k=self.mode_num, dim=-1)
+        pred_goals = torch.gather(goals, 1, pred_goal_ids.unsqueeze(-1).expand([goals.shape[0], self.mode_num, 2]))
+        pred_trajs = decoder.complete_trajectories(pred_goals, inputs, element_mask, hidden_states)
+        # The last point of a trajectory is its goal.
+        pred_trajs = torch.cat([pred_trajs[:, :, :-1], pred_goals.unsqueeze(2)], dim=2)
+        return scores, pred_goals, pred_trajs
+
+
+def pack_inputs(mapping: List[Dict], goals_2D: List[np.ndarray] = None) -> Tuple[Tensor, ...]:
+    """
+    Inputs of VectorNetInference for the preprocessed examples of mapping, on the CPU.
+
+    :param goals_2D: candidate goals of every example (value shape ['goal num', 2]), mapping[i]['goals_2D'] if None
+    """
+    batch = mapping if isinstance(mapping, utils.Batch) else utils.Batch(mapping)
+    offsets, lengths = batch.offsets.numpy(), batch.lengths.numpy()
+    positions = np.arange(lengths.max())
+    polyline_mask = positions[np.newaxis, :] < lengths[:, np.newaxis]
+    polylines = np.zeros([len(lengths), len(positions), batch.vectors.shape[1]], dtype=np.float32)
+    polylines[polyline_mask] = batch.vectors.numpy()[(offsets[:, np.newaxis] + positions[np.newaxis, :])[polyline_mask]]
+
+    polyline_nums = np.array(batch.polyline_nums)
+    elements = np.arange(polyline_nums.max())
+    element_mask = elements[np.newaxis, :] < polyline_nums[:, np.newaxis]
+    element_index = np.where(element_mask, np.cumsum(polyline_nums)[:, np.newaxis] - polyline_nums[:, np.newaxis] +
+                             elements[np.newaxis, :], 0)
+    map_start_polyline_idxs = np.array([each['map_start_polyline_idx'] for each in batch])
+    lane_mask = element_mask & (elements[np.newaxis, :] >= map_start_polyline_idxs[:, np.newaxis])
+
+    if goals_2D is None:
+        goals_2D = [each['goals_2D'] for each in batch]
+    goals, goals_lengths = utils.merge_tensors([torch.tensor(each, dtype=torch.float) for each in goals_2D],
+                                               torch.device('cpu'), hidden_size=2)
+    goals_mask = utils.get_length_mask(goals_lengths, goals.shape[1], torch.device('cpu'))
+    return (torch.from_numpy(polylines), torch.from_numpy(polyline_mask), torch.from_numpy(element_index),
+            torch.from_numpy(element_mask), torch.from_numpy(lane_mask), goals, goals_mask)
+
+
+def export_torchscript(engine: VectorNetInference, inputs: Tuple[Tensor, ...], path,
+                       check_inputs: List[Tuple[Tensor, ...]] = ()):
+    """
+    Trace engine on inputs and save it to path, it can be loaded by torch.jit.load without the source.
+
+    :param check_inputs: more inputs, preferably with other batch, polyline and goal numbers, on which the trace
+                         is checked against engine as well as on inputs
+    """
+    with torch.no_grad():
+        traced = torch.jit.trace(engine.eval(), inputs, check_inputs=[inputs] + list(check_inputs))
+    traced.save(path)
+    return traced
+
+
+def export_onnx(engine: VectorNetInference, inputs: Tuple[Tensor, ...], path, opset_version=17):
+    """
+    Export engine to an ONNX model at path, with the batch, polyline, element and goal axes dynamic.
+    """
+    dynamic_axes = {
+        'polylines': {0: 'polyline_num', 1: 'vector_num'},
+        'polyline_mask': {0: 'polyline_num', 1: 'vector_num'},
+        'element_index': {0: 'batch_size', 1: 'element_num'},
+        'element_mask': {0: 'batch_size', 1: 'element_num'},
+        'lane_mask': {0: 'batch_size', 1: 'element_num'},
+        'goals': {0: 'batch_size', 1: 'goal_num'},
+        'goals_mask': {0: 'batch_size', 1: 'goal_num'},
+        'scores': {0: 'batch_size', 1: 'goal_num'},
+        'pred_goals': {0: 'batch_size'},
+        'pred_trajs': {0: 'batch_size'},
+    }
+    with torch.no_grad():
+        torch.onnx.export(engine.eval(), inputs, path, input_names=INPUT_NAMES, output_names=OUTPUT_NAMES,
+                          dynamic_axes=dynamic_axes, opset_version=opset_version)
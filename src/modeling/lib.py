@@ -61,19 +61,53 @@ class GlobalGraph(nn.Module):
         self.value = nn.Linear(hidden_size, self.all_head_size * self.num_qkv)
         if utils.args.attention_decay:
             self.attention_decay = nn.Parameter(torch.ones(1) * 0.5)
+        # See attention.
+        self.fused = utils.args.attention_backend == 'sdpa'
+        if self.fused:
+            assert hasattr(F, 'scaled_dot_product_attention'), 'attention_backend sdpa needs torch >= 2.0'
 
     def get_extended_attention_mask(self, attention_mask):
         """
-        1 in attention_mask stands for doing attention, 0 for not doing attention.
+        1 (or True) in attention_mask stands for doing attention, 0 for not doing attention.
 
         After this function, 1 turns to 0, 0 turns to -10000.0
 
         Because the -10000.0 will be fed into softmax and -10000.0 can be thought as 0 in softmax.
+
+        :param attention_mask: shape [batch, query num, key num], or broadcastable to it,
+                               e.g. [batch, 1, key num] to mask padded keys only
         """
-        extended_attention_mask = attention_mask.unsqueeze(1)
+        extended_attention_mask = attention_mask.unsqueeze(1).float()
         extended_attention_mask = (1.0 - extended_attention_mask) * -10000.0
         return extended_attention_mask
 
+    def attention(self, query_layer, key_layer, value_layer, attention_mask=None, return_probs=False):
+        """
+        Scaled dot-product attention, layers are of shape [batch, num heads, num, head_size].
+
+        With attention_backend sdpa, it runs in one torch.nn.functional.scaled_dot_product_attention call,
+        which doesn't materialize the attention probabilities, so it's only used if they are not returned.
+
+        :return: context layer (shape [batch, num heads, query num, head_size])
+                 and attention probabilities (None if not return_probs)
+        """
+        extended_attention_mask = None
+        if attention_mask is not None:
+            extended_attention_mask = self.get_extended_attention_mask(attention_mask)
+        if self.fused and not return_probs:
+            if extended_attention_mask is not None:
+                extended_attention_mask = extended_attention_mask.to(query_layer.dtype)
+            return F.scaled_dot_product_attention(query_layer, key_layer, value_layer,
+                                                  attn_mask=extended_attention_mask), None
+
+        attention_scores = torch.matmul(
+            query_layer / math.sqrt(self.attention_head_size), key_layer.transpose(-1, -2))
+        if extended_attention_mask is not None:
+            # turn 1 to 0, 0 to -10000.0 in att_mask for softmax - a way to enhance the attention?
+            attention_scores = attention_scores + extended_attention_mask
+        attention_probs = nn.Softmax(dim=-1)(attention_scores) # (batch, num heads, query num, key num)
+        return torch.matmul(attention_probs, value_layer), attention_probs
+
     def transpose_for_scores(self, x):
         sz = x.size()[:-1] + (self.num_attention_heads,
                               self.attention_head_size)
@@ -91,23 +125,18 @@ class GlobalGraph(nn.Module):
         key_layer = self.transpose_for_scores(mixed_key_layer)
         value_layer = self.transpose_for_scores(mixed_value_layer)
 
-        attention_scores = torch.matmul(
-            query_layer / math.sqrt(self.attention_head_size), key_layer.transpose(-1, -2))
-        # print(attention_scores.shape, attention_mask.shape)
-        if attention_mask is not None:
-            # turn 1 to 0, 0 to -10000.0 in att_mask for softmax - a way to enhance the attention?
-            attention_scores = attention_scores + self.get_extended_attention_mask(attention_mask) 
         # if utils.args.attention_decay and utils.second_span:
         #     attention_scores[:, 0, 0, 0] = attention_scores[:, 0, 0, 0] - self.attention_decay
-        attention_probs = nn.Softmax(dim=-1)(attention_scores) # (batch, num heads, max_vector_num, max_vector_num)
-        if utils.args.visualize and mapping is not None:
-            for i, each in enumerate(attention_probs.tolist()):
-                mapping[i]['attention_scores'] = np.array(each[0])
         if utils.args.attention_decay and utils.second_span:
             utils.logging(self.attention_decay, prob=0.01)
             value_layer = torch.cat([value_layer[:, 0:1, 0:1, :] * self.attention_decay, value_layer[:, 0:1, 1:, :]],
                                     dim=2)
-        context_layer = torch.matmul(attention_probs, value_layer)
+        visualize = utils.args.visualize and mapping is not None
+        context_layer, attention_probs = self.attention(query_layer, key_layer, value_layer, attention_mask,
+                                                        return_probs=return_scores or visualize)
+        if visualize:
+            for i, each in enumerate(attention_probs.tolist()):
+                mapping[i]['attention_scores'] = np.array(each[0])
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[
                                   :-2] + (self.all_head_size,)
@@ -140,14 +169,12 @@ class CrossAttention(GlobalGraph):
         key_layer = self.transpose_for_scores(mixed_key_layer)
         value_layer = self.transpose_for_scores(mixed_value_layer)
 
-        attention_scores = torch.matmul(
-            query_layer / math.sqrt(self.attention_head_size), key_layer.transpose(-1, -2))
-        if attention_mask is not None:
-            assert hidden_states_query.shape[1] == attention_mask.shape[1] \
-                   and hidden_states_key.shape[1] == attention_mask.shape[2]
-            attention_scores = attention_scores + self.get_extended_attention_mask(attention_mask)
-        attention_probs = nn.Softmax(dim=-1)(attention_scores)
-        context_layer = torch.matmul(attention_probs, value_layer)
+        # Shape checks on traced tensors would be recorded as constants, see inference.export_torchscript.
+        if attention_mask is not None and not torch.jit.is_tracing():
+            assert attention_mask.shape[1] in (1, hidden_states_query.shape[1]) \
+                   and attention_mask.shape[2] in (1, hidden_states_key.shape[1])
+        context_layer, attention_probs = self.attention(query_layer, key_layer, value_layer, attention_mask,
+                                                        return_probs=return_scores)
         context_layer = context_layer.permute(0, 2, 1, 3).contiguous()
         new_context_layer_shape = context_layer.size()[
                                   :-2] + (self.all_head_size,)
@@ -187,7 +214,8 @@ class PointSubGraph(nn.Module):
         device = hidden_states.device
         predict_agent_num, point_num = hidden_states.shape[0], hidden_states.shape[1]
         hidden_size = self.hidden_size
-        assert (agent.shape[0], agent.shape[1]) == (predict_agent_num, hidden_size)
+        if not torch.jit.is_tracing():
+            assert (agent.shape[0], agent.shape[1]) == (predict_agent_num, hidden_size)
         agent = agent[:, :hidden_size // 2].unsqueeze(1).expand([predict_agent_num, point_num, hidden_size // 2])
         for layer_index, layer in enumerate(self.layers):
             if layer_index == 0:
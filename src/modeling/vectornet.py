@@ -25,20 +25,31 @@ class NewSubGraph(nn.Module):
         self.layers_4 = nn.ModuleList([GlobalGraph(hidden_size) for _ in range(depth)])
         self.layer_0_again = MLP(hidden_size)
 
-    def forward(self, input_list: list):
-        # input_list: [n vectors in batch i, hidden_size] includes all the sub-graphs (agents and polylines)
-        batch_size = len(input_list) # N polylines in batch
-        device = input_list[0].device
-        hidden_states, lengths = utils.merge_tensors(input_list, device) # [N polylines, max(length) T, hidden_size]
-        hidden_size = hidden_states.shape[2]
-        max_vector_num = hidden_states.shape[1]
-
-        attention_mask = torch.zeros([batch_size, max_vector_num, max_vector_num], device=device)
+    def forward(self, vectors: Tensor, offsets: Tensor, lengths: Tensor, max_length: int):
+        """
+        Encode all sub-graphs (agents and lanes) of a batch at once.
+
+        :param vectors: packed vectors, the i-th sub-graph is vectors[offsets[i]:offsets[i] + lengths[i]] (see utils.Batch)
+        :param max_length: max(lengths), passed in to avoid a device sync
+        :return: hidden state of every sub-graph [N polylines, hidden_size], and of every vector in them
+        """
+        assert bool(torch.all(lengths > 0))
+        positions = torch.arange(max_length, device=vectors.device)
+        valid = positions.unsqueeze(0) < lengths.unsqueeze(1)  # [N polylines, max(length) T]
+        hidden_states = torch.zeros([len(lengths), max_length, vectors.shape[1]], device=vectors.device)
+        hidden_states[valid] = vectors[(offsets.unsqueeze(1) + positions.unsqueeze(0))[valid]]
+        hidden_states = self.encode(hidden_states, valid)
+        return torch.max(hidden_states, dim=1)[0], hidden_states[valid]
+
+    def encode(self, hidden_states: Tensor, valid: Tensor):
+        """
+        :param hidden_states: vectors of the sub-graphs, padded with zeros (shape [N polylines, max(length) T, hidden_size])
+        :param valid: whether every vector is a vector of the sub-graph (shape [N polylines, max(length) T])
+        :return: hidden state of every vector (shape [N polylines, max(length) T, hidden_size])
+        """
+        attention_mask = valid.unsqueeze(2) & valid.unsqueeze(1)
         hidden_states = self.layer_0(hidden_states)
         hidden_states = self.layer_0_again(hidden_states)
-        for i in range(batch_size):
-            assert lengths[i] > 0
-            attention_mask[i, :lengths[i], :lengths[i]].fill_(1)
 
         for layer_index, layer in enumerate(self.layers):
             temp = hidden_states
@@ -50,7 +61,7 @@ class NewSubGraph(nn.Module):
             hidden_states = hidden_states + temp
             hidden_states = self.layers_2[layer_index](hidden_states)
 
-        return torch.max(hidden_states, dim=1)[0], torch.cat(utils.de_merge_tensors(hidden_states, lengths))
+        return hidden_states
 
 
 class VectorNet(nn.Module):
@@ -87,42 +98,23 @@ class VectorNet(nn.Module):
             self.decoder.complete_traj_cross_attention = CrossAttention(hidden_size)
             self.decoder.complete_traj_decoder = DecoderResCat(hidden_size, hidden_size * 3, out_features=self.decoder.future_frame_num * 2)
 
-    def forward_encode_sub_graph(self, mapping: List[Dict], matrix: List[np.ndarray], polyline_spans: List[List[slice]],
-                                 device, batch_size) -> Tuple[List[Tensor], List[Tensor]]:
+    def forward_encode_sub_graph(self, mapping: utils.Batch, device, batch_size) -> Tuple[List[Tensor], List[Tensor]]:
         """
-        :param matrix: each value in list is vectors of all element (shape [-1, 128])
-        :param polyline_spans: vectors of i_th element is matrix[polyline_spans[i]]
+        :param mapping: its vectors are the polylines of all elements, packed (see utils.Batch)
         :return: hidden states of all elements and hidden states of lanes
         """
-        input_list_list = []
-        # TODO(cyrushx): This is not used? Is it because input_list_list includes map data as well?
-        # Yes, input_list_list includes map data, this will be used in the future release.
-        map_input_list_list = []
-        lane_states_batch = None
-        for i in range(batch_size):
-            input_list = []
-            map_input_list = []
-            map_start_polyline_idx = mapping[i]['map_start_polyline_idx']
-            for j, polyline_span in enumerate(polyline_spans[i]):
-                tensor = torch.tensor(matrix[i][polyline_span], device=device)
-                input_list.append(tensor)
-                if j >= map_start_polyline_idx:
-                    map_input_list.append(tensor)
-
-            input_list_list.append(input_list)
-            map_input_list_list.append(map_input_list)
-
-        if True:
-            element_states_batch = []
-            for i in range(batch_size):
-                a, b = self.point_level_sub_graph(input_list_list[i])
-                element_states_batch.append(a)
+        lengths = mapping.lengths
+        max_length = int(lengths.max())
+        packed = mapping.to(device)
+        # One pass over the sub-graphs of all examples. The padding length is the longest polyline in the batch,
+        # which is the 19 vectors of the AGENT history in every Argoverse example.
+        element_states, _ = self.point_level_sub_graph(packed.vectors, packed.offsets, packed.lengths, max_length)
+        element_states_batch = list(torch.split(element_states, mapping.polyline_nums))
 
+        lane_states_batch = None
         if 'lane_scoring' in args.other_params:
-            lane_states_batch = []
-            for i in range(batch_size):
-                a, b = self.point_level_sub_graph(map_input_list_list[i])
-                lane_states_batch.append(a)
+            # Lanes are sub-graphs of their own, so their states are those of the single pass above.
+            lane_states_batch = [element_states_batch[i][mapping[i]['map_start_polyline_idx']:] for i in range(batch_size)]
 
         # We follow laneGCN to fuse realtime traffic information from agent nodes to lane nodes.
         if 'laneGCN' in args.other_params:
@@ -142,34 +134,32 @@ class VectorNet(nn.Module):
         return element_states_batch, lane_states_batch
 
     # @profile
-    def forward(self, mapping: List[Dict], device):
+    def forward(self, mapping: List[Dict], device, pipeline=False):
+        """
+        :param pipeline: see Decoder.forward
+        """
         import time
         global starttime
         starttime = time.time()
 
-        matrix = utils.get_from_mapping(mapping, 'matrix') # Batch x Vector x 128
-        # TODO(cyrushx): Can you explain the structure of polyline spans?
-        # vectors of i_th element is matrix[polyline_spans[i]]
-        polyline_spans = utils.get_from_mapping(mapping, 'polyline_spans') # Batch x Polyline (20 vectors)
-
-        batch_size = len(matrix)
-        # for i in range(batch_size):
-        # polyline_spans[i] = [slice(polyline_span[0], polyline_span[1]) for polyline_span in polyline_spans[i]]
+        if not isinstance(mapping, utils.Batch):
+            mapping = utils.batch_list_to_batch_tensors(mapping)
+        batch_size = len(mapping)
 
         if args.argoverse:
             utils.batch_init(mapping)
 
-        element_states_batch, lane_states_batch = self.forward_encode_sub_graph(mapping, matrix, polyline_spans, device, batch_size)
+        element_states_batch, lane_states_batch = self.forward_encode_sub_graph(mapping, device, batch_size)
 
         inputs, inputs_lengths = utils.merge_tensors(element_states_batch, device=device)
-        max_poly_num = max(inputs_lengths)
-        attention_mask = torch.zeros([batch_size, max_poly_num, max_poly_num], device=device)
-        for i, length in enumerate(inputs_lengths):
-            attention_mask[i][:length][:length].fill_(1)
+        # Elements attend to all elements of the padded batch and padding attends to nothing, as with the
+        # [batch_size, max_poly_num, max_poly_num] mask whose first inputs_lengths[i] rows were filled with 1.
+        attention_mask = utils.get_length_mask(inputs_lengths, inputs.shape[1], device).unsqueeze(2)
 
         # Output of VectorNet3
         hidden_states = self.global_graph(inputs, attention_mask, mapping)
 
         utils.logging('time3', round(time.time() - starttime, 2), 'secs')
 
-        return self.decoder(mapping, batch_size, lane_states_batch, inputs, inputs_lengths, hidden_states, device)
+        return self.decoder(mapping, batch_size, lane_states_batch, inputs, inputs_lengths, hidden_states, device,
+                            pipeline=pipeline)
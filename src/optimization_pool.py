@@ -0,0 +1,161 @@
+import atexit
+import multiprocessing
+from multiprocessing import Process, resource_tracker, shared_memory
+from queue import Empty
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+import goal_optimizer
+import utils_cython
+
+# Restarts of the Cython optimizer per example, the best one is kept.
+RUN_TIMES = 8
+
+
+def get_optimal_targets(args, goals_2D: np.ndarray, scores: np.ndarray, file_name):
+    """
+    Goal set optimization of one example (see utils.select_goals_by_optimization), running all restarts here.
+
+    :param scores: log probabilities of goals
+    :return: (expectation, ans_points, pred_probs) of the best restart
+    """
+    objective = 'MR'
+    MRratio = 1.0
+    if 'MRminFDE' in args.other_params:
+        objective = 'MRminFDE'
+        MRratio = float(args.other_params['MRminFDE']) if args.other_params['MRminFDE'] is not True else 1.0
+    opti_time = float(args.other_params.get('opti_time', 10000.0))
+    scores = np.exp(scores)
+
+    kwargs = {}
+    if 'cnt_sample' in args.other_params:
+        assert args.other_params['cnt_sample'] > 1
+        kwargs.update(dict(
+            num_step=1000,
+            cnt_sample=args.other_params['cnt_sample'],
+            MRratio=MRratio,
+        ))
+
+    if 'opti_vectorized' in args.other_params:
+        # The vectorized optimizer runs its restarts as chains of a single call.
+        kwargs['mode_num'] = args.mode_num
+        return goal_optimizer.get_optimal_targets(goals_2D, scores, objective, opti_time, kwargs=kwargs)
+
+    best_results = None
+    for _ in range(RUN_TIMES):
+        # The Cython optimizer filters goals_2D and scores in place.
+        results = utils_cython.get_optimal_targets(goals_2D.copy(), scores.copy(), file_name, objective, opti_time,
+                                                   kwargs=kwargs.copy())
+        if best_results is None or results[0] < best_results[0]:
+            best_results = results
+    return best_results
+
+
+def _attach(name):
+    shm = shared_memory.SharedMemory(name=name)
+    # The block is owned (and unlinked) by the pool, so this process must not track it.
+    resource_tracker.unregister(shm._name, 'shared_memory')
+    return shm
+
+
+def run_worker(args, queue, queue_res):
+    utils_cython.args = args
+    while True:
+        task = queue.get()
+        if task is None:
+            break
+        batch_id, i, shm_name, total, start, end, file_name = task
+        shm = _attach(shm_name)
+        array = np.ndarray([total, 3], dtype=np.float32, buffer=shm.buf)
+        goals_2D = array[start:end, :2].copy()
+        scores = array[start:end, 2].copy()
+        del array
+        shm.close()
+
+        queue_res.put((batch_id, i, get_optimal_targets(args, goals_2D, scores, file_name)))
+
+
+class GoalOptimizationPool:
+    """
+    Persistent worker processes for the goal set optimization of eval batches.
+
+    submit copies the goals and scores of a batch into one shared memory block and returns at once, every example
+    is a single task. get blocks until all examples of a batch are optimized, so the caller can run the model on
+    the next batch in between.
+    """
+
+    def __init__(self, args, core_num):
+        self.queue = multiprocessing.Queue()
+        self.queue_res = multiprocessing.Queue()
+        self.processes = [Process(target=run_worker, args=(args, self.queue, self.queue_res), daemon=True)
+                          for _ in range(core_num)]
+        for each in self.processes:
+            each.start()
+        self.batches: Dict[int, dict] = {}
+        self.next_batch_id = 0
+        self.closed = False
+
+    def submit(self, goals_2D_scores_batch: List[Tuple[np.ndarray, np.ndarray]], file_names: List[str]) -> int:
+        """
+        :param goals_2D_scores_batch: goals (shape ['goal num', 2]) and their log scores of every example
+        :return: id of the batch, for get
+        """
+        assert not self.closed
+        lengths = [len(scores) for _, scores in goals_2D_scores_batch]
+        ends = np.cumsum(lengths)
+        total = int(ends[-1])
+        shm = shared_memory.SharedMemory(create=True, size=max(total * 3 * 4, 1))
+        array = np.ndarray([total, 3], dtype=np.float32, buffer=shm.buf)
+        for i, (goals_2D, scores) in enumerate(goals_2D_scores_batch):
+            array[ends[i] - lengths[i]:ends[i], :2] = goals_2D
+            array[ends[i] - lengths[i]:ends[i], 2] = scores
+        del array
+
+        batch_id = self.next_batch_id
+        self.next_batch_id += 1
+        self.batches[batch_id] = dict(shm=shm, results=[None] * len(lengths), remaining=len(lengths))
+        for i in range(len(lengths)):
+            self.queue.put((batch_id, i, shm.name, total, int(ends[i] - lengths[i]), int(ends[i]), file_names[i]))
+        return batch_id
+
+    def _receive(self):
+        try:
+            batch_id, i, results = self.queue_res.get(timeout=10)
+        except Empty:
+            assert all(each.is_alive() for each in self.processes), 'a goal optimization worker died'
+            return
+        batch = self.batches[batch_id]
+        batch['results'][i] = results
+        batch['remaining'] -= 1
+
+    def get(self, batch_id) -> List[tuple]:
+        """
+        :return: (expectation, ans_points, pred_probs) of every example of the batch
+        """
+        batch = self.batches[batch_id]
+        while batch['remaining'] > 0:
+            self._receive()
+        del self.batches[batch_id]
+        batch['shm'].close()
+        batch['shm'].unlink()
+        return batch['results']
+
+    def close(self):
+        if self.closed:
+            return
+        self.closed = True
+        for _ in self.processes:
+            self.queue.put(None)
+        for each in self.processes:
+            each.join()
+        for batch in self.batches.values():
+            batch['shm'].close()
+            batch['shm'].unlink()
+        self.batches.clear()
+
+
+def create_pool(args, core_num) -> GoalOptimizationPool:
+    pool = GoalOptimizationPool(args, core_num)
+    atexit.register(pool.close)
+    return pool
@@ -95,16 +95,18 @@ def gather_and_output_motion_metrics(args, device, queue, motion_metrics, metric
 
 def gather_and_output_others(args, device, queue, motion_metrics):
     if is_main_device(device):
+        utils.sync_other_errors()
         for i in range(args.distributed_training - 1):
             other_errors_dict_ = queue.get()
-            for key in utils.other_errors_dict:
-                utils.other_errors_dict[key].extend(other_errors_dict_[key])
+            for key, value in other_errors_dict_.items():
+                utils.other_errors_dict[key].extend(value)
 
         score_file = score_file = utils.get_eval_identifier()
         utils.logging('other_errors {}'.format(utils.other_errors_to_string()),
                       type=score_file, to_screen=True, append_time=True)
 
     else:
+        utils.sync_other_errors()
         queue.put(utils.other_errors_dict)
 
 
@@ -151,6 +153,7 @@ def train_one_epoch(model, iter_bar, optimizer, device, args: utils.Args, i_epoc
     li_ADE = []
     li_FDE = []
     utils.other_errors_dict.clear()
+    utils.other_errors_tensors.clear()
     start_time = time.time()
     if 'data_ratio_per_epoch' in args.other_params:
         max_iter_num = int(float(args.other_params['data_ratio_per_epoch']) * len(iter_bar))
@@ -190,11 +193,13 @@ def train_one_epoch(model, iter_bar, optimizer, device, args: utils.Args, i_epoc
 
     if args.argoverse:
         if is_main_device(device):
+            utils.sync_other_errors()
             for i in range(args.distributed_training - 1):
                 other_errors_dict_ = queue.get()
-                for key in utils.other_errors_dict:
-                    utils.other_errors_dict[key].extend(other_errors_dict_[key])
+                for key, value in other_errors_dict_.items():
+                    utils.other_errors_dict[key].extend(value)
         else:
+            utils.sync_other_errors()
             queue.put(utils.other_errors_dict)
 
     if is_main_device(device):
@@ -259,7 +264,9 @@ def demo_basic(rank, world_size, kwargs, queue):
         train_dataloader = torch.utils.data.DataLoader(
             train_dataset, sampler=train_sampler,
             batch_size=args.train_batch_size // world_size,
-            collate_fn=utils.batch_list_to_batch_tensors)
+            collate_fn=utils.batch_list_to_batch_tensors,
+            num_workers=args.data_workers,
+            pin_memory=torch.cuda.is_available() and not args.no_cuda)
 
     for i_epoch in range(int(args.num_train_epochs)):
         if 'complete_traj-3' in args.other_params:
@@ -0,0 +1,324 @@
+import hashlib
+import json
+import os
+import pickle
+from collections import OrderedDict
+from typing import Dict
+
+import numpy as np
+
+# Version of the layout below, part of the preprocess key (see dataset_argoverse.get_preprocess_key).
+CACHE_VERSION = 2
+
+# Per-scenario arrays, stored as one flat column each: key -> (dtype, row width).
+# The row width of 'matrix' is args.hidden_size and is recorded in the layout file.
+# labels and polygons keep float64, since get_masked_mapping rebuilds goals_2D and the goal labels from them.
+ARRAY_FIELDS = {
+    'matrix': (np.float32, None),
+    'goals_2D': (np.float32, 2),
+    'labels': (np.float64, 2),
+    'origin_labels': (np.float64, 2),
+}
+
+# Per-scenario lists of [n, 2] point arrays (lanes, agent histories, ...): key -> dtype.
+LIST_FIELDS = {
+    'polygons': np.float64,
+    'agents': np.float32,
+    'trajs': np.float32,
+    'vis_lanes': np.float32,
+}
+
+LAYOUT_FILE = 'layout.json'
+# Source files of a shard, see load_manifest.
+SHARD_FILES = 'files.json'
+
+MAX_OPEN_SHARDS = 32
+
+
+def _open_memmap(path, dtype, width=1):
+    if os.path.getsize(path) == 0:
+        # np.memmap cannot map empty files.
+        return np.zeros((0, width), dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode='r').reshape([-1, width])
+
+
+def _span(ends, idx):
+    return (int(ends[idx - 1]) if idx > 0 else 0), int(ends[idx])
+
+
+class _ColumnWriter:
+    """
+    Append-only column: rows go to '<name>.bin', the end row of every record goes to '<name>.idx'.
+
+    For list fields every element is a record, and the end record of every scenario goes to '<name>.groups'.
+    """
+
+    def __init__(self, path, dtype, width, grouped=False):
+        self.dtype = dtype
+        self.width = width
+        self.data_file = open(path + '.bin', 'ab')
+        self.index_file = open(path + '.idx', 'ab')
+        self.group_file = open(path + '.groups', 'ab') if grouped else None
+        self.rows = self.data_file.tell() // (np.dtype(dtype).itemsize * width)
+        self.records = self.index_file.tell() // 8
+
+    def append(self, array):
+        array = np.ascontiguousarray(array, dtype=self.dtype).reshape([-1, self.width])
+        self.data_file.write(array.tobytes())
+        self.rows += len(array)
+        self.records += 1
+        self.index_file.write(np.int64(self.rows).tobytes())
+
+    def end_group(self):
+        self.group_file.write(np.int64(self.records).tobytes())
+
+    def close(self):
+        self.data_file.close()
+        self.index_file.close()
+        if self.group_file is not None:
+            self.group_file.close()
+
+
+class _Column:
+    def __init__(self, path, dtype, width, grouped=False):
+        self.ends = _open_memmap(path + '.idx', np.int64).reshape([-1])
+        self.data = _open_memmap(path + '.bin', dtype, width)
+        self.group_ends = _open_memmap(path + '.groups', np.int64).reshape([-1]) if grouped else None
+
+    def __len__(self):
+        return len(self.ends)
+
+    def __getitem__(self, idx):
+        start, end = _span(self.ends, idx)
+        return self.data[start:end]
+
+    def group(self, idx):
+        """
+        All records of the idx-th scenario of a list field.
+        """
+        start, end = _span(self.group_ends, idx)
+        return [self[i] for i in range(start, end)]
+
+
+class ScenarioCacheWriter:
+    """
+    Write preprocessed scenarios (see dataset_argoverse.preprocess) into a columnar cache directory.
+
+    Large arrays are stored as flat columns (see ARRAY_FIELDS and LIST_FIELDS), polyline spans as an offset index,
+    and the remaining small values of each mapping are pickled into the 'meta' column.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        os.makedirs(directory, exist_ok=True)
+        self.layout = None
+        self.columns: Dict[str, _ColumnWriter] = {}
+        self.size = 0
+
+    def _init_layout(self, mapping):
+        self.layout = dict(
+            arrays={key: np.dtype(dtype).name for key, (dtype, _) in ARRAY_FIELDS.items() if key in mapping},
+            lists={key: np.dtype(dtype).name for key, dtype in LIST_FIELDS.items() if key in mapping},
+            hidden_size=int(mapping['matrix'].shape[1]),
+        )
+        with open(os.path.join(self.directory, LAYOUT_FILE), 'w') as file:
+            json.dump(self.layout, file)
+
+        def add_column(name, dtype, width, grouped=False):
+            self.columns[name] = _ColumnWriter(os.path.join(self.directory, name), dtype, width, grouped)
+
+        for key in self.layout['arrays']:
+            add_column(key, ARRAY_FIELDS[key][0], ARRAY_FIELDS[key][1] or self.layout['hidden_size'])
+        for key in self.layout['lists']:
+            add_column(key, LIST_FIELDS[key], 2, grouped=True)
+        add_column('polyline_spans', np.int32, 2)
+        add_column('meta', np.uint8, 1)
+
+    def append(self, mapping: Dict):
+        if self.layout is None:
+            self._init_layout(mapping)
+        meta = {}
+        for key, value in mapping.items():
+            if key in self.layout['arrays']:
+                self.columns[key].append(value)
+            elif key in self.layout['lists']:
+                for each in value:
+                    self.columns[key].append(each)
+                self.columns[key].end_group()
+            elif key == 'polyline_spans':
+                self.columns[key].append([[each.start, each.stop] for each in value])
+            else:
+                meta[key] = value
+        assert len(meta) + len(self.layout['arrays']) + len(self.layout['lists']) + 1 == len(mapping)
+        self.columns['meta'].append(np.frombuffer(pickle.dumps(meta), dtype=np.uint8))
+        self.size += 1
+
+    def close(self):
+        for each in self.columns.values():
+            each.close()
+
+
+class ScenarioCache:
+    """
+    Read-only view of a cache directory written by ScenarioCacheWriter.
+
+    Columns are opened with np.memmap, so processes reading the same cache share the page cache.
+    Items are rebuilt as mapping dicts whose arrays are views into the memory-mapped columns.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        with open(os.path.join(directory, LAYOUT_FILE)) as file:
+            self.layout = json.load(file)
+        self.columns = None
+        self.size = len(self._open()['meta'])
+
+    def _open(self) -> Dict[str, _Column]:
+        if self.columns is None:
+            def column(name, dtype, width, grouped=False):
+                return _Column(os.path.join(self.directory, name), dtype, width, grouped)
+
+            columns = {}
+            for key, dtype in self.layout['arrays'].items():
+                columns[key] = column(key, dtype, ARRAY_FIELDS[key][1] or self.layout['hidden_size'])
+            for key, dtype in self.layout['lists'].items():
+                columns[key] = column(key, dtype, 2, grouped=True)
+            columns['polyline_spans'] = column('polyline_spans', np.int32, 2)
+            columns['meta'] = column('meta', np.uint8, 1)
+            self.columns = columns
+        return self.columns
+
+    def __getstate__(self):
+        # Memory maps are reopened in the receiving process instead of being pickled as copies.
+        state = self.__dict__.copy()
+        state['columns'] = None
+        return state
+
+    def close(self):
+        self.columns = None
+
+    def __len__(self):
+        return self.size
+
+    def __getitem__(self, idx) -> Dict:
+        columns = self._open()
+        mapping = pickle.loads(columns['meta'][idx].tobytes())
+        for key in self.layout['arrays']:
+            mapping[key] = columns[key][idx]
+        for key in self.layout['lists']:
+            mapping[key] = columns[key].group(idx)
+        mapping['polyline_spans'] = [slice(int(each[0]), int(each[1])) for each in columns['polyline_spans'][idx]]
+        return mapping
+
+
+def get_shard_dir(directory, shard_idx):
+    return os.path.join(directory, 'shard_{:05d}'.format(shard_idx))
+
+
+def load_manifest(directory) -> Dict[str, list]:
+    """
+    Merge the file lists of all finished shards of a cache directory.
+
+    Every shard lists the source files it was built from as {file: [hash, size, mtime_ns, row]},
+    where row is -1 if the file gave no valid scenario. If a file was rebuilt, the latest shard wins.
+    A shard without scenarios can also list files whose size or mtime changed but whose content did not,
+    as {file: [hash, size, mtime_ns, row, shard_name]} with the shard that holds the row.
+
+    Returns {file: [shard_name, hash, size, mtime_ns, row, listing_shard_name]}.
+    """
+    manifest = {}
+    if not os.path.exists(directory):
+        return manifest
+    for shard_name in sorted(os.listdir(directory)):
+        path = os.path.join(directory, shard_name, SHARD_FILES)
+        if shard_name.startswith('shard_') and os.path.exists(path):
+            with open(path) as file:
+                for source_file, entry in json.load(file).items():
+                    manifest[source_file] = [entry[4] if len(entry) > 4 else shard_name] + entry[:4] + [shard_name]
+    return manifest
+
+
+class ShardedScenarioCache:
+    """
+    Scenarios spread over the shards of a cache directory, read as one dataset.
+
+    items lists the (shard_name, row) of every scenario in dataset order. At most MAX_OPEN_SHARDS shards
+    are memory-mapped at a time, since every mapped column holds a file descriptor.
+    """
+
+    def __init__(self, directory, items):
+        self.directory = directory
+        self.items = items
+        self.shards = OrderedDict()
+
+    def _get_shard(self, shard_name) -> ScenarioCache:
+        if shard_name in self.shards:
+            self.shards.move_to_end(shard_name)
+        else:
+            if len(self.shards) >= MAX_OPEN_SHARDS:
+                self.shards.popitem(last=False)[1].close()
+            self.shards[shard_name] = ScenarioCache(os.path.join(self.directory, shard_name))
+        return self.shards[shard_name]
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['shards'] = OrderedDict()
+        return state
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, idx) -> Dict:
+        shard_name, row = self.items[idx]
+        return self._get_shard(shard_name)[row]
+
+
+class DiskLRU:
+    """
+    Bounded on-disk cache of pickled values, which can be shared by several processes.
+
+    The modification time of a file marks its last use, and the least recently used files are evicted.
+    """
+
+    def __init__(self, directory, size):
+        self.directory = directory
+        self.size = size
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.directory, hashlib.sha1(key.encode()).hexdigest() + '.pkl')
+
+    def get(self, key):
+        """
+        Returns (True, value) on a hit and (False, None) on a miss.
+        """
+        path = self._path(key)
+        try:
+            with open(path, 'rb') as file:
+                value = pickle.load(file)
+            os.utime(path)
+        except (FileNotFoundError, EOFError):
+            return False, None
+        return True, value
+
+    def put(self, key, value):
+        path = self._path(key)
+        temp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(temp_path, 'wb') as file:
+            pickle.dump(value, file, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(temp_path, path)
+
+        names = [name for name in os.listdir(self.directory) if name.endswith('.pkl')]
+        if len(names) > self.size:
+            mtimes = []
+            for name in names:
+                try:
+                    mtimes.append((os.path.getmtime(os.path.join(self.directory, name)), name))
+                except FileNotFoundError:
+                    pass
+            for _, name in sorted(mtimes)[:len(mtimes) - self.size]:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    # Already evicted by another process.
+                    pass
@@ -1,4 +1,5 @@
 import argparse
+import copy
 import inspect
 import json
 import math
@@ -28,6 +29,8 @@ from matplotlib.pyplot import MultipleLocator
 from torch import Tensor
 
 import utils_cython, structs
+from frame_transform import Frame
+import optimization_pool
 
 from argoverse.map_representation.map_api import ArgoverseMap
 from argoverse.utils.centerline_utils import get_centerlines_most_aligned_with_trajectory, is_overlapping_lane_seq, remove_overlapping_lane_seq
@@ -148,6 +151,10 @@ def add_argument(parser):
     parser.add_argument("--core_num",
                         default=16,
                         type=int)
+    parser.add_argument("--data_workers",
+                        default=0,
+                        type=int,
+                        help="num_workers of the DataLoaders, useful with '--other_params lazy_preprocess'")
     parser.add_argument("--visualize",
                         action='store_true')
     parser.add_argument("--train_extra",
@@ -165,6 +172,10 @@ def add_argument(parser):
                         default=None)
     parser.add_argument("--attention_decay",
                         action='store_true')
+    parser.add_argument("--attention_backend",
+                        default='math',
+                        choices=['math', 'sdpa'],
+                        help="sdpa runs attention in torch.nn.functional.scaled_dot_product_attention")
     parser.add_argument("--placeholder",
                         default=0.0,
                         type=float)
@@ -249,6 +260,7 @@ class Args:
     no_agents = None
     not_use_api = None
     core_num = None
+    data_workers = None
     visualize = None
     train_extra = None
     hidden_dropout_prob = None
@@ -257,6 +269,7 @@ class Args:
     lstm = None
     add_prefix = None
     attention_decay = None
+    attention_backend = None
     do_test = None
     placeholder = None
     multi = None
@@ -401,9 +414,6 @@ def get_name(name='', append_time=False):
 
 eps = 1e-5
 
-origin_point = None
-origin_angle = None
-
 
 def get_pad_vector(li):
     """
@@ -414,8 +424,61 @@ def get_pad_vector(li):
     return li
 
 
+class Batch:
+    """
+    The mapping dicts of a batch, with the polylines of all examples packed into one float32 tensor.
+
+    vectors[offsets[k]:offsets[k] + lengths[k]] is the k-th polyline of the batch, and example i owns the
+    polyline_nums[i] polylines after those of the examples before it.
+
+    It is indexed and iterated like the list of mapping dicts but is not a Sequence, so that DataLoader(pin_memory=True)
+    calls its pin_memory. Older torch versions rebuild a Sequence element by element instead, dropping the tensors.
+    """
+
+    def __init__(self, mapping: List[Dict]):
+        self.mapping = list(mapping)
+        matrices = [each['matrix'] for each in self]
+        polyline_spans = [each['polyline_spans'] for each in self]
+        row_offsets = np.cumsum([0] + [len(matrix) for matrix in matrices[:-1]])
+        self.vectors = torch.from_numpy(np.concatenate(matrices).astype(np.float32, copy=False))
+        self.offsets = torch.tensor([row_offset + span.start for row_offset, spans in zip(row_offsets, polyline_spans)
+                                     for span in spans], dtype=torch.long)
+        self.lengths = torch.tensor([span.stop - span.start for spans in polyline_spans for span in spans],
+                                    dtype=torch.long)
+        self.polyline_nums = [len(spans) for spans in polyline_spans]
+
+    def __len__(self):
+        return len(self.mapping)
+
+    def __getitem__(self, idx):
+        return self.mapping[idx]
+
+    def __iter__(self):
+        return iter(self.mapping)
+
+    def _with_tensors(self, function):
+        # copy.copy keeps the mapping dicts and the attributes without calling __init__.
+        batch = copy.copy(self)
+        batch.vectors, batch.offsets, batch.lengths = [function(each) for each in
+                                                       (self.vectors, self.offsets, self.lengths)]
+        return batch
+
+    def pin_memory(self):
+        """
+        Called by torch.utils.data.DataLoader(pin_memory=True).
+        """
+        return self._with_tensors(lambda tensor: tensor.pin_memory())
+
+    def to(self, device):
+        """
+        Non-blocking if the tensors are pinned.
+        """
+        return self._with_tensors(lambda tensor: tensor.to(device, non_blocking=True))
+
+
 def batch_list_to_batch_tensors(batch):
-    return [each for each in batch]
+    # Scenarios preprocessed on demand are None if the file has no valid scenario.
+    return Batch([each for each in batch if each is not None])
 
 
 def batch_list_to_batch_tensors_old(batch):
@@ -581,173 +644,157 @@ class CustomMarker(Path):
         super().__init__(vertices, codes=svgpath2mpl.parse_path(svg).codes)
 
 
-def clustering(mapping, goals_2D, scores: np.ndarray, future_frame_num, predict: np.ndarray = None, max_guesses=None): 
-    predict = predict.reshape([args.mode_num, future_frame_num, 2])  
-    lanes = [] 
-    lanes_dir = []
-    agent_lanes_dir = []
-    distances_list = []
-    closest_point_per_lane_list = []
-    confidences = [] 
-    lanes_threshold = 2.5
-    
-    # Compute probabilities
-    goals = [[each[-1,0], each[-1,1]] for each in predict]
-    def do_kdtree(combined_x_y_arrays,points):
-        mytree = scipy.spatial.cKDTree(combined_x_y_arrays)
-        dist, indexes = mytree.query(points)
-        return indexes
-    goals2goals2D = [np.array(np.floor(g)) for g in goals]
-    #find the scores for these goals
-    score_indexes = do_kdtree(goals_2D,goals2goals2D).tolist() # log_probabilities
-    goals_probs = scipy.special.softmax(scores[score_indexes]) # probabilities of the 12 predicted goals (sum up to 1) 
+# Lanes whose ends are closer than this belong to the same intention.
+LANES_THRESHOLD = 2.5
+
+
+def get_local_lanes(mapping, points: np.ndarray):
+    """
+    Nearest centerlines (am.get_nearest_centerline) of every point of a scenario.
+
+    Every lane is converted to the normalized coordinate system once, however many points it is near.
+
+    :param points: shape ['point num', 2], in the normalized coordinate system
+    :return: (lane ids, confidences, distances) of every point, and the centerlines of all these lanes
+    """
+    frame = Frame.from_mapping(mapping)
+    lookups = []
+    local_lanes = {}
+    for point in frame.to_world(points):
+        lane_ids, conf, lines, distances = am.get_nearest_centerline(point, visualize=False, name=None,
+                                                                     city_name=mapping['city_name'])
+        for lane_id, line in zip(lane_ids, lines):
+            if lane_id not in local_lanes:
+                local_lanes[lane_id] = frame.to_frame(line)
+        lookups.append((list(lane_ids), list(conf), list(distances)))
+    return lookups, local_lanes
+
+
+def get_lane_directions(lines: List[np.ndarray], points: np.ndarray):
+    """
+    Direction of every lane at its two waypoints closest to the corresponding point, for all lanes at once.
+
+    :param points: shape ['lane num', 2]
+    :return: shape ['lane num', 2]
+    """
+    lengths = np.array([len(line) for line in lines])
+    padded = np.full([len(lines), lengths.max(), 2], np.nan, dtype=np.result_type(*lines))
+    for i, line in enumerate(lines):
+        padded[i, :len(line)] = line
+    dis = np.linalg.norm(padded - points[:, np.newaxis, :], axis=-1)
+    dis[np.isnan(dis)] = np.inf
+    closest_waypt_idxs = np.minimum(np.argsort(dis, axis=1, kind='stable')[:, :2], lengths[:, np.newaxis] - 1)
+    lane_idxs = np.arange(len(lines))
+    prev_waypoints = padded[lane_idxs, closest_waypt_idxs.min(axis=1)]
+    next_waypoints = padded[lane_idxs, closest_waypt_idxs.max(axis=1)]
+    return next_waypoints - prev_waypoints
+
+
+def get_lane_components(lane_ids: List, local_lanes: Dict[Any, np.ndarray], lanes_threshold=LANES_THRESHOLD):
+    """
+    Union-find over lanes, where two lanes are adjacent if an end of one is within lanes_threshold of the other one
+    (end to end, end to start or start to end).
+
+    :return: {lane id: component}, components are numbered by their first lane in lane_ids
+    """
+    starts = np.array([local_lanes[lane_id][0] for lane_id in lane_ids], dtype=np.float64)
+    ends = np.array([local_lanes[lane_id][-1] for lane_id in lane_ids], dtype=np.float64)
+
+    def get_dis(a, b):
+        return np.linalg.norm(a[:, np.newaxis, :] - b[np.newaxis, :, :], axis=-1)
+
+    adjacent = np.minimum(np.minimum(get_dis(ends, ends), get_dis(ends, starts)), get_dis(starts, ends)) < lanes_threshold
+
+    parents = list(range(len(lane_ids)))
+
+    def find(i):
+        while parents[i] != i:
+            parents[i] = parents[parents[i]]
+            i = parents[i]
+        return i
+
+    for i, j in zip(*np.nonzero(np.triu(adjacent, 1))):
+        root_i, root_j = find(i), find(j)
+        # The smaller root is kept, so that the root of a component is its first lane.
+        parents[max(root_i, root_j)] = min(root_i, root_j)
+
+    roots = [find(i) for i in range(len(lane_ids))]
+    component_ids = {root: idx for idx, root in enumerate(sorted(set(roots)))}
+    return {lane_id: component_ids[root] for lane_id, root in zip(lane_ids, roots)}
+
+
+def clustering(mapping, goals_2D, scores: np.ndarray, future_frame_num, predict: np.ndarray = None, max_guesses=None):
+    """
+    Cluster the predicted trajectories into intentions, the connected sets of lanes near their endpoints.
+
+    The nearest lanes of every endpoint are looked up once per scenario (get_local_lanes), lanes against the
+    direction of the trajectory are dropped, and the remaining lanes of all modes are merged by get_lane_components.
+    """
+    predict = predict.reshape([args.mode_num, future_frame_num, 2])
+
+    # Probabilities of the predicted goals, from the scores of their nearest goals of goals_2D
+    score_indexes = scipy.spatial.cKDTree(goals_2D).query(np.floor(predict[:, -1]))[1]
+    goals_probs = scipy.special.softmax(scores[score_indexes])  # sum up to 1
     # order predict by probabilities
-    goals_probs_ids = np.argsort(goals_probs) 
-    predict_ordered = [predict[i] for i in goals_probs_ids[::-1]]
-    goals = np.array([goals[i] for i in goals_probs_ids[::-1]])
-    goals_probs_ordered = np.array([goals_probs[i] for i in goals_probs_ids[::-1]])
-    
-    clusters = [] # goal clusters
-    cluster_lanes = [] # lanes of each cluster      
-    agent_dir  = []
-    dict_lanes = {} # dict of lanes and their 2D points
+    goals_probs_ids = np.argsort(goals_probs)[::-1]
+    predict_ordered = predict[goals_probs_ids]
+    goals = predict_ordered[:, -1].copy()
+    goals_probs_ordered = goals_probs[goals_probs_ids]
+
+    agent_vector_dir = predict_ordered[:, -2] - predict_ordered[:, -4]
+    agent_dir = np.arctan2(agent_vector_dir[:, 1], agent_vector_dir[:, 0])
+
+    lookups, local_lanes = get_local_lanes(mapping, goals)
+    dict_lanes = local_lanes  # dict of lanes and their 2D points
+
+    # All (mode, lane) pairs are filtered together.
+    pair_modes = np.array([m for m, (lane_ids, _, _) in enumerate(lookups) for _ in lane_ids], dtype=np.int64)
+    pair_lanes = [lane_id for lane_ids, _, _ in lookups for lane_id in lane_ids]
+    pair_conf = np.array([each for _, conf, _ in lookups for each in conf], dtype=np.float64)
+    pair_is_nearest = np.array([each == min(distances) for _, _, distances in lookups for each in distances], dtype=bool)
     opposite_dir = 0
-    for m, each in enumerate(predict_ordered):            
-        # Compute trajectory direction
-        agent_vector_dir = each[-2] - each[-4]
-        agent_dir.append(np.arctan2(agent_vector_dir[1],agent_vector_dir[0]))
-        # Transform point to original coordinate
-        to_origin_coordinate(each[-1:], mapping['element_in_batch'])
-        # Find nearest centerline to the end point for subsequent clustering 
-        lane_id, conf, lines, distances = am.get_nearest_centerline((each[-1]), visualize=False, name=None ,city_name=mapping["city_name"]) 
-        to_relative_coordinate(each[-1:], mapping['cent_x'],mapping['cent_y'],mapping['angle'])  
-        ids_list = []
-        lane_dir = []
-        agent_lane_angle_list = []
-        closest_point_per_lane = [] 
-        probability = []
-        for i, line in enumerate(lines): 
-            # Convert to relative coorinates to be in the same coordinate frame as the trajectory
-            to_relative_coordinate(line, mapping['cent_x'],mapping['cent_y'],mapping['angle'])  
-            # Compute lane direction
-            closest_waypt_indxs = np.linalg.norm(line - each[-1], axis=1).argsort()[:2]
-            closest_point_per_lane.append(line[closest_waypt_indxs[0]])
-            prev_waypoint_id = closest_waypt_indxs.min()
-            next_waypoint_id = closest_waypt_indxs.max()
-            prev_waypoint = line[prev_waypoint_id]
-            next_waypoint = line[next_waypoint_id]
-            lane_dir_vector = next_waypoint - prev_waypoint 
-            lane_dir.append(lane_dir_vector)
-            # Compute angle between agent and lane
-            agent_lane_angle = abs( agent_dir[-1] - np.arctan2(lane_dir_vector[1],lane_dir_vector[0]) )
-            if agent_lane_angle < np.pi / 4: 
-                agent_lane_angle_list.append(agent_lane_angle)
-                ids_list.append(i) 
-            else:
-                if distances[i] == min(distances):
-                    opposite_dir += 1
-            dict_lanes[lane_id[i]] = line 
-        if len(ids_list) > 0: 
-            lane_id, conf, lines, lane_dir, distances, closest_point_per_lane = [lane_id[i] for i in ids_list], [conf[i] for i in ids_list], [lines[i] for i in ids_list], \
-                                            [lane_dir[i] for i in ids_list], [distances[i] for i in ids_list], [closest_point_per_lane[i] for i in ids_list]
-    
-            # Soft clustering into intention-modes with lanes
-            # If goals share at least one lane, then they are in the same cluster 
-            lanes_m = []
-            if len(lane_id) == 1:
-                lanes_m.append(lane_id)
-                probability = [1.0]
-            else:
-            # check if lanes should be in different clusters (don't merge or are successors)
-                for j in range(1, len(lane_id)): 
-                    min_dist = min(np.linalg.norm(lines[0][-1] - lines[j][-1]),np.linalg.norm(lines[0][-1] - lines[j][0]), np.linalg.norm(lines[0][0] - lines[j][-1]))
-                    if min_dist > lanes_threshold: 
-                        if len(lanes_m) == 0:
-                            lanes_m.append(lane_id[:j])
-                            lanes_m.append(lane_id[j:j+1])  
-                            probability.append(conf[0]*(1/agent_lane_angle_list[0]))
-                            probability.append(conf[j]*(1/agent_lane_angle_list[j]))
-                        else:
-                            # check if the lane is in the same cluster as the previous one
-                            included = False
-                            for k in range(1,j):
-                                min_dist = min(np.linalg.norm(lines[k][-1] - lines[j][-1]),np.linalg.norm(lines[k][-1] - lines[j][0]), np.linalg.norm(lines[k][0] - lines[j][-1])) 
-                                if min_dist < lanes_threshold:  
-                                    for kidx, lanem in enumerate(lanes_m):
-                                        if lane_id[k] in lanem and lane_id[j] not in lanem:   
-                                            lanes_m[kidx].append(lane_id[j])
-                                            probability.append(conf[j]*(1/agent_lane_angle_list[j]))
-                                            included=True
-                                            break
-                                    break
-                            if not included: 
-                                lanes_m.append(lane_id[j:j+1])
-                                probability.append(conf[j]*(1/agent_lane_angle_list[j]))
-                    else:
-                        # lane j belongs to the same cluster as lane 0
-                        if len(lanes_m) == 0:
-                            lanes_m.append(lane_id[:j+1])  
-                            probability.append(conf[0]*(1/agent_lane_angle_list[0]))
-                            probability.append(conf[j]*(1/agent_lane_angle_list[j]))
-                            
-                        else:
-                            lanes_m[0].append(lane_id[j])
-                            probability.append(conf[j]*(1/agent_lane_angle_list[j]))   
-            if m == 0:
-                clusters = [[m] for i in range(len(lanes_m))] 
-                cluster_lanes = [set(lm) for lm in lanes_m] 
-            else:
-                for l_group in lanes_m: 
-                    clusterized = False
-                    # If any lane in l_group is in cluster_lanes, then they are in the same cluster  
-                    for c_n, lane_cn in enumerate(cluster_lanes):
-                        # compute minimum last distance between lanes in l_group and lanes in cluster_lanes
-                        min_dist = np.min([min(np.linalg.norm(dict_lanes[l][-1] - dict_lanes[l_c][-1]), np.linalg.norm(dict_lanes[l][-1] - dict_lanes[l_c][0]), np.linalg.norm(dict_lanes[l][0] - dict_lanes[l_c][-1])) for l in l_group for l_c in list(lane_cn)])
-                        if any(l_group[i] in lane_cn for i in range(len(l_group))) or min_dist < lanes_threshold:   
-                            clusters[c_n].extend([m])
-                            cluster_lanes[c_n].update(l_group)
-                            clusterized = True
-                            break 
-                    if clusterized == False:
-                        clusters.append([m])
-                        cluster_lanes.append(set(l_group))
-        else:
-            # print("No lanes found with agent_lane_angle < pi/4")
-            lane_id = []
-        
-        lanes.append(lane_id) 
-        lanes_dir.append(lane_dir)
-        agent_lanes_dir.append(agent_lane_angle_list)
-        distances_list.append(distances)
-        closest_point_per_lane_list.append(closest_point_per_lane)
-        confidences.append(list(scipy.special.softmax(probability)) if len(probability) > 0 else [0]) # sum(y_k) = 1)     
-
-    hard_clusters = [[] for i in range(len(clusters))]
-    cluster_probs = [0] * len(clusters)
-    confidences_cluster = [[] for c in range(len(clusters))]
-    confidences_hard_cluster = [[] for c in range(len(clusters))]
-    max_conf_idx = [(np.array(conf)).argmax() if len(conf)>1 else 0 for conf in confidences] 
-    
-    if len(clusters) == 0:
+    keep = np.zeros([0], dtype=bool)
+    if len(pair_lanes) > 0:
+        lane_dir = get_lane_directions([local_lanes[lane_id] for lane_id in pair_lanes], goals[pair_modes])
+        agent_lane_angle = np.abs(agent_dir[pair_modes] - np.arctan2(lane_dir[:, 1], lane_dir[:, 0]))
+        keep = agent_lane_angle < np.pi / 4
+        opposite_dir = int(np.sum(~keep & pair_is_nearest))
+
+    lanes = [[] for _ in range(len(goals))]
+    confidences = [[0] for _ in range(len(goals))]
+    for m in range(len(goals)):
+        pairs = np.nonzero(keep & (pair_modes == m))[0]
+        lanes[m] = [pair_lanes[i] for i in pairs]
+        if len(pairs) == 1:
+            confidences[m] = [1.0]
+        elif len(pairs) > 1:
+            confidences[m] = list(scipy.special.softmax(pair_conf[pairs] * (1 / agent_lane_angle[pairs])))
+
+    # If goals share at least one lane or adjacent lanes, then they are in the same cluster
+    lane_ids = list(dict.fromkeys(lane_id for lanes_m in lanes for lane_id in lanes_m))
+    if len(lane_ids) == 0:
         print(f"No clusters have been found in {mapping['file_name'].split('/')[-1]}")
         return dict_lanes, [], np.array(agent_dir[:max_guesses]).var(ddof=1), 0, opposite_dir, []
+    lane_components = get_lane_components(lane_ids, local_lanes)
+    cluster_num = max(lane_components.values()) + 1
 
-
+    hard_clusters = [[] for _ in range(cluster_num)]
+    cluster_probs = np.zeros([cluster_num])
+    confidences_hard_cluster = [[] for _ in range(cluster_num)]
     for m in range(len(goals)):
-        for i, lanem in enumerate(lanes[m]):
-            for j in range(len(clusters)):
-                if lanem in cluster_lanes[j]:
-                    cluster_probs[j] += goals_probs_ordered[m]*confidences[m][i]
-                    confidences_cluster[j].append(confidences[m][i]*goals_probs_ordered[m])
-                    if i == max_conf_idx[m]:
-                        hard_clusters[j].append(m)
-                        confidences_hard_cluster[j].append(confidences[m][i]*goals_probs_ordered[m])
-    cluster_probs = scipy.special.softmax(cluster_probs)  
-    
+        if len(lanes[m]) == 0:
+            continue
+        components = [lane_components[lane_id] for lane_id in lanes[m]]
+        np.add.at(cluster_probs, components, goals_probs_ordered[m] * np.array(confidences[m]))
+        max_conf_idx = int(np.argmax(confidences[m]))
+        hard_clusters[components[max_conf_idx]].append(m)
+        confidences_hard_cluster[components[max_conf_idx]].append(confidences[m][max_conf_idx] * goals_probs_ordered[m])
+    cluster_probs = scipy.special.softmax(cluster_probs)
+
     cluster_probs = [cluster_probs[i] for i in range(len(cluster_probs)) if len(hard_clusters[i])>0]
-    hard_clusters = [c for c in hard_clusters if len(c)>0] 
+    hard_clusters = [c for c in hard_clusters if len(c)>0]
     confidences_hard_cluster = [c for c in confidences_hard_cluster if len(c)>0]
-    cluster_avg = [np.mean(goals[c], axis=0) for c in hard_clusters]  
+    cluster_avg = [np.mean(goals[c], axis=0) for c in hard_clusters]
     cluster_cov = []
     for c in hard_clusters:
         if len(c)>2:
@@ -1161,16 +1208,7 @@ traj_last = None
 
 
 def batch_init(mapping):
-    global traj_last, origin_point, origin_angle
-    batch_size = len(mapping)
-
-    global origin_point, origin_angle
-    origin_point = np.zeros([batch_size, 2])
-    origin_angle = np.zeros([batch_size])
-    for i in range(batch_size):
-        origin_point[i][0], origin_point[i][1] = rotate(0 - mapping[i]['cent_x'], 0 - mapping[i]['cent_y'],
-                                                        mapping[i]['angle'])
-        origin_angle[i] = -mapping[i]['angle']
+    global traj_last
 
     def load_file2pred():
         global file2pred
@@ -1212,6 +1250,14 @@ def merge_tensors(tensors: List[torch.Tensor], device, hidden_size=None) -> Tupl
     return res, lengths
 
 
+def get_length_mask(lengths, max_length, device):
+    """
+    Boolean mask of shape [len(lengths), max_length], True for the first lengths[i] positions of row i.
+    """
+    lengths = torch.as_tensor(lengths, device=device)
+    return torch.arange(max_length, device=device).unsqueeze(0) < lengths.unsqueeze(1)
+
+
 def de_merge_tensors(tensor: Tensor, lengths):
     return [tensor[i, :lengths[i]] for i in range(len(lengths))]
 
@@ -1653,6 +1699,28 @@ def get_neighbour_points_new(points, neighbour_dis=2, density=1.0):
     return points
 
 
+def get_neighbour_points_tensor(points: Tensor, neighbour_dis=2, density=1.0) -> Tensor:
+    """
+    Tensor version of get_neighbour_points_new, on the device of points.
+
+    Every point is rounded and expanded into a grid of side 2 * neighbour_dis with spacing density.
+    Grid points are snapped to multiples of density and deduplicated, keeping the order of first occurrence,
+    so density=1.0 gives the same points in the same order as get_neighbour_points.
+
+    :param points: shape ['point num', 2]
+    :return: shape ['dense point num', 2]
+    """
+    offsets = torch.arange(-neighbour_dis, neighbour_dis + eps, density, device=points.device, dtype=torch.float)
+    offsets = torch.stack(torch.meshgrid(offsets, offsets, indexing='ij'), dim=-1).view(-1, 2)
+    grid = torch.round(points.float()).unsqueeze(1) + offsets.unsqueeze(0)
+    keys = torch.round(grid.view(-1, 2) / density).long()
+
+    keys, inverse = torch.unique(keys, dim=0, return_inverse=True)
+    first = torch.full([len(keys)], len(inverse), device=points.device, dtype=torch.long)
+    first.scatter_reduce_(0, inverse, torch.arange(len(inverse), device=points.device), reduce='amin')
+    return keys[torch.argsort(first)].float() * density
+
+
 def get_neighbour_points_for_lanes(polygons):
     points = []
     for polygon in polygons:
@@ -1707,109 +1775,43 @@ idx_in_batch_2_ans_points = {}
 idx_in_batch_2_ans_point_scores = {}
 
 
-def run_process_todo(queue, queue_res, speed=None, eval_time=None):
-    id = np.random.randint(5)
-    print('in run_process_todo', get_time(), id)
-
-
-def run_process(queue, queue_res, args):
-    id = np.random.randint(5)
-    utils_cython.args = args
-    objective = 'MR'
-    if 'MRminFDE' in args.other_params:
-        objective = 'MRminFDE'
-    opti_time = float(args.other_params.get('opti_time', 10000.0))
-
-    li = []
-    while True:
-        # print('a', round(time.time() - start_time, 2))
-        value = queue.get()
-        if value is None:
-            break
-        idx_in_batch, file_name, (goals_2D, scores), kwargs = value
-        scores = np.exp(scores)
-        if file_name == 'test_obs/data/33670.csv':
-            print('aaa', len(scores), np.sum(scores), scores, goals_2D)
-
-        if 'MRminFDE' in args.other_params:
-            assert 'cnt_sample' in args.other_params
-            MRratio = float(args.other_params['MRminFDE']) if args.other_params['MRminFDE'] is not True else 1.0
-
-        start_time = time.time()
-
-        if 'cnt_sample' in args.other_params:
-            num_step = 1000
-            kwargs.update(dict(
-                num_step=num_step,
-                cnt_sample=args.other_params['cnt_sample'],
-                MRratio=MRratio,
-            ))
-            assert args.other_params['cnt_sample'] > 1
-
-        results = utils_cython.get_optimal_targets(goals_2D, scores, file_name, objective, opti_time, kwargs=kwargs)
-
-        li.append(round(time.time() - start_time, 2))
-
-        expectation, ans_points, pred_probs = results
-        queue_res.put((idx_in_batch, expectation, ans_points, pred_probs))
-    pass
+def get_optimization_pool() -> optimization_pool.GoalOptimizationPool:
+    this = get_optimization_pool
+    if not hasattr(this, 'pool'):
+        assert args.core_num >= 2
+        this.pool = optimization_pool.create_pool(args, args.core_num)
+    return this.pool
 
-    print('out run_process', get_time(), id)
 
+def submit_goals_optimization(mapping) -> int:
+    """
+    Start the goal set optimization of a batch in the worker pool, without waiting for it.
 
-def select_goals_by_optimization(batch_gt_points, mapping, close=False):
-    this = select_goals_by_optimization
-    if not hasattr(this, 'processes'):
-        # if end:
-        #     return
-        queue = multiprocessing.Queue(args.core_num)
-        queue_res = multiprocessing.Queue()
-        processes = [
-            Process(target=run_process, args=(queue, queue_res, args,))
-            for _ in range(args.core_num)]
-        for each in processes:
-            each.start()
-        this.processes = processes
-        this.queue = queue
-        this.queue_res = queue_res
+    :return: id of the batch, for select_goals_by_optimization
+    """
+    return get_optimization_pool().submit([mapping[i]['goals_2D_scores'] for i in range(len(mapping))],
+                                          get_from_mapping(mapping, 'file_name'))
 
-    queue = this.queue
-    queue_res = this.queue_res
 
+def select_goals_by_optimization(batch_gt_points, mapping, close=False, batch_id=None):
+    """
+    :param batch_id: id from submit_goals_optimization if the batch was already submitted
+    """
     if close:
-        for i in range(args.core_num):
-            queue.put(None)
-        for each in select_goals_by_optimization.processes:
-            each.join()
+        get_optimization_pool().close()
         return
 
+    if batch_id is None:
+        batch_id = submit_goals_optimization(mapping)
+
     start_time = time.time()
     batch_size, future_frame_num, _ = batch_gt_points.shape
 
-    batch_file_name = get_from_mapping(mapping, 'file_name')
-
-    assert args.core_num >= 2
-
-    run_times = 8
-    for _ in range(run_times):
-        for i in range(batch_size):
-            kwargs = {}
-            pass
-
-            queue.put((i, batch_file_name[i], mapping[i]['goals_2D_scores'], kwargs))
-
-    while not queue.empty():
-        pass
-
-    expectations = np.ones(batch_size) * 10000.0
     batch_ans_points = np.zeros([batch_size, args.mode_num, 2])
     batch_pred_probs = np.zeros([batch_size, args.mode_num])
-    for _ in range(run_times * batch_size):
-        i, expectation, ans_points, pred_probs = queue_res.get()
-        if expectation < expectations[i]:
-            expectations[i] = expectation
-            batch_ans_points[i] = ans_points
-            batch_pred_probs[i] = pred_probs
+    for i, (expectation, ans_points, pred_probs) in enumerate(get_optimization_pool().get(batch_id)):
+        batch_ans_points[i] = ans_points
+        batch_pred_probs[i] = pred_probs
 
     # print('here', round(time.time() - start_time, 2))
 
@@ -1819,27 +1821,9 @@ def select_goals_by_optimization(batch_gt_points, mapping, close=False):
             FDE = np.min(get_dis_point_2_points(batch_gt_points[i][-1], batch_ans_points[i]))
         method2FDEs[0].append(FDE)
 
-        ans_points = batch_ans_points[i].copy()
-        if args.argoverse:
-            to_origin_coordinate(ans_points, i)
-
     return batch_ans_points, batch_pred_probs
 
 
-def to_origin_coordinate(points, idx_in_batch, scale=None):
-    for point in points:
-        point[0], point[1] = rotate(point[0] - origin_point[idx_in_batch][0],
-                                    point[1] - origin_point[idx_in_batch][1], origin_angle[idx_in_batch])
-        if scale is not None:
-            point[0] *= scale
-            point[1] *= scale
-
-
-def to_relative_coordinate(points, x, y, angle):
-    for point in points:
-        point[0], point[1] = rotate(point[0] - x, point[1] - y, angle)
-
-
 def get_time():
     return time.strftime("%Y-%m-%d-%H-%M-%S", time.localtime())
 
@@ -1901,11 +1885,32 @@ def get_color_text(text, color='red'):
 other_errors_dict = defaultdict(list)
 
 
+# Errors put as tensors stay on their device until sync_other_errors.
+other_errors_tensors = defaultdict(list)
+
+
 def other_errors_put(error_type, error):
     other_errors_dict[error_type].append(error)
 
 
+def other_errors_put_tensor(error_type, errors: Tensor):
+    """
+    Put the errors of all examples of a batch (shape [batch_size]) without a host sync.
+    """
+    other_errors_tensors[error_type].append(errors.detach())
+
+
+def sync_other_errors():
+    """
+    Move the errors put by other_errors_put_tensor into other_errors_dict.
+    """
+    for error_type, errors in other_errors_tensors.items():
+        other_errors_dict[error_type].extend(torch.cat(errors).tolist())
+    other_errors_tensors.clear()
+
+
 def other_errors_to_string():
+    sync_other_errors()
     res = {}
     for each, value in other_errors_dict.items():
         res[each] = np.mean(value)
@@ -2105,32 +2110,17 @@ def get_wait5_rank(rank):
 #     if len(shape) != len(shape_):
 #         return False
 
-class Normalizer:
+class Normalizer(Frame):
     def __init__(self, x, y, yaw):
-        self.x = x
-        self.y = y
+        super().__init__(x, y, yaw)
         self.yaw = yaw
-        self.origin = rotate(0.0 - x, 0.0 - y, yaw)
 
     def __call__(self, points, reverse=False):
         points = np.array(points)
         if points.shape == (2,):
             points.shape = (1, 2)
         assert len(points.shape) <= 3
-        if len(points.shape) == 3:
-            for each in points:
-                each[:] = self.__call__(each, reverse)
-        else:
-            assert len(points.shape) == 2
-            for point in points:
-                if reverse:
-                    point[0], point[1] = rotate(point[0] - self.origin[0],
-                                                point[1] - self.origin[1], -self.yaw)
-                else:
-                    point[0], point[1] = rotate(point[0] - self.x,
-                                                point[1] - self.y, self.yaw)
-
-        return points
+        return self.to_world(points) if reverse else self.to_frame(points)
 
 
 def satisfy_one_of(conds, other_params):
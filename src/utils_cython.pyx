@@ -127,23 +127,18 @@ cdef np.float32_t get_rand(np.float32_t l, np.float32_t r):
 cdef int get_rand_int(int l, int r):
     return l + rand() % (r - l + 1)
 
-cdef np.float32_t get_value(np.ndarray[np.float32_t, ndim=2] goals_2D, np.ndarray[np.float32_t, ndim=1] scores,
-                            np.ndarray[np.float32_t, ndim=2] selected_points, int n, objective, int cnt_sample, np.float32_t MRratio,
-                            kwargs):
-    cdef np.float32_t value = 0.0, cnt_hit, x, y, sum, minFDE, t_float, miss_error, stride, s_x, s_y
-    cdef int i, j, k, need, cnt, t_int, objective_int, cnt_len = 0, a, b
-    cdef np.ndarray[np.float32_t, ndim=1] point = np.zeros(2, dtype=np.float32)
-    mode_num = kwargs.get('--mode_num', 12) 
+def get_sample_points(np.ndarray[np.float32_t, ndim=2] goals_2D, np.ndarray[np.float32_t, ndim=1] scores, int n, int cnt_len):
+    """
+    Sub-sample the 1m x 1m cell around each of the first n goals on a cnt x cnt lattice, where cnt depends on the score.
 
-    for i in range(100):
-        if i * i == cnt_sample:
-            cnt_len = i
-    if cnt_len == 0:
-        assert False, 'cnt_sample != square'
+    Returns flat arrays of the x and y of the sample points, and goal_ends, goal i owns the sample points
+    goal_ends[i - 1]:goal_ends[i].
+    """
+    cdef np.float32_t stride, s_x, s_y, t_float
+    cdef int i, a, b, cnt, t_int, m = 0
+    cdef np.ndarray[np.int32_t, ndim=1] cnts = np.zeros(n, dtype=np.int32)
 
     for i in range(n):
-        point[0], point[1] = goals_2D[i, 0], goals_2D[i, 1]
-        sum = 0.0
         t_int = int(scores[i] * 1000)
 
         if t_int > 10:
@@ -152,7 +147,17 @@ cdef np.float32_t get_value(np.ndarray[np.float32_t, ndim=2] goals_2D, np.ndarra
             cnt = cnt_len * 2
         else:
             cnt = cnt_len
+        cnts[i] = cnt
+        m += cnt * cnt
 
+    cdef np.ndarray[np.float32_t, ndim=1] xs = np.zeros(m, dtype=np.float32)
+    cdef np.ndarray[np.float32_t, ndim=1] ys = np.zeros(m, dtype=np.float32)
+    cdef np.ndarray[np.int32_t, ndim=1] goal_ends = np.zeros(n, dtype=np.int32)
+    cdef np.ndarray[np.float32_t, ndim=1] point = np.zeros(2, dtype=np.float32)
+    m = 0
+    for i in range(n):
+        point[0], point[1] = goals_2D[i, 0], goals_2D[i, 1]
+        cnt = cnts[i]
         t_float = cnt
         stride = 1.0 / t_float
 
@@ -161,21 +166,79 @@ cdef np.float32_t get_value(np.ndarray[np.float32_t, ndim=2] goals_2D, np.ndarra
 
         for a in range(cnt):
             for b in range(cnt):
-                # x = get_rand(point[0] - 0.5, point[0] + 0.5)
-                # y = get_rand(point[1] - 0.5, point[1] + 0.5)
-                x = s_x + a * stride
-                y = s_y + b * stride
-                minFDE = 10000.0
-                miss_error = 10.0
-                for j in range(mode_num):
-                    t_float = get_dis_point(x - selected_points[j, 0], y - selected_points[j, 1])
-                    if t_float < minFDE:
-                        minFDE = t_float
-                if minFDE <= 2.0:
-                    miss_error = 0.0
-                sum += minFDE * (1.0 - MRratio) + miss_error * MRratio
-        sum /= cnt * cnt
+                xs[m] = s_x + a * stride
+                ys[m] = s_y + b * stride
+                m += 1
+        goal_ends[i] = m
+
+    return xs, ys, goal_ends
+
+cdef void get_min_sqr_dis(np.ndarray[np.float32_t, ndim=1] xs, np.ndarray[np.float32_t, ndim=1] ys,
+                          np.ndarray[np.float32_t, ndim=2] selected_points, int mode_num,
+                          np.ndarray[np.float32_t, ndim=1] min_sqr_dis, np.ndarray[np.int32_t, ndim=1] nearest):
+    """
+    Squared distance from every sample point to its nearest selected point, and the index of that point.
+    """
+    cdef np.float32_t t_float
+    cdef int s, j
+    for s in range(xs.shape[0]):
+        min_sqr_dis[s] = 100000000.0
+        for j in range(mode_num):
+            t_float = get_sqr_dis_point(xs[s] - selected_points[j, 0], ys[s] - selected_points[j, 1])
+            if t_float < min_sqr_dis[s]:
+                min_sqr_dis[s] = t_float
+                nearest[s] = j
+
+cdef void update_min_sqr_dis(np.ndarray[np.float32_t, ndim=1] xs, np.ndarray[np.float32_t, ndim=1] ys,
+                             np.ndarray[np.float32_t, ndim=2] selected_points, int mode_num,
+                             np.ndarray[np.int32_t, ndim=1] moved, int moved_num,
+                             np.ndarray[np.float32_t, ndim=1] min_sqr_dis, np.ndarray[np.int32_t, ndim=1] nearest,
+                             np.ndarray[np.float32_t, ndim=1] nxt_min_sqr_dis, np.ndarray[np.int32_t, ndim=1] nxt_nearest,
+                             np.ndarray[np.int32_t, ndim=1] is_moved):
+    """
+    get_min_sqr_dis after the selected points moved[:moved_num] moved, given min_sqr_dis and nearest before the move.
+
+    Only sample points whose nearest selected point moved are compared with all selected points,
+    the others keep their nearest distance unless a moved point is now closer.
+    """
+    cdef np.float32_t t_float
+    cdef int s, j, k
+    for s in range(xs.shape[0]):
+        if is_moved[nearest[s]]:
+            nxt_min_sqr_dis[s] = 100000000.0
+            for j in range(mode_num):
+                t_float = get_sqr_dis_point(xs[s] - selected_points[j, 0], ys[s] - selected_points[j, 1])
+                if t_float < nxt_min_sqr_dis[s]:
+                    nxt_min_sqr_dis[s] = t_float
+                    nxt_nearest[s] = j
+        else:
+            nxt_min_sqr_dis[s] = min_sqr_dis[s]
+            nxt_nearest[s] = nearest[s]
+            for k in range(moved_num):
+                j = moved[k]
+                t_float = get_sqr_dis_point(xs[s] - selected_points[j, 0], ys[s] - selected_points[j, 1])
+                if t_float < nxt_min_sqr_dis[s]:
+                    nxt_min_sqr_dis[s] = t_float
+                    nxt_nearest[s] = j
+
+cdef np.float32_t get_value(np.ndarray[np.int32_t, ndim=1] goal_ends, np.ndarray[np.float32_t, ndim=1] scores, int n,
+                            np.ndarray[np.float32_t, ndim=1] min_sqr_dis, np.float32_t MRratio, np.float32_t miss_cost):
+    """
+    Expected cost of the selected points, given the squared distance from every sample point to its nearest one.
+    """
+    cdef np.float32_t value = 0.0, sum, minFDE, miss_error
+    cdef int i, s, start = 0
+    for i in range(n):
+        sum = 0.0
+        for s in range(start, goal_ends[i]):
+            minFDE = sqrt(min_sqr_dis[s])
+            miss_error = miss_cost
+            if minFDE <= 2.0:
+                miss_error = 0.0
+            sum += minFDE * (1.0 - MRratio) + miss_error * MRratio
+        sum /= goal_ends[i] - start
         value += scores[i] * sum
+        start = goal_ends[i]
 
     return value
 
@@ -184,7 +247,7 @@ args = None
 def _get_optimal_targets(np.ndarray[np.float32_t, ndim=2] goals_2D, np.ndarray[np.float32_t, ndim=1] scores,
                          file_name, objective, int num_step, int cnt_sample, MRratio, float opti_time, kwargs):
     cdef np.float32_t t, threshold, expectation, nxt_expectation, lr, ratio, fire_prob, min_expectation
-    cdef int i, j, n, m, t_int, step, op, ok, go
+    cdef int i, j, n, m, t_int, step, op, ok, go, cnt_len = 0, moved_num
     n = goals_2D.shape[0]
     m = 0
     threshold = 0.001
@@ -192,6 +255,8 @@ def _get_optimal_targets(np.ndarray[np.float32_t, ndim=2] goals_2D, np.ndarray[n
     cdef np.ndarray[np.float32_t, ndim=2] ans_points = np.zeros((mode_num, 2), dtype=np.float32)
     cdef np.ndarray[np.float32_t, ndim=2] nxt_points = np.zeros((mode_num, 2), dtype=np.float32)
     cdef np.ndarray[np.float32_t, ndim=1] pred_probs = np.zeros(mode_num, dtype=np.float32)
+    cdef np.ndarray[np.int32_t, ndim=1] moved = np.zeros(mode_num, dtype=np.int32)
+    cdef np.ndarray[np.int32_t, ndim=1] is_moved = np.zeros(mode_num, dtype=np.int32)
     cdef:
         float best_expectation = 10000.0
         np.ndarray[np.float32_t, ndim=2] best_points = np.zeros((mode_num, 2), dtype=np.float32)
@@ -200,6 +265,12 @@ def _get_optimal_targets(np.ndarray[np.float32_t, ndim=2] goals_2D, np.ndarray[n
     if opti_time < 100.0:
         num_step = 1000_000
 
+    for i in range(100):
+        if i * i == cnt_sample:
+            cnt_len = i
+    if cnt_len == 0:
+        assert False, 'cnt_sample != square'
+
     for i in range(n):
         if scores[i] >= threshold:
             goals_2D[m, 0] = goals_2D[i, 0]
@@ -210,12 +281,21 @@ def _get_optimal_targets(np.ndarray[np.float32_t, ndim=2] goals_2D, np.ndarray[n
         print('warning: m == 0')
     n = m
 
+    # The sub-sample lattice is built once, and every state keeps the nearest selected point of each sample point,
+    # so a step only compares the sample points with the moved points (see update_min_sqr_dis).
+    xs, ys, goal_ends = get_sample_points(goals_2D, scores, n, cnt_len)
+    cdef np.ndarray[np.float32_t, ndim=1] min_sqr_dis = np.zeros(len(xs), dtype=np.float32)
+    cdef np.ndarray[np.float32_t, ndim=1] nxt_min_sqr_dis = np.zeros(len(xs), dtype=np.float32)
+    cdef np.ndarray[np.int32_t, ndim=1] nearest = np.zeros(len(xs), dtype=np.int32)
+    cdef np.ndarray[np.int32_t, ndim=1] nxt_nearest = np.zeros(len(xs), dtype=np.int32)
+
     for j in range(mode_num):
         t_int = get_rand_int(0, n - 1)
         ans_points[j, 0] = goals_2D[t_int, 0]
         ans_points[j, 1] = goals_2D[t_int, 1]
 
-    expectation = get_value(goals_2D, scores, ans_points, n, objective, cnt_sample, MRratio, kwargs)
+    get_min_sqr_dis(xs, ys, ans_points, mode_num, min_sqr_dis, nearest)
+    expectation = get_value(goal_ends, scores, n, min_sqr_dis, MRratio, 10.0)
     for step in range(num_step):
         if (clock() - start_time) / CLOCKS_PER_SEC >= opti_time:
             break
@@ -232,15 +312,22 @@ def _get_optimal_targets(np.ndarray[np.float32_t, ndim=2] goals_2D, np.ndarray[n
         if op == 0:
             while True:
                 ok = 0
+                moved_num = 0
                 for j in range(mode_num):
+                    is_moved[j] = 0
                     if get_rand(0.0, 1.0) < 0.3:
                         nxt_points[j, 0] += get_rand(-lr, lr)
                         nxt_points[j, 1] += get_rand(-lr, lr)
                         ok = 1
+                        moved[moved_num] = j
+                        moved_num += 1
+                        is_moved[j] = 1
                 if ok:
                     break
 
-        nxt_expectation = get_value(goals_2D, scores, nxt_points, n, objective, cnt_sample, MRratio, kwargs)
+        update_min_sqr_dis(xs, ys, nxt_points, mode_num, moved, moved_num, min_sqr_dis, nearest,
+                           nxt_min_sqr_dis, nxt_nearest, is_moved)
+        nxt_expectation = get_value(goal_ends, scores, n, nxt_min_sqr_dis, MRratio, 10.0)
 
         go = 0
         if nxt_expectation < expectation:
@@ -255,6 +342,8 @@ def _get_optimal_targets(np.ndarray[np.float32_t, ndim=2] goals_2D, np.ndarray[n
             for j in range(mode_num):
                 ans_points[j, 0] = nxt_points[j, 0]
                 ans_points[j, 1] = nxt_points[j, 1]
+            min_sqr_dis, nxt_min_sqr_dis = nxt_min_sqr_dis, min_sqr_dis
+            nearest, nxt_nearest = nxt_nearest, nearest
 
         if expectation < best_expectation:
             best_expectation = expectation
@@ -267,8 +356,10 @@ def _get_optimal_targets(np.ndarray[np.float32_t, ndim=2] goals_2D, np.ndarray[n
     for j in range(mode_num):
         for k in range(mode_num):
             nxt_points[k, 0], nxt_points[k, 1] = best_points[j, 0], best_points[j, 1]
-        t = get_value(goals_2D, scores, nxt_points, n, 'minFDE', cnt_sample, MRratio, kwargs)
-        pred_probs[j] = 1.0 - get_value(goals_2D, scores, nxt_points, n, objective, cnt_sample, MRratio, kwargs)
+        get_min_sqr_dis(xs, ys, nxt_points, mode_num, nxt_min_sqr_dis, nxt_nearest)
+        # The objective does not change get_value, so the minFDE value equals the objective value.
+        t = get_value(goal_ends, scores, n, nxt_min_sqr_dis, MRratio, 10.0)
+        pred_probs[j] = 1.0 - t
         if t < min_expectation:
             min_expectation = t
             argmin = j
@@ -322,62 +413,25 @@ def get_normalized_points(points: np.ndarray, normalizer, reverse=False):
         return _get_normalized(trajectorys, normalizer.origin[0], normalizer.origin[1], -normalizer.yaw)[0]
     return _get_normalized(trajectorys, normalizer.x, normalizer.y, normalizer.yaw)[0]
 
+cdef float _set_predict_get_MRratio(kwargs):
+    if kwargs is not None and 'set_predict-MRratio' in kwargs:
+        return float(kwargs['set_predict-MRratio'])
+    return 1.0
+
 cdef float _set_predict_get_value(np.ndarray[np.float32_t, ndim=2] goals_2D,
                                   np.ndarray[np.float32_t, ndim=1] scores,
                                   np.ndarray[np.float32_t, ndim=2] selected_points,
                                   kwargs):
     cdef:
         int n = goals_2D.shape[0]
-        np.ndarray[np.float32_t, ndim=1] point = np.zeros(2, dtype=np.float32)
-        float MRratio = 1.0
         mode_num = kwargs.get('--mode_num',12)
+        float MRratio = _set_predict_get_MRratio(kwargs)
 
-        float value = 0.0, cnt_hit, x, y, sum, minFDE, t_float, miss_error, stride, s_x, s_y
-        int i, j, k, need, cnt, t_int, objective_int, cnt_len = 3, a, b
-
-    if kwargs is not None and 'set_predict-MRratio' in kwargs:
-        MRratio = float(kwargs['set_predict-MRratio'])
-
-    for i in range(n):
-        point[0], point[1] = goals_2D[i, 0], goals_2D[i, 1]
-
-        if True:
-            sum = 0.0
-            t_int = int(scores[i] * 1000)
-
-            if t_int > 10:
-                cnt = cnt_len * 3
-            elif t_int > 5:
-                cnt = cnt_len * 2
-            else:
-                cnt = cnt_len
-
-            t_float = cnt
-            stride = 1.0 / t_float
-
-            s_x = point[0] - 0.5 + stride / 2.0
-            s_y = point[1] - 0.5 + stride / 2.0
-
-            for a in range(cnt):
-                for b in range(cnt):
-                    # x = get_rand(point[0] - 0.5, point[0] + 0.5)
-                    # y = get_rand(point[1] - 0.5, point[1] + 0.5)
-                    x = s_x + a * stride
-                    y = s_y + b * stride
-                    minFDE = 10000.0
-                    miss_error = 1.0
-                    # warning: miss_error is not 10.0
-                    for j in range(mode_num):
-                        t_float = get_dis_point(x - selected_points[j, 0], y - selected_points[j, 1])
-                        if t_float < minFDE:
-                            minFDE = t_float
-                    if minFDE <= 2.0:
-                        miss_error = 0.0
-                    sum += minFDE * (1.0 - MRratio) + miss_error * MRratio
-            sum /= cnt * cnt
-            value += scores[i] * sum
-
-    return value
+    xs, ys, goal_ends = get_sample_points(goals_2D, scores, n, 3)
+    min_sqr_dis = np.zeros(len(xs), dtype=np.float32)
+    get_min_sqr_dis(xs, ys, selected_points, mode_num, min_sqr_dis, np.zeros(len(xs), dtype=np.int32))
+    # warning: miss_error is not 10.0
+    return get_value(goal_ends, scores, n, min_sqr_dis, MRratio, 1.0)
 
 def set_predict_get_value(goals_2D, scores, selected_points, kwargs=None):
     return _set_predict_get_value(goals_2D, scores, selected_points, kwargs)
@@ -387,15 +441,27 @@ def _set_predict_next_step(np.ndarray[np.float32_t, ndim=2] goals_2D,
                            np.ndarray[np.float32_t, ndim=2] selected_points,
                            float lr, kwargs):
     cdef:
-        int step, j, ok, num_step = 100
+        int step, j, ok, num_step = 100, moved_num, n = goals_2D.shape[0]
         mode_num = kwargs.get('--mode_num',12)
-        float nxt_expectation, best_expectation = _set_predict_get_value(goals_2D, scores, selected_points, kwargs)
+        float MRratio = _set_predict_get_MRratio(kwargs)
+        float nxt_expectation, best_expectation
         np.ndarray[np.float32_t, ndim = 2] nxt_points = np.zeros((mode_num, 2), dtype=np.float32)
         np.ndarray[np.float32_t, ndim = 2] best_points = selected_points.copy()
+        np.ndarray[np.int32_t, ndim=1] moved = np.zeros(mode_num, dtype=np.int32)
+        np.ndarray[np.int32_t, ndim=1] is_moved = np.zeros(mode_num, dtype=np.int32)
 
     if kwargs is not None and 'dynamic_label-double' in kwargs:
         num_step = 200
 
+    # All proposals perturb selected_points, so the nearest selected point of every sample point is computed once.
+    xs, ys, goal_ends = get_sample_points(goals_2D, scores, n, 3)
+    min_sqr_dis = np.zeros(len(xs), dtype=np.float32)
+    nearest = np.zeros(len(xs), dtype=np.int32)
+    nxt_min_sqr_dis = np.zeros(len(xs), dtype=np.float32)
+    nxt_nearest = np.zeros(len(xs), dtype=np.int32)
+    get_min_sqr_dis(xs, ys, selected_points, mode_num, min_sqr_dis, nearest)
+    best_expectation = get_value(goal_ends, scores, n, min_sqr_dis, MRratio, 1.0)
+
     for step in range(num_step):
         for j in range(mode_num):
             nxt_points[j, 0] = selected_points[j, 0]
@@ -404,15 +470,22 @@ def _set_predict_next_step(np.ndarray[np.float32_t, ndim=2] goals_2D,
         if True:
             while True:
                 ok = 0
+                moved_num = 0
                 for j in range(mode_num):
+                    is_moved[j] = 0
                     if get_rand(0.0, 1.0) < 0.5:
                         nxt_points[j, 0] += get_rand(-lr, lr)
                         nxt_points[j, 1] += get_rand(-lr, lr)
                         ok = 1
+                        moved[moved_num] = j
+                        moved_num += 1
+                        is_moved[j] = 1
                 if ok:
                     break
 
-        nxt_expectation = _set_predict_get_value(goals_2D, scores, nxt_points, kwargs)
+        update_min_sqr_dis(xs, ys, nxt_points, mode_num, moved, moved_num, min_sqr_dis, nearest,
+                           nxt_min_sqr_dis, nxt_nearest, is_moved)
+        nxt_expectation = get_value(goal_ends, scores, n, nxt_min_sqr_dis, MRratio, 1.0)
         if nxt_expectation < best_expectation:
             best_expectation = nxt_expectation
             for j in range(mode_num):
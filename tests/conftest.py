@@ -0,0 +1,22 @@
+import argparse
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src'))
+
+
+@pytest.fixture
+def args():
+    """
+    Parsed default arguments with other_params as a dict (see utils.init), set as utils.args.
+    """
+    pytest.importorskip('utils_cython', reason='build utils_cython first, see README')
+    import utils
+    parser = argparse.ArgumentParser()
+    utils.add_argument(parser)
+    args = parser.parse_args(['--argoverse', '--future_frame_num', '30'])
+    args.other_params = {}
+    utils.args = args
+    return args
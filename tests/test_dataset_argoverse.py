@@ -0,0 +1,146 @@
+import os
+
+import numpy as np
+import pytest
+
+pytest.importorskip('argoverse')
+
+
+def test_preprocess_key_covers_preprocessing_options(args):
+    from dataset_argoverse import get_preprocess_key
+    args.other_params = {'goals_2D': True, 'direction': True}
+    key = get_preprocess_key(args)
+
+    args.mode_num = 6
+    assert get_preprocess_key(args) != key
+    args.mode_num = 12
+    args.other_params['set_predict'] = 6
+    assert get_preprocess_key(args) != key
+    del args.other_params['set_predict']
+
+    # Masking and eval params are applied after preprocessing.
+    args.other_params.update({'mask_lanes': True, 'p': '0.2', 'optimization': True})
+    args.eval_batch_size = 1
+    assert get_preprocess_key(args) == key
+
+
+def get_scenario(rng):
+    """
+    id2info (see argoverse_get_instance) and lane centerlines of a synthetic scenario, in the frame of the agent.
+
+    The third track has one point of history only, so it has no agent polyline.
+    """
+    from dataset_argoverse import type2index
+    id2info = {}
+    for id, object_type, frame_num in [('AGENT', 'AGENT', 50), ('AV', 'AV', 20), ('3', 'OTHERS', 20), ('4', 'OTHERS', 1),
+                                       ('5', 'OTHERS', 12), ('6', 'OTHERS', 20), ('7', 'OTHERS', 3)]:
+        info = np.zeros([frame_num, 5])
+        # Tracks other than AGENT end at the last frame of history.
+        info[:, 0] = (np.arange(frame_num) + max(20 - frame_num, 0)) * 0.1
+        info[:, 2] = type2index[object_type]
+        info[:, 3:5] = np.cumsum(rng.normal(size=[frame_num, 2]), axis=0)
+        id2info[id] = info
+    polygons = [np.cumsum(rng.normal(size=[int(rng.integers(2, 11)), 2]), axis=0) * 3 for _ in range(8)]
+    return id2info, polygons
+
+
+def get_preprocessed(args, id2info, polygons, monkeypatch):
+    import dataset_argoverse
+
+    def get_sub_map(args, x, y, city_name, vectors=[], polyline_spans=[], mapping=None):
+        mapping['polygons'] = polygons
+        mapping['goals_2D'] = dataset_argoverse.get_goals_2D(args, polygons)
+        # Two borders per lane.
+        mapping['vis_lanes'] = [each for polygon in polygons for each in [polygon - 1, polygon + 1]]
+        for polygon in polygons:
+            vectors.append(dataset_argoverse.get_lane_vectors(polygon, len(polyline_spans), args.hidden_size))
+            start = polyline_spans[-1][1]
+            polyline_spans.append([start, start + len(vectors[-1])])
+        return vectors, polyline_spans
+
+    monkeypatch.setattr(dataset_argoverse, 'get_sub_map', get_sub_map)
+    monkeypatch.setattr(dataset_argoverse, 'max_vector_num', 10 ** 9)
+    mapping = dict(file_name='0.csv', city_name='PIT', cent_x=0.0, cent_y=0.0, angle=0.0, agent_pred_index=20,
+                   two_seconds=1.9)
+    return dataset_argoverse.preprocess(args, {id: info.copy() for id, info in id2info.items()}, mapping)
+
+
+@pytest.mark.parametrize('mask', ['mask_lanes', 'mask_agents', 'mask_agents_frames'])
+def test_masked_mapping_matches_masked_preprocessing(args, mask, tmp_path, monkeypatch):
+    from dataset_argoverse import get_masked_mapping
+    from scenario_cache import ScenarioCache, ScenarioCacheWriter
+    args.visualize = args.use_map = True
+    args.other_params = {'goals_2D': True, 'subdivide': True, 'lane_scoring': True, mask: True, 'p': '0.5'}
+    id2info, polygons = get_scenario(np.random.default_rng(0))
+
+    writer = ScenarioCacheWriter(str(tmp_path))
+    writer.append(get_preprocessed(args, id2info, polygons, monkeypatch))
+    writer.close()
+    masked = get_masked_mapping(args, ScenarioCache(str(tmp_path))[0], np.random.default_rng(1))
+
+    # The same draws, applied to the scenario before preprocessing.
+    rng = np.random.default_rng(1)
+    agent_ids = [id for id, info in id2info.items() if len(info) > 1]
+    if mask == 'mask_agents':
+        for id, keep in zip(agent_ids[2:], rng.random(len(agent_ids) - 2) >= 0.5):
+            if not keep:
+                del id2info[id]
+    if mask == 'mask_agents_frames':
+        for id in agent_ids[2:]:
+            id2info[id] = id2info[id][rng.random(len(id2info[id])) > 0.5]
+    if mask == 'mask_lanes':
+        polygons = [polygon for polygon, keep in zip(polygons, rng.random(len(polygons)) > 0.5) if keep]
+    expected = get_preprocessed(args, id2info, polygons, monkeypatch)
+
+    assert np.array_equal(masked['matrix'], expected['matrix'])
+    assert masked['polyline_spans'] == expected['polyline_spans']
+    assert masked['map_start_polyline_idx'] == expected['map_start_polyline_idx']
+    for key in ['agents', 'trajs', 'vis_lanes', 'polygons']:
+        assert len(masked[key]) == len(expected[key])
+        for a, b in zip(masked[key], expected[key]):
+            assert np.array_equal(a, b.astype(a.dtype))
+    assert np.array_equal(masked['goals_2D'], expected['goals_2D'].astype(masked['goals_2D'].dtype))
+    assert masked['goals_2D_labels'] == expected['goals_2D_labels']
+    assert masked['stage_one_label'] == expected['stage_one_label']
+
+
+def test_touched_files_are_hashed_once(args, tmp_path, monkeypatch):
+    import dataset_argoverse
+    data_dir = tmp_path / 'data'
+    data_dir.mkdir()
+    for i in range(3):
+        (data_dir / '{}.csv'.format(i)).write_text('header\n{}\n'.format(i))
+    args.data_dir = [str(data_dir)]
+    args.temp_file_dir = str(tmp_path / 'temp')
+    args.core_num = 1
+
+    def argoverse_get_instance(lines, file_name, args):
+        return dict(file_name=file_name, matrix=np.full([2, args.hidden_size], float(lines[0]), dtype=np.float32),
+                    polyline_spans=[slice(0, 2)])
+
+    hashed = []
+
+    def get_file_hash(file):
+        hashed.append(file)
+        return file_hash(file)
+
+    file_hash = dataset_argoverse.get_file_hash
+    monkeypatch.setattr(dataset_argoverse, 'load_map', lambda: None)
+    monkeypatch.setattr(dataset_argoverse, 'argoverse_get_instance', argoverse_get_instance)
+    monkeypatch.setattr(dataset_argoverse, 'get_file_hash', get_file_hash)
+
+    def get_values():
+        dataset = dataset_argoverse.Dataset(args, 1, to_screen=False)
+        return [float(dataset[i]['matrix'][0, 0]) for i in range(len(dataset))]
+
+    assert get_values() == [0, 1, 2]
+    os.utime(data_dir / '1.csv', ns=(0, 0))
+    hashed.clear()
+    assert get_values() == [0, 1, 2]
+    assert hashed == [str(data_dir / '1.csv')]
+    hashed.clear()
+    assert get_values() == [0, 1, 2]
+    assert hashed == []
+    # A change of content after the touch is still preprocessed again.
+    (data_dir / '1.csv').write_text('header\n5\n')
+    assert get_values() == [0, 5, 2]
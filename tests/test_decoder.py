@@ -0,0 +1,71 @@
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+
+
+@pytest.fixture
+def decoder(args):
+    from modeling.decoder import Decoder
+    args.hidden_size = 16
+    args.other_params = {'goals_2D': True, 'lane_scoring': True}
+    torch.manual_seed(0)
+    return Decoder(args, None).eval()
+
+
+def lane_scoring_per_example(decoder, i, lane_states_batch, inputs, inputs_lengths, hidden_states, label):
+    """
+    Decoder.lane_scoring before it was batched, for one example.
+    """
+    stage_one_hidden = lane_states_batch[i]
+    stage_one_hidden_attention = decoder.stage_one_cross_attention(
+        stage_one_hidden.unsqueeze(0), inputs[i][:inputs_lengths[i]].unsqueeze(0)).squeeze(0)
+    stage_one_scores = decoder.stage_one_decoder(torch.cat([hidden_states[i, 0, :].unsqueeze(0).expand(
+        stage_one_hidden.shape), stage_one_hidden, stage_one_hidden_attention], dim=-1)).squeeze(-1)
+    stage_one_scores = F.log_softmax(stage_one_scores, dim=-1)
+    loss = F.nll_loss(stage_one_scores.unsqueeze(0), torch.tensor([label]))
+
+    _, stage_one_topk_ids = torch.topk(stage_one_scores, k=len(stage_one_scores))
+    sum = 0.0
+    for idx, each in enumerate(torch.exp(stage_one_scores[stage_one_topk_ids])):
+        sum += each
+        if sum > 0.95:
+            stage_one_topk_ids = stage_one_topk_ids[:idx + 1]
+            break
+    return lane_states_batch[i][stage_one_topk_ids], loss, label in stage_one_topk_ids.tolist()
+
+
+def test_lane_scoring_matches_per_example_loop(decoder):
+    import utils
+    torch.manual_seed(1)
+    lane_nums, inputs_lengths = [5, 40, 1, 12], [9, 50, 3, 20]
+    lane_states_batch = [torch.randn(n, 16) * 3 for n in lane_nums]
+    inputs = torch.randn(len(lane_nums), max(inputs_lengths), 16)
+    hidden_states = torch.randn(len(lane_nums), max(inputs_lengths), 16)
+    labels = [2, 7, 0, 11]
+    mapping = [dict(polygons=[None] * n, stage_one_label=label) for n, label in zip(lane_nums, labels)]
+
+    utils.other_errors_dict.clear()
+    utils.other_errors_tensors.clear()
+    loss = torch.zeros(len(lane_nums))
+    with torch.no_grad():
+        topk_lanes, topk_lanes_mask = decoder.lane_scoring(mapping, len(lane_nums), lane_states_batch, inputs,
+                                                           inputs_lengths, hidden_states, torch.device('cpu'), loss)
+        utils.sync_other_errors()
+        for i in range(len(lane_nums)):
+            expected_lanes, expected_loss, expected_recall = lane_scoring_per_example(
+                decoder, i, lane_states_batch, inputs, inputs_lengths, hidden_states, labels[i])
+            assert torch.allclose(topk_lanes[i][topk_lanes_mask[i]], expected_lanes, atol=1e-6)
+            assert torch.allclose(loss[i], expected_loss, atol=1e-5)
+            assert utils.other_errors_dict['stage_one_k'][i] == len(expected_lanes)
+            assert utils.other_errors_dict['stage_one_recall'][i] == float(expected_recall)
+
+
+def test_select_top_lanes_with_lanes_anywhere(decoder):
+    # Lanes need not be at the front of their example, as in modeling.inference.
+    scores = torch.log(torch.tensor([[0.0, 0.5, 0.0, 0.3, 0.2], [0.0, 0.0, 0.9, 0.06, 0.04]]))
+    lanes_mask = torch.tensor([[False, True, False, True, True], [False, False, True, True, True]])
+    lanes = torch.arange(10, dtype=torch.float).view(2, 5, 1)
+    topk_lanes, topk_lanes_mask, _ = decoder.select_top_lanes(scores, lanes, lanes_mask)
+    assert topk_lanes[0][topk_lanes_mask[0]].view(-1).tolist() == [1.0, 3.0, 4.0]
+    assert topk_lanes[1][topk_lanes_mask[1]].view(-1).tolist() == [7.0, 8.0]
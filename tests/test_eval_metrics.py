@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+from eval_metrics import DisplacementErrors
+
+
+def get_scores_per_frame(trajectories, labels):
+    """
+    ADE and DE@1..3 of the first modes, as post_eval computed them before DisplacementErrors.
+    """
+    DE = np.zeros(labels.shape[:2])
+    for i in range(len(labels)):
+        for j in range(labels.shape[1]):
+            DE[i][j] = np.sqrt((labels[i][j][0] - trajectories[i, 0, j, 0]) ** 2 +
+                               (labels[i][j][1] - trajectories[i, 0, j, 1]) ** 2)
+    length = DE.shape[1]
+    scores = [np.sum(np.mean(DE, axis=1)) / len(DE)]
+    for j in range(1, 4):
+        scores.append(np.sum(DE[:, round(float(length) * j / 3) - 1]) / len(DE))
+    return scores
+
+
+@pytest.mark.parametrize('scenario_num', [0, 3, 40])
+def test_displacement_errors(scenario_num):
+    rng = np.random.default_rng(0)
+    trajectories = rng.normal(size=[40, 6, 30, 2]) * 10
+    labels = rng.normal(size=[40, 30, 2]) * 10
+    DEs = DisplacementErrors(scenario_num, 30)
+    # The second batch is more than twice the size of the first one.
+    for start, end in [(0, 4), (4, 13), (13, 14), (14, 40)]:
+        DEs.add(trajectories[start:end], labels[start:end])
+    assert DEs.size == 40
+    assert np.allclose(DEs.get_scores(), get_scores_per_frame(trajectories, labels))
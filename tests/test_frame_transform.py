@@ -0,0 +1,58 @@
+import math
+
+import numpy as np
+import torch
+
+from frame_transform import Frame
+
+
+def get_frames_and_points(batch_size=4):
+    rng = np.random.default_rng(0)
+    x, y = rng.normal(size=[2, batch_size]) * 1000
+    angle = rng.uniform(-math.pi, math.pi, size=batch_size)
+    points = np.stack([x, y], axis=-1)[:, np.newaxis, :] + rng.normal(size=[batch_size, 30, 2]) * 50
+    return Frame(x, y, angle), points
+
+
+def rotate(x, y, angle):
+    """
+    utils.rotate, which transformed points one by one before Frame.
+    """
+    return x * math.cos(angle) - y * math.sin(angle), x * math.sin(angle) + y * math.cos(angle)
+
+
+def test_frame_matches_rotating_point_by_point():
+    frame, points = get_frames_and_points()
+    for i in range(len(points)):
+        to_frame = frame[i].to_frame(points[i])
+        origin_x, origin_y = rotate(0 - frame.x[i], 0 - frame.y[i], frame.angle[i])
+        for point, point_in_frame in zip(points[i], to_frame):
+            assert tuple(point_in_frame) == rotate(point[0] - frame.x[i], point[1] - frame.y[i], frame.angle[i])
+            assert tuple(frame[i].to_world(point_in_frame)) == \
+                   rotate(point_in_frame[0] - origin_x, point_in_frame[1] - origin_y, -frame.angle[i])
+
+
+def test_round_trip():
+    frame, points = get_frames_and_points()
+    assert np.allclose(frame.to_world(frame.to_frame(points)), points, rtol=0, atol=1e-9)
+    for i in range(len(points)):
+        assert np.allclose(frame[i].to_world(frame[i].to_frame(points[i])), points[i], rtol=0, atol=1e-9)
+    # Points in the frame are 50 m around the agent, so float32 keeps them to about 1e-5 m.
+    points_in_frame = frame.to_frame(points).astype(np.float32)
+    assert np.allclose(frame.to_frame(frame.to_world(points_in_frame)), points_in_frame, rtol=0, atol=1e-3)
+
+
+def test_batched_numpy_and_torch_frames_agree():
+    frame, points = get_frames_and_points()
+    to_frame = frame.to_frame(points)
+    assert np.array_equal(to_frame, np.stack([frame[i].to_frame(points[i]) for i in range(len(points))]))
+    assert np.array_equal(frame.to_frame(torch.tensor(points)).numpy(), to_frame)
+    assert np.array_equal(frame.to_world(torch.tensor(to_frame)).numpy(), frame.to_world(to_frame))
+    assert np.array_equal(frame[1].to_frame(torch.tensor(points[1])).numpy(), to_frame[1])
+
+
+def test_float32_points_keep_their_dtype():
+    frame, points = get_frames_and_points()
+    points_in_frame = frame.to_frame(points).astype(np.float32)
+    assert frame[0].to_world(points_in_frame[0]).dtype == np.float32
+    assert frame.to_world(torch.tensor(points_in_frame)).dtype == torch.float32
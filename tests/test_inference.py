@@ -0,0 +1,111 @@
+import numpy as np
+import pytest
+import torch
+
+
+def get_engine(args, extra_params=('laneGCN', 'lane_scoring')):
+    from modeling.inference import VectorNetInference
+    from modeling.vectornet import VectorNet
+    args.hidden_size = 32
+    args.other_params = {'semantic_lane': True, 'direction': True, 'goals_2D': True, 'enhance_global_graph': True,
+                         'subdivide': True, 'point_sub_graph': True, 'complete_traj': True, 'complete_traj-3': True}
+    args.other_params.update({name: True for name in extra_params})
+    torch.manual_seed(0)
+    return VectorNetInference(VectorNet(args), args).eval()
+
+
+@pytest.fixture
+def engine(args):
+    return get_engine(args)
+
+
+def get_inputs(batch_size, hidden_size, seed):
+    """
+    Random inputs of VectorNetInference (see pack_inputs) with 3 agents per example, the other elements are lanes.
+    """
+    generator = torch.Generator().manual_seed(seed)
+    element_nums = torch.randint(8, 20, [batch_size], generator=generator)
+    vector_nums = torch.randint(2, 20, [int(element_nums.sum())], generator=generator)
+    polyline_mask = torch.arange(19).unsqueeze(0) < vector_nums.unsqueeze(1)
+    polylines = torch.randn(list(polyline_mask.shape) + [hidden_size], generator=generator) * polyline_mask.unsqueeze(-1)
+    elements = torch.arange(int(element_nums.max())).unsqueeze(0)
+    element_mask = elements < element_nums.unsqueeze(1)
+    element_index = torch.where(element_mask, (torch.cumsum(element_nums, 0) - element_nums).unsqueeze(1) + elements,
+                                torch.zeros_like(elements))
+    lane_mask = element_mask & (elements >= 3)
+    goal_nums = torch.randint(20, 50, [batch_size], generator=generator)
+    goals = torch.randn([batch_size, 50, 2], generator=generator) * 10
+    goals_mask = torch.arange(50).unsqueeze(0) < goal_nums.unsqueeze(1)
+    return polylines, polyline_mask, element_index, element_mask, lane_mask, goals, goals_mask
+
+
+def test_traced_engine_matches_eager(engine, args, tmp_path):
+    from modeling.inference import export_torchscript
+    inputs = get_inputs(2, args.hidden_size, 0)
+    # Another batch size, and other polyline, element and goal numbers.
+    other_inputs = get_inputs(5, args.hidden_size, 1)
+    export_torchscript(engine, inputs, str(tmp_path / 'vectornet.pt'), check_inputs=[other_inputs])
+    traced = torch.jit.load(str(tmp_path / 'vectornet.pt'))
+    with torch.no_grad():
+        for each in [inputs, other_inputs]:
+            for output, traced_output in zip(engine(*each), traced(*each)):
+                assert output.shape == traced_output.shape
+                # Scores of padded goals are -inf in both.
+                assert torch.equal(output, traced_output)
+
+
+def get_mapping(batch_size, hidden_size, seed):
+    """
+    Preprocessed examples (see dataset_argoverse.preprocess) with random vectors and goals.
+    """
+    rng = np.random.default_rng(seed)
+    mapping = []
+    for i in range(batch_size):
+        agent_num, lane_num = int(rng.integers(2, 6)), int(rng.integers(3, 12))
+        # The AGENT history is the longest polyline, as in Argoverse.
+        lengths = [19] + rng.integers(1, 19, size=agent_num - 1).tolist() + rng.integers(1, 10, size=lane_num).tolist()
+        ends = np.cumsum(lengths)
+        mapping.append(dict(
+            matrix=rng.normal(size=[ends[-1], hidden_size]).astype(np.float32),
+            polyline_spans=[slice(int(end - length), int(end)) for end, length in zip(ends, lengths)],
+            map_start_polyline_idx=agent_num,
+            polygons=[None] * lane_num,
+            stage_one_label=0,
+            goals_2D=rng.normal(size=[int(rng.integers(20, 50)), 2]) * 10,
+        ))
+    return mapping
+
+
+@pytest.mark.parametrize('extra_params', [(), ('laneGCN',), ('lane_scoring',), ('laneGCN', 'lane_scoring')])
+def test_engine_matches_decoder(args, extra_params):
+    import utils
+    from modeling.inference import pack_inputs
+    engine = get_engine(args, extra_params)
+    model, decoder, device = engine.model, engine.model.decoder, torch.device('cpu')
+    if 'lane_scoring' in extra_params:
+        # Peaked lane scores, so that select_top_lanes leaves out some lanes.
+        decoder.stage_one_decoder.fc.weight.data *= 20
+    batch = utils.Batch(get_mapping(4, args.hidden_size, 0))
+    with torch.no_grad():
+        # The encoding of VectorNet.forward and Decoder.goals_2D_batch.
+        element_states_batch, lane_states_batch = model.forward_encode_sub_graph(batch, device, len(batch))
+        inputs, inputs_lengths = utils.merge_tensors(element_states_batch, device=device)
+        inputs_mask = utils.get_length_mask(inputs_lengths, inputs.shape[1], device)
+        hidden_states = model.global_graph(inputs, inputs_mask.unsqueeze(2), batch)
+        topk_lanes = None
+        if 'lane_scoring' in extra_params:
+            topk_lanes = decoder.lane_scoring(batch, len(batch), lane_states_batch, inputs, inputs_lengths,
+                                              hidden_states, device, torch.zeros(len(batch)))
+            assert torch.sum(topk_lanes[1]) < sum(len(each['polygons']) for each in batch)
+        goals_2D_batch = [torch.tensor(each['goals_2D'], dtype=torch.float) for each in batch]
+        scores_batch = decoder.get_scores(goals_2D_batch, inputs, hidden_states, inputs_lengths, device, topk_lanes)
+
+        scores, pred_goals, pred_trajs = engine(*pack_inputs(batch))
+        for i, expected in enumerate(scores_batch):
+            assert torch.allclose(scores[i, :len(expected)], expected, rtol=0, atol=1e-5)
+            assert torch.all(torch.isinf(scores[i, len(expected):]))
+            expected_goals = goals_2D_batch[i][torch.topk(expected, k=args.mode_num)[1]]
+            assert torch.equal(pred_goals[i], expected_goals)
+        expected_trajs = decoder.complete_trajectories(pred_goals, inputs, inputs_mask, hidden_states)
+        assert torch.allclose(pred_trajs[:, :, :-1], expected_trajs[:, :, :-1], rtol=0, atol=1e-5)
+        assert torch.equal(pred_trajs[:, :, -1], pred_goals)
@@ -0,0 +1,47 @@
+import pytest
+import torch
+
+
+def get_attention_pair(args, attention_class, **kwargs):
+    """
+    Modules of attention_class with the same weights, with attention_backend math and sdpa.
+    """
+    args.attention_backend = 'math'
+    torch.manual_seed(0)
+    math_module = attention_class(32, num_attention_heads=2, **kwargs).eval()
+    args.attention_backend = 'sdpa'
+    sdpa_module = attention_class(32, num_attention_heads=2, **kwargs).eval()
+    sdpa_module.load_state_dict(math_module.state_dict())
+    assert sdpa_module.fused and not math_module.fused
+    return math_module, sdpa_module
+
+
+def get_masks(batch_size, query_num, key_num):
+    generator = torch.Generator().manual_seed(1)
+    key_mask = torch.arange(key_num).unsqueeze(0) < torch.randint(1, key_num + 1, [batch_size, 1], generator=generator)
+    query_mask = torch.arange(query_num).unsqueeze(0) < torch.randint(1, query_num + 1, [batch_size, 1],
+                                                                      generator=generator)
+    full_mask = key_mask.unsqueeze(1) & query_mask.unsqueeze(2)
+    return [None, full_mask, full_mask.long(), key_mask.unsqueeze(1), query_mask.unsqueeze(2)]
+
+
+@pytest.mark.parametrize('mask_idx', range(5))
+def test_sdpa_global_graph_matches_math(args, mask_idx):
+    from modeling.lib import GlobalGraph
+    math_module, sdpa_module = get_attention_pair(args, GlobalGraph)
+    hidden_states = torch.randn([3, 7, 32], generator=torch.Generator().manual_seed(2))
+    mask = get_masks(3, 7, 7)[mask_idx]
+    with torch.no_grad():
+        assert torch.allclose(sdpa_module(hidden_states, mask), math_module(hidden_states, mask), rtol=0, atol=1e-5)
+
+
+@pytest.mark.parametrize('mask_idx', range(5))
+def test_sdpa_cross_attention_matches_math(args, mask_idx):
+    from modeling.lib import CrossAttention
+    math_module, sdpa_module = get_attention_pair(args, CrossAttention, key_hidden_size=16, query_hidden_size=8)
+    generator = torch.Generator().manual_seed(2)
+    query = torch.randn([3, 5, 8], generator=generator)
+    key = torch.randn([3, 9, 16], generator=generator)
+    mask = get_masks(3, 5, 9)[mask_idx]
+    with torch.no_grad():
+        assert torch.allclose(sdpa_module(query, key, mask), math_module(query, key, mask), rtol=0, atol=1e-5)
@@ -0,0 +1,39 @@
+import collections.abc
+import pickle
+
+import numpy as np
+import torch
+
+
+def get_mapping(hidden_size=8):
+    rng = np.random.default_rng(0)
+    mapping = []
+    for polyline_lengths in [[3, 2], [4], [1, 2, 5]]:
+        ends = np.cumsum(polyline_lengths)
+        mapping.append(dict(matrix=rng.normal(size=[ends[-1], hidden_size]).astype(np.float32),
+                            polyline_spans=[slice(int(end - length), int(end))
+                                            for end, length in zip(ends, polyline_lengths)]))
+    return mapping
+
+
+def test_batch_packs_polylines(args):
+    import utils
+    mapping = get_mapping()
+    batch = utils.Batch(mapping)
+    assert len(batch) == 3 and batch[1] is mapping[1] and list(batch) == mapping
+    assert batch.polyline_nums == [2, 1, 3]
+    polylines = [each['matrix'][span] for each in mapping for span in each['polyline_spans']]
+    for polyline, offset, length in zip(polylines, batch.offsets.tolist(), batch.lengths.tolist()):
+        assert np.array_equal(batch.vectors[offset:offset + length].numpy(), polyline)
+
+
+def test_batch_keeps_its_tensors_through_the_data_loader(args):
+    import utils
+    batch = utils.Batch(get_mapping())
+    # DataLoader(pin_memory=True) rebuilds sequences element by element, before or after checking for pin_memory.
+    assert not isinstance(batch, collections.abc.Sequence)
+    for each in [pickle.loads(pickle.dumps(batch)), batch.to(torch.device('cpu'))]:
+        assert isinstance(each, utils.Batch) and len(each) == 3
+        assert torch.equal(each.vectors, batch.vectors) and torch.equal(each.offsets, batch.offsets)
+    loader = torch.utils.data.DataLoader(get_mapping(), batch_size=2, collate_fn=utils.batch_list_to_batch_tensors)
+    assert [len(each) for each in loader if isinstance(each, utils.Batch)] == [2, 1]